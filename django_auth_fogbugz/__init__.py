@@ -1,2 +1,4 @@
 version = (1, 2, 0)
 version_string = '.'.join(str(x) for x in version)
+
+default_app_config = 'django_auth_fogbugz.apps.FogBugzConfig'
@@ -0,0 +1,558 @@
+# Copyright (c) 2012, Douglas Napoleone.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+#     3. Neither the name of Django nor the names of its contributors may be
+#        used to endorse or promote products derived from this software without
+#        specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Native asyncio support, used by ``FogBugzBackend.aauthenticate`` under
+ASGI (Django 5.2 and later).
+
+:class:`AsyncFogBugzClient` speaks just enough HTTP/1.1 over asyncio
+streams to make the FogBugz XML API calls the backend needs (``logon``,
+``viewPerson`` and ``logoff``) without holding a thread. All the calls for
+one login share a single keep-alive connection.
+"""
+
+from asgiref.sync import sync_to_async
+from urllib.parse import urlencode, urlsplit
+from xml.etree import ElementTree
+
+import asyncio
+import logging
+import ssl
+import time
+
+import fogbugz
+
+from . import limiter, metrics, singleflight, throttle
+from .breaker import CircuitOpenError, get_breaker
+from .client import cached_discovery, discover, person_from_element
+from .conf import get_settings
+
+logger = logging.getLogger('django_auth_fogbugz')
+
+async def adiscover(url):
+    """
+    Async :func:`.client.discover`, only leaving the event loop when the
+    discovery result is not cached in process.
+    """
+    api_url = cached_discovery(url)
+    if api_url is None:
+        api_url = await sync_to_async(discover, thread_sensitive=False)(url)
+    return api_url
+
+
+class AsyncFogBugzClient(object):
+    """
+    Minimal asyncio FogBugz XML API client. Responses are returned as the
+    ElementTree ``<response>`` element, API errors are raised as the same
+    ``fogbugz`` exceptions FogBugzPy uses.
+
+    Call :meth:`close` (or use ``async with``) when done with it.
+    """
+    def __init__(self, url, token=None):
+        if not url.endswith('/'):
+            url += '/'
+        self.url = url
+        self._token = token or None
+        self._api_url = None
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def token(self, token):
+        """
+        Set the token without actually logging on.
+        """
+        self._token = token
+
+    async def logon(self, username, password):
+        try:
+            response = await self.request('logon', email=username,
+                                          password=password)
+        except fogbugz.FogBugzConnectionError:
+            raise
+        except fogbugz.FogBugzAPIError as e:
+            raise fogbugz.FogBugzLogonError(e)
+        self._token = response.findtext('token')
+
+    async def logoff(self):
+        await self.request('logoff')
+        self._token = None
+
+    async def view_person(self, **kwargs):
+        """
+        Return the ``<person>`` element for the logged on user, or the
+        one selected by ``kwargs`` (e.g. ``ixPerson=3``).
+        """
+        response = await self.request('viewPerson', **kwargs)
+        return response.find('person')
+
+    async def discover(self):
+        """
+        Look up the API url, if it is not known yet.
+        """
+        if self._api_url is None:
+            self._api_url = await adiscover(self.url)
+
+    async def request(self, cmd, **kwargs):
+        await self.discover()
+        kwargs['cmd'] = cmd
+        if self._token:
+            kwargs['token'] = self._token
+        body = urlencode(kwargs).encode('utf-8')
+
+        circuit = get_breaker(self.url)
+        if circuit is not None and not circuit.allow():
+            raise fogbugz.FogBugzConnectionError(CircuitOpenError(self.url))
+        success = False
+        try:
+            async with self._lock:
+                try:
+                    data = await asyncio.wait_for(
+                        self._post(self._api_url, body),
+                        get_settings().TIMEOUT)
+                except asyncio.TimeoutError:
+                    ## the connection is in an unknown state.
+                    await self.close()
+                    raise fogbugz.FogBugzConnectionError(
+                        "Timed out waiting for FogBugz server (%s)." %
+                        self.url)
+            success = True
+        finally:
+            if circuit is not None:
+                circuit.record(success)
+        try:
+            response = ElementTree.fromstring(data)
+        except ElementTree.ParseError as e:
+            raise fogbugz.FogBugzConnectionError(e)
+        error = response.find('error')
+        if error is not None:
+            raise fogbugz.FogBugzAPIError('Error Code %s: %s' % (
+                error.get('code'), error.text))
+        return response
+
+    async def close(self):
+        writer = self._writer
+        self._reader = self._writer = None
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (OSError, ssl.SSLError):
+                pass
+
+    async def _connect(self, parts):
+        context = None
+        port = parts.port or 80
+        if parts.scheme == 'https':
+            context = ssl.create_default_context()
+            port = parts.port or 443
+        self._reader, self._writer = await asyncio.open_connection(
+            parts.hostname, port, ssl=context)
+
+    async def _post(self, url, body):
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        head = ('POST %s HTTP/1.1\r\n'
+                'Host: %s\r\n'
+                'Content-Type: application/x-www-form-urlencoded\r\n'
+                'Content-Length: %d\r\n'
+                'Connection: keep-alive\r\n'
+                '\r\n' % (path, parts.netloc, len(body)))
+        while True:
+            reused = self._writer is not None
+            try:
+                if not reused:
+                    await self._connect(parts)
+                self._writer.write(head.encode('latin-1') + body)
+                await self._writer.drain()
+                status, reason, data = await self._read_response()
+            except (OSError, EOFError, ValueError,
+                    asyncio.IncompleteReadError) as e:
+                await self.close()
+                if reused:
+                    ## The server closed an idle keep-alive connection,
+                    ## retry once on a fresh one.
+                    continue
+                raise fogbugz.FogBugzConnectionError(e)
+            break
+        if status >= 400:
+            raise fogbugz.FogBugzConnectionError(
+                "HTTP Error %d: %s" % (status, reason))
+        return data
+
+    async def _read_response(self):
+        reader = self._reader
+        line = await reader.readline()
+        if not line:
+            raise EOFError("Connection closed by the FogBugz server.")
+        status_line = line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        status = int(status_line[1])
+        reason = status_line[2] if len(status_line) > 2 else ''
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = headers.get('connection', '').lower() != 'close'
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(
+                    (await reader.readline()).split(b';')[0].strip(), 16)
+                if not size:
+                    ## skip any trailers
+                    while (await reader.readline()) not in (b'\r\n', b'\n',
+                                                            b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            data = b''.join(chunks)
+        elif 'content-length' in headers:
+            data = await reader.readexactly(int(headers['content-length']))
+        else:
+            data = await reader.read()
+            keep_alive = False
+
+        if not keep_alive:
+            await self.close()
+        return status, reason, data
+
+
+class AsyncGroup(object):
+    """
+    asyncio version of :class:`.singleflight.Group`.
+    """
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn):
+        call_key = (id(asyncio.get_running_loop()), key)
+        task = self._calls.get(call_key)
+        if task is not None:
+            return await asyncio.shield(task), True
+        task = asyncio.ensure_future(fn())
+        self._calls[call_key] = task
+        try:
+            ## shielded, so cancelling this caller does not cancel the
+            ## login for the callers waiting on it.
+            return await asyncio.shield(task), False
+        finally:
+            if self._calls.get(call_key) is task:
+                del self._calls[call_key]
+
+_alogins = AsyncGroup()
+
+
+async def aacquire(logons):
+    """
+    Async :meth:`.limiter.ConcurrencyLimiter.acquire`, polling for a
+    permit instead of blocking the event loop.
+    """
+    async def try_acquire():
+        if isinstance(logons, limiter.GlobalConcurrencyLimiter):
+            ## the cache is not async.
+            return await sync_to_async(logons.try_acquire,
+                                       thread_sensitive=False)()
+        return logons.try_acquire()
+
+    permit = await try_acquire()
+    if permit or not logons.enqueue():
+        return permit
+    loop = asyncio.get_running_loop()
+    start = time.time()
+    deadline = loop.time() + logons.timeout
+    try:
+        while not permit and loop.time() < deadline:
+            await asyncio.sleep(min(logons.poll_interval,
+                                    deadline - loop.time()))
+            permit = await try_acquire()
+    finally:
+        logons.dequeue(start, permit)
+    return permit
+
+async def arelease(logons, permit):
+    if isinstance(logons, limiter.GlobalConcurrencyLimiter):
+        await sync_to_async(logons.release, thread_sensitive=False)(permit)
+    else:
+        logons.release(permit)
+
+
+class AsyncBackendMixin(object):
+    """
+    Native ``aauthenticate`` for :class:`.backend.FogBugzBackend`.
+
+    FogBugz calls use :class:`AsyncFogBugzClient`. The database and cache
+    steps before and after them are the same ``_begin_login`` and
+    ``_finish_login`` as the sync path, each in one ``sync_to_async`` call.
+    """
+    async def aauthenticate(self, request=None, username=None, password=None):
+        from .backend import _client_address
+
+        if not username or not password:
+            return None
+        username = username.lower()
+
+        fbcfg = get_settings()
+        previous = metrics.start_login(username)
+        user = None
+        error = True
+        client = _client_address(request)
+        try:
+            throttled = throttle.enabled(fbcfg) and await sync_to_async(
+                self._throttled, thread_sensitive=False)(
+                fbcfg, username, password, client)
+            if not throttled:
+                user = await self._aauthenticate_coalesced(fbcfg, username,
+                                                           password)
+                if user is None and throttle.enabled(fbcfg):
+                    await sync_to_async(self._record_rejection,
+                                        thread_sensitive=False)(
+                        fbcfg, username, password, client)
+            error = False
+        finally:
+            metrics.finish_login(previous, user, error)
+        return user
+
+    async def _aauthenticate_coalesced(self, fbcfg, username, password):
+        if not fbcfg.COALESCE_LOGINS:
+            return await self._aauthenticate(fbcfg, username, password)
+
+        key = singleflight.login_key(username, password)
+        user, shared = await _alogins.do(
+            key, lambda: self._aauthenticate_leased(fbcfg, key, username,
+                                                    password))
+        if shared and user is not None:
+            logger.debug("Shared concurrent login result for user (%s).",
+                         username)
+            user = await sync_to_async(self.get_user)(user.pk)
+        return user
+
+    async def _aauthenticate_leased(self, fbcfg, key, username, password):
+        """
+        Async :meth:`_authenticate_leased`, waiting for the lease in a
+        thread.
+        """
+        if not fbcfg.COALESCE_LEASE_TIMEOUT:
+            return await self._aauthenticate(fbcfg, username, password)
+
+        lease = singleflight.Lease(key, fbcfg.COALESCE_LEASE_TIMEOUT)
+        if not await sync_to_async(lease.acquire, thread_sensitive=False)():
+            found, pk = await sync_to_async(lease.wait,
+                                            thread_sensitive=False)()
+            if found:
+                logger.debug("Shared login result from another process for "
+                             "user (%s).", username)
+                if not pk:
+                    return None
+                return await sync_to_async(self.get_user)(pk)
+            return await self._aauthenticate(fbcfg, username, password)
+
+        try:
+            user = await self._aauthenticate(fbcfg, username, password)
+        except BaseException:
+            await sync_to_async(lease.release, thread_sensitive=False)()
+            raise
+        await sync_to_async(lease.release, thread_sensitive=False)(
+            user.pk if user is not None else 0)
+        return user
+
+    async def _aauthenticate(self, fbcfg, username, password):
+        """
+        Async :meth:`_authenticate`. The steps before and after the FogBugz
+        calls are the same ``_begin_login`` and ``_finish_login``, each run
+        in one ``sync_to_async`` call.
+        """
+        done, user, username, email_login, person = await sync_to_async(
+            self._begin_login)(fbcfg, username, password)
+        if done:
+            return user
+
+        fb = None
+        try:
+            if not person:
+                try:
+                    fb, person = await self._alimited_logon(
+                        fbcfg, user, username, password)
+                except fogbugz.FogBugzConnectionError as e:
+                    return await sync_to_async(self._connection_failed)(
+                        fbcfg, user, username, password, e)
+                if not person:
+                    return None
+
+            user = await sync_to_async(self._finish_login)(
+                fbcfg, user, username, email_login, fb, person, password)
+            if user is None:
+                await self._afogbugz_logoff(fbcfg, fb, username,
+                                            keep_token=False)
+                return None
+            with metrics.timed('logoff'):
+                await self._afogbugz_logoff(fbcfg, fb, username)
+            return user
+        finally:
+            if fb:
+                await fb.close()
+
+    async def _alimited_logon(self, fbcfg, user, username, password):
+        """
+        Async :meth:`_limited_logon`.
+        """
+        logons = limiter.get_limiter()
+        if logons is None:
+            return await self._afogbugz_logon(fbcfg, user, username,
+                                              password)
+        permit = await aacquire(logons)
+        if not permit:
+            self._log_logon_rejected(fbcfg, username)
+            return None, None
+        try:
+            return await self._afogbugz_logon(fbcfg, user, username,
+                                              password)
+        finally:
+            await arelease(logons, permit)
+
+    async def _afogbugz_logon(self, fbcfg, user, username, password):
+        """
+        Async :meth:`_fogbugz_logon`. On failure the client is closed and
+        ``(None, None)`` is returned, connection errors are raised.
+        """
+        fb = AsyncFogBugzClient(fbcfg.SERVER)
+        try:
+            with metrics.timed('connect'):
+                await fb.discover()
+
+            profile, reuse_token, clear_token, queue_token = \
+                self._stored_token(fbcfg, user, username)
+            if clear_token:
+                logger.debug("Clearing existing token for user (%s).",
+                             username)
+                fb.token(clear_token)
+                try:
+                    with metrics.timed('clear_token'):
+                        await fb.logoff()
+                except Exception as e:
+                    self._log_clear_failed(fbcfg, username, e)
+                    fb.token(None)
+
+            try:
+                with metrics.timed('logon'):
+                    await fb.logon(username, password)
+            except fogbugz.FogBugzConnectionError:
+                raise
+            except fogbugz.FogBugzLogonError as e:
+                await sync_to_async(self._logon_failed,
+                                    thread_sensitive=False)(
+                    fbcfg, username, e)
+                await fb.close()
+                return None, None
+            finally:
+                if queue_token and fb._token != queue_token:
+                    if not self._queue_clear_token(fbcfg, queue_token,
+                                                   username):
+                        await self._aclear_token(fbcfg, queue_token,
+                                                 username)
+
+            if reuse_token:
+                stored = await self._acheck_token(fbcfg, profile, username)
+                if stored:
+                    if fb._token != profile.token:
+                        await self._afogbugz_logoff(fbcfg, fb, username,
+                                                    keep_token=False)
+                    await fb.close()
+                    return stored
+
+            try:
+                with metrics.timed('view_person'):
+                    element = await fb.view_person()
+            except fogbugz.FogBugzConnectionError:
+                await self._afogbugz_logoff(fbcfg, fb, username,
+                                            keep_token=False)
+                raise
+            except fogbugz.FogBugzAPIError as e:
+                self._view_person_failed(fbcfg, username, e)
+                await fb.close()
+                return None, None
+            person = person_from_element(element)
+        except BaseException:
+            await fb.close()
+            raise
+        return fb, person
+
+    async def _aclear_token(self, fbcfg, token, username):
+        """
+        Async :meth:`_clear_token`.
+        """
+        logger.debug("Clearing existing token for user (%s).", username)
+        old = AsyncFogBugzClient(fbcfg.SERVER, token)
+        try:
+            with metrics.timed('clear_token'):
+                await old.logoff()
+        except Exception as e:
+            self._log_clear_failed(fbcfg, username, e)
+        finally:
+            await old.close()
+
+    async def _acheck_token(self, fbcfg, profile, username):
+        """
+        Async :meth:`_check_token`.
+        """
+        stored = AsyncFogBugzClient(fbcfg.SERVER, profile.token)
+        try:
+            person = person_from_element(await stored.view_person())
+        except fogbugz.FogBugzAPIError as e:
+            self._log_stored_token_invalid(username, e)
+            await stored.close()
+            return None
+        result = self._stored_person(stored, profile, person, username)
+        if result is None:
+            await stored.close()
+        return result
+
+    async def _afogbugz_logoff(self, fbcfg, fb, username, keep_token=None):
+        """
+        Async :meth:`_fogbugz_logoff`.
+        """
+        if not self._logoff_inline(fbcfg, fb, username, keep_token):
+            return
+        try:
+            await fb.logoff()
+        except Exception as e:
+            self._log_logoff_failed(fbcfg, username, e)
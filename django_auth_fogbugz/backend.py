@@ -28,60 +28,133 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 from django.contrib.auth.backends import ModelBackend
-from django.core.validators import URLValidator, EmailValidator
+from django.contrib.auth.hashers import check_password, make_password
+from django.core.validators import EmailValidator
 from django.core.exceptions import ValidationError
-
-try:
-    from django.contrib.auth import get_user_model
-except ImportError:
-    from django.contrib.auth.models import User
-    def get_user_model():
-        return User
+from django.db import transaction
+from django.utils import timezone
+from django.contrib.auth import get_user_model
 
 import sys
 import traceback
 import logging
+import datetime
 
 import fogbugz
 
 from .models import FogBugzProfile
+from .conf import FogBugzSettings, get_settings
+from .client import FogBugzClient, FogBugzPerson, forget_client
+from .permissions import get_role_permissions, role_permissions
+from . import (breaker, credentials, limiter, logoff, metrics, singleflight,
+               throttle, tokens)
+## connects the user_logged_in receiver keeping the person in the session.
+from . import session
 
-class FogBugzSettings(object):
-    """
-    Django setting wrapper, ensuring all values exist with defaults.
-    """
-    _server_validator = URLValidator(message=
-        "AUTH_FOGBUGZ_SERVER must be set to a valid fogbugz api url.")
-
-    defaults = dict(
-    #   SETTING_NAME         =     ('Default Value', Validator),
-        SERVER               =     (None,            _server_validator),
-        ENABLE_PROFILE       =     (False,           None),
-        ENABLE_PROFILE_TOKEN =     (False,           None),
-        ALLOW_COMMUNITY      =     (False,           None),
-        AUTO_CREATE_USERS    =     (False,           None),
-        SERVER_USES_LDAP     =     (False,           None),
-        MAP_ADMIN_AS_SUPER   =     (False,           None),
-        MAP_ADMIN_AS_STAFF   =     (False,           None),
-    )
+from .aio import AsyncBackendMixin
 
-    def __init__(self, prefix='AUTH_FOGBUGZ_'):
-        """
-        Loads our settings from django.conf.settings, applying defaults,
-        and raising an exception if a validator is supplied and fails.
-        """
-        from django.conf import settings
+def _username_from_email(email):
+    return email.lower()
 
-        for name, (default, test) in self.defaults.items():
-            value = getattr(settings, prefix + name, default)
+def _user_lookup(fbcfg, username):
+    """
+    Work out how to find the Django user for a (lower-cased) login name.
+    The problem here is that it could be the email address or an LDAP
+    user login.
+
+    Returns ``(email_login, username, lookups)`` where ``lookups`` are the
+    keyword arguments for the user model manager ``get()``, to be tried in
+    order. E-mail logins try the indexed :class:`FogBugzProfile` e-mail
+    address first, falling back to a case insensitive match (which can not
+    use an index) for users without a profile yet, such as those created
+    by hand. Their first login creates the profile.
+    """
+    try:
+        EmailValidator()(username)
+        ## it's an e-mail address...
+        if not fbcfg.ENABLE_PROFILE:
+            return True, username, [dict(email__iexact=username)]
+        return True, username, [dict(fogbugzprofile__email=username),
+                                dict(email__iexact=username)]
+    except ValidationError:
+        if '\\' in username:
+            ## LDAP username with domain specified, strip the '\\'
+            username = username.split('\\')[-1]
+        username_field = getattr(get_user_model(), 'USERNAME_FIELD',
+                                 'username')
+        return False, username, [{username_field: username}]
+
+def _use_credential_cache(fbcfg):
+    ## A cached login has no fresh token to store in the profile, which is
+    ## only fine if the stored one is being kept anyway.
+    return fbcfg.CREDENTIAL_CACHE_TTL and not (
+        fbcfg.ENABLE_PROFILE and fbcfg.ENABLE_PROFILE_TOKEN and
+        not fbcfg.REUSE_PROFILE_TOKEN)
+
+def _use_offline_login(fbcfg):
+    return fbcfg.OFFLINE_LOGIN_TTL and fbcfg.ENABLE_PROFILE
+
+def _offline_values(fbcfg, profile, password):
+    """
+    The offline verifier profile fields for a password FogBugz accepted.
+    The verifier is only hashed again, and its expiry pushed out, once half
+    of it has passed, so most logins neither hash the password nor write.
+    A password changed in FogBugz is picked up then.
+    """
+    now = timezone.now()
+    ttl = fbcfg.OFFLINE_LOGIN_TTL
+    if (profile is not None and profile.offline_verifier and
+            profile.offline_expires is not None and
+            profile.offline_expires - now >=
+            datetime.timedelta(seconds=ttl / 2.0)):
+        return {}
+    return dict(offline_verifier=make_password(password),
+                offline_expires=now + datetime.timedelta(seconds=ttl))
+
+def _token_expires(fbcfg, token):
+    if not token:
+        return None
+    return timezone.now() + datetime.timedelta(seconds=fbcfg.TOKEN_LIFETIME)
+
+def _user_queryset(fbcfg):
+    """
+    The users to look up logins in, with the profile fetched in the same
+    query when it is enabled.
+    """
+    manager = get_user_model()._default_manager
+    if fbcfg.ENABLE_PROFILE:
+        return manager.select_related('fogbugzprofile')
+    return manager.all()
 
-            if callable(test):
-                test(value)
+def _client_address(request):
+    """
+    The address a login came from, for the per client throttle.
+    """
+    if request is None:
+        return None
+    return request.META.get('REMOTE_ADDR') or None
 
-            setattr(self, name, value)
+def _cached_profile(user):
+    """
+    The user's FogBugzProfile or ``None``, without a query when it was
+    fetched with :func:`_user_queryset`.
+    """
+    try:
+        return user.fogbugzprofile
+    except FogBugzProfile.DoesNotExist:
+        return None
 
-def _username_from_email(email):
-    return email.lower()
+def _set_changed(obj, values):
+    """
+    Set the attributes on ``obj`` which differ from ``values``, returning
+    the names of those that changed.
+    """
+    changed = []
+    for name, value in sorted(values.items()):
+        if getattr(obj, name) != value:
+            setattr(obj, name, value)
+            changed.append(name)
+    return changed
 
 class NullHandler(logging.Handler):
     def emit(self, record):
@@ -90,9 +163,12 @@ class NullHandler(logging.Handler):
 logger = logging.getLogger('django_auth_fogbugz')
 logger.addHandler(NullHandler())
 
-class FogBugzBackend(ModelBackend):
+## Concurrent logins in flight in this process, see COALESCE_LOGINS.
+_logins = singleflight.Group()
+
+class FogBugzBackend(AsyncBackendMixin, ModelBackend):
 
-    def authenticate(self, username=None, password=None):
+    def authenticate(self, request=None, username=None, password=None):
         if not username or not password:
             return None
 
@@ -102,39 +178,306 @@ class FogBugzBackend(ModelBackend):
         ## LDAP is enabled.
         username = username.lower()
 
-        fbcfg = FogBugzSettings()
+        fbcfg = get_settings()
+        previous = metrics.start_login(username)
+        user = None
+        error = True
+        client = _client_address(request)
+        try:
+            if not self._throttled(fbcfg, username, password, client):
+                user = self._authenticate_coalesced(fbcfg, username,
+                                                    password)
+                if user is None:
+                    self._record_rejection(fbcfg, username, password, client)
+            error = False
+        finally:
+            metrics.finish_login(previous, user, error)
+        return user
+
+    def _throttled(self, fbcfg, username, password, client):
+        """
+        Check the recent failed logons (see :mod:`.throttle`), returns
+        ``True`` if the login is turned away without contacting FogBugz.
+        """
+        if not throttle.enabled(fbcfg):
+            return False
+        outcome = throttle.check(fbcfg, username, password, client)
+        if outcome is None:
+            return False
+        metrics.set_outcome(outcome)
+        logger.info("Login Failed: Turning away user (%s) from (%s) after "
+                    "recent failed logons (%s).", username, client, outcome)
+        return True
+
+    def _record_rejection(self, fbcfg, username, password, client):
+        outcome = metrics.get_outcome()
+        if throttle.enabled(fbcfg) and outcome in throttle.REJECTIONS:
+            throttle.record(fbcfg, username, password, client, outcome)
+
+    def _authenticate_coalesced(self, fbcfg, username, password):
+        if not fbcfg.COALESCE_LOGINS:
+            return self._authenticate(fbcfg, username, password)
+
+        ## Only one login per username and password does the FogBugz
+        ## exchange, concurrent ones wait for it and share the result.
+        key = singleflight.login_key(username, password)
+        user, shared = _logins.do(key, lambda: self._authenticate_leased(
+            fbcfg, key, username, password))
+        if shared and user is not None:
+            ## every caller gets its own user instance.
+            logger.debug("Shared concurrent login result for user (%s).",
+                         username)
+            user = self.get_user(user.pk)
+        return user
+
+    def get_user_by_ixPerson(self, ixPerson):
+        """
+        The Django user for a FogBugz person id, or ``None``. Only users
+        with a FogBugzProfile (AUTH_FOGBUGZ_ENABLE_PROFILE) can be found.
+        """
+        try:
+            return _user_queryset(get_settings()).get(
+                fogbugzprofile__ixPerson=ixPerson)
+        except get_user_model().DoesNotExist:
+            return None
+
+    def get_all_permissions(self, user_obj, obj=None):
+        """
+        The ModelBackend permissions plus, with ROLE_PERMISSIONS, those the
+        user's FogBugz role grants (see :mod:`.permissions`).
+        """
+        perms = super(FogBugzBackend, self).get_all_permissions(user_obj, obj)
+        fbcfg = get_settings()
+        if (not fbcfg.ROLE_PERMISSIONS or not fbcfg.ENABLE_PROFILE or
+                obj is not None or not user_obj.is_active or
+                user_obj.is_anonymous):
+            return perms
+        ## cached on the user like ModelBackend's _perm_cache, as
+        ## has_perm() calls this for every check.
+        all_perms = getattr(user_obj, '_fogbugz_perm_cache', None)
+        if all_perms is None:
+            all_perms = set(perms) | get_role_permissions(user_obj)
+            user_obj._fogbugz_perm_cache = all_perms
+        return all_perms
+
+    def _authenticate_leased(self, fbcfg, key, username, password):
+        """
+        Coalesce logins across processes with a cache lease when
+        COALESCE_LEASE_TIMEOUT is set.
+        """
+        if not fbcfg.COALESCE_LEASE_TIMEOUT:
+            return self._authenticate(fbcfg, username, password)
+
+        lease = singleflight.Lease(key, fbcfg.COALESCE_LEASE_TIMEOUT)
+        if not lease.acquire():
+            found, pk = lease.wait()
+            if found:
+                logger.debug("Shared login result from another process for "
+                             "user (%s).", username)
+                if not pk:
+                    return None
+                return self.get_user(pk)
+            ## the other process gave up, or took too long. Do it ourselves.
+            return self._authenticate(fbcfg, username, password)
+
+        try:
+            user = self._authenticate(fbcfg, username, password)
+        except Exception:
+            lease.release()
+            raise
+        ## publish 0 for a failed login, so waiters do not retry it.
+        lease.release(user.pk if user is not None else 0)
+        return user
+
+    def _authenticate(self, fbcfg, username, password):
+        done, user, username, email_login, person = self._begin_login(
+            fbcfg, username, password)
+        if done:
+            return user
+
+        fb = None
+        if not person:
+            try:
+                fb, person = self._limited_logon(fbcfg, user, username,
+                                                 password)
+            except fogbugz.FogBugzConnectionError as e:
+                return self._connection_failed(fbcfg, user, username,
+                                               password, e)
+            if not person:
+                return None
+
+        user = self._finish_login(fbcfg, user, username, email_login, fb,
+                                  person, password)
+        if user is None:
+            self._fogbugz_logoff(fbcfg, fb, username, keep_token=False)
+            return None
+        with metrics.timed('logoff'):
+            self._fogbugz_logoff(fbcfg, fb, username)
+        return user
+
+    def _begin_login(self, fbcfg, username, password):
+        """
+        The login steps before any FogBugz call, shared with
+        ``aauthenticate``: the circuit breaker, the user lookup, the
+        settings checks and the credential cache.
+
+        Returns ``(done, user, username, email_login, person)``. When
+        ``done`` is set ``user`` is the result of the login. Otherwise the
+        password still has to be checked with FogBugz, unless ``person``
+        was found in the credential cache.
+        """
+        offline = breaker.is_open(fbcfg.SERVER)
+        if offline and not _use_offline_login(fbcfg):
+            ## Fail fast, later backends can still log in local accounts.
+            self._log_breaker_open(fbcfg, username)
+            return True, None, username, False, None
 
         ## first check to see if there is already a user account for this
         ## user.
         user = None
-        email = ''
-        ixPerson = 0
-        email_login = False
         UserModel = get_user_model()
-        ## the problem here is that it could be the email address
-        ## or an LDAP user login.
-        try:
-            try:
-                EmailValidator()(username)
-                ## it's an e-mail address...
-                email_login = True
-                user = UserModel.objects.get(email__iexact=username)
-            except ValidationError:
-                if '\\' in username:
-                    ## LDAP username with domain specified, strip the '\\'
-                    username = username.split('\\')[-1]
-                    user = UserModel.objects.get_by_natural_key(username)
-                else:
-                    user = UserModel.objects.get_by_natural_key(username)
-        except UserModel.DoesNotExist:
-            logger.debug("No pre-existing user model for user (%s).", username)
+        email_login, username, lookups = _user_lookup(fbcfg, username)
+        with metrics.timed('lookup'):
+            for lookup in lookups:
+                try:
+                    user = _user_queryset(fbcfg).get(**lookup)
+                    break
+                except UserModel.DoesNotExist:
+                    pass
+            else:
+                logger.debug("No pre-existing user model for user (%s).",
+                             username)
+
+        if not self._can_login(fbcfg, user, username, email_login):
+            return True, None, username, email_login, None
+
+        if offline:
+            self._log_breaker_open(fbcfg, username)
+            return (True, self._offline_login(fbcfg, user, username, password),
+                    username, email_login, None)
+
+        person = None
+        if _use_credential_cache(fbcfg):
+            person = credentials.lookup(username, password)
+            if person:
+                logger.debug("Verified user (%s) from the credential cache.",
+                             username)
+                if user is not None:
+                    return (True,
+                            self._cached_login(fbcfg, user, username, person),
+                            username, email_login, person)
+        return False, user, username, email_login, person
+
+    def _connection_failed(self, fbcfg, user, username, password, error):
+        logger.error("Login Failed: "
+                     "FogBugz Server (%s) Connection Error: %s",
+                     fbcfg.SERVER, str(error))
+        metrics.set_outcome(metrics.CONNECTION_ERROR)
+        return self._offline_login(fbcfg, user, username, password)
+
+    def _finish_login(self, fbcfg, user, username, email_login, fb, person,
+                      password):
+        """
+        The login steps once the password is verified, shared with
+        ``aauthenticate``: the community check, and saving the user and
+        profile. ``fb`` is the logged on client, or ``None`` for a password
+        verified from the credential cache.
+
+        Returns the user, or ``None`` if the person may not log in. The
+        logon token is left for the caller to log off.
+        """
+        if fb and _use_credential_cache(fbcfg):
+            credentials.remember(username, password, person)
+
+        if not self._person_allowed(fbcfg, person, username):
+            throttle.remember_community(fbcfg, username, person.ixPerson)
+            return None
+
+        ## Only store a token we were given by FogBugz, a login answered
+        ## from the credential cache leaves the stored token alone.
+        token = None
+        if fb and fbcfg.ENABLE_PROFILE_TOKEN:
+            token = fb._token
+
+        ## Only refresh the offline verifier after FogBugz checked the
+        ## password.
+        with metrics.timed('save'):
+            user = self._save_user(fbcfg, user, username, email_login,
+                                   person, token, password if fb else None)
+        ## kept in the session by django_auth_fogbugz.session.
+        user._fogbugz_person = person
+        return user
+
+    def _cached_login(self, fbcfg, user, username, person):
+        """
+        Log in an existing user whose password was verified from the
+        credential cache. The admin and community flags cached with it may
+        be out of date (a sync or later login may have changed them), so the
+        user and profile are not written, and the stored profile flags
+        apply.
+        """
+        profile = None
+        if fbcfg.ENABLE_PROFILE:
+            profile = _cached_profile(user)
+        if profile is not None:
+            person = FogBugzPerson(profile.ixPerson, person.fullname,
+                                   person.email, profile.is_administrator,
+                                   profile.is_community)
+        if not self._person_allowed(fbcfg, person, username):
+            return None
+        user._fogbugz_person = person
+        return user
 
+    def _offline_login(self, fbcfg, user, username, password):
+        """
+        Check the password against the profile's offline verifier, when
+        the FogBugz server can not be reached. The admin and community
+        flags are those from the last successful login or sync.
+        """
+        if not _use_offline_login(fbcfg) or not user:
+            return None
+        profile = _cached_profile(user)
+        if profile is None or not profile.offline_verifier:
+            logger.debug("Login Failed: No offline verifier for user (%s).",
+                         username)
+            return None
+        if (profile.offline_expires is None or
+                profile.offline_expires <= timezone.now()):
+            logger.debug("Login Failed: The offline verifier for user (%s) "
+                         "has expired.", username)
+            return None
+        if not check_password(password, profile.offline_verifier):
+            logger.debug("Login Failed: Offline verification failed for "
+                         "user (%s).", username)
+            return None
+        if profile.is_community and not fbcfg.ALLOW_COMMUNITY:
+            logger.debug("Login Failed: Community users are not allowed. "
+                         "User (%s) is a community user on Server (%s).",
+                         username, fbcfg.SERVER)
+            metrics.set_outcome(metrics.COMMUNITY_REJECTED)
+            return None
+        logger.info("Logged in user (%s) offline, FogBugz Server (%s) is "
+                    "unavailable.", username, fbcfg.SERVER)
+        return user
+
+    def _log_breaker_open(self, fbcfg, username):
+        metrics.set_outcome(metrics.CIRCUIT_OPEN)
+        logger.warning("Login Failed: FogBugz Server (%s) is failing, the "
+                       "circuit breaker is open. Not checking user (%s).",
+                       fbcfg.SERVER, username)
+
+    def _can_login(self, fbcfg, user, username, email_login):
+        """
+        Check the settings allow a FogBugz login for this username, before
+        contacting the FogBugz server.
+        """
         if not user and not fbcfg.AUTO_CREATE_USERS:
             ## no existing user, and not allowed to create new ones
             logger.debug(
                 "Login Failed: No auto creation of users, "
                 "login failed for user (%s).", username)
-            return None
+            metrics.set_outcome(metrics.NO_USER)
+            return False
 
         if not email_login and not fbcfg.SERVER_USES_LDAP:
             ## Reguardless if it is an existing user, if we do not have
@@ -144,7 +487,8 @@ class FogBugzBackend(ModelBackend):
             logger.debug("Login Failed: User (%s) logged in with non-e-mail "
                          "username and AUTH_FOGBUGZ_SERVER_USES_LDAP "
                          "is not set. ", username)
-            return None
+            metrics.set_outcome(metrics.NOT_ALLOWED)
+            return False
 
         if not user and email_login and fbcfg.SERVER_USES_LDAP:
             ## no existing user, and logging in with e-mail, but
@@ -159,140 +503,102 @@ class FogBugzBackend(ModelBackend):
                          "(%s) is configured for LDAP authentication. User "
                          "must login with their LDAP username the "
                          "first time. ", username, fbcfg.SERVER)
-            return None
-
-
+            metrics.set_outcome(metrics.NOT_ALLOWED)
+            return False
 
-        try:
-            fb = fogbugz.FogBugz(fbcfg.SERVER)
-        except fogbugz.FogBugzConnectionError as e:
-            ## Log the error
-            logger.error("Login Failed: "
-                         "FogBugz Server (%s) Connection Error: %s",
-                         fbcfg.SERVER, str(e))
-            return None
+        return True
 
-        if user and fbcfg.ENABLE_PROFILE:
-            ## get the old token from the profile
-            token = None
-            try:
-                token = user.fogbugzprofile.token
-                ixPerson = user.fogbugzprofile.ixPerson
-            except FogBugzProfile.DoesNotExist:
-                logger.debug("No existing token for user (%s).", username)
-            if token:
-                logger.debug("Clearing existing token for user (%s).",username)
-                fb.token(token)
-                try:
-                    ## Loging off explicitly will clear the token
-                    fb.logoff()
-                except Exception as e:
-                    ## reset it if the logoff failed. Could fail for many
-                    ## reasons. Later logon logic will handle meaningful
-                    ## errors.
-                    logger.warning("Failed to clear old token for user (%s). "
-                                   "Reconnecting to FogBugz Server (%s). "
-                                   "Message: %s",
-                                   username, fbcfg.SERVER, str(e))
-                    fb = fogbugz.FogBugz(fbcfg.SERVER)
-
-        try:
-            fb.logon(username, password)
-        except fogbugz.FogBugzLogonError as e:
-            ## Log:
-            logger.debug("Login Failed: "
-                "Authentication Failure on Server (%s) for user (%s): %s",
-                fbcfg.SERVER, username, str(e))
-            #### RED_FLAG: check for inactive user and set in Django if there
-            ####           is a Django user.
-
-            return None
-
-        ## NOTE: FogBugz allows for logging in with the e-mail address
-        ##       as well as the username. Make sure you have the proper
-        ##       username.
-        ## We also do not want to allow community users unless settings
-        ## says we should.
-        res = fb.viewPerson()
-        fbPerson=res.person
-        community = fbPerson.fcommunity.string=='true'
-        if not fbcfg.ALLOW_COMMUNITY and community:
+    def _person_allowed(self, fbcfg, person, username):
+        """
+        We do not want to allow community users unless settings says we
+        should.
+        """
+        if not fbcfg.ALLOW_COMMUNITY and person.community:
             ## Log:
             logger.debug("Login Failed: Community users are not allowed. "
                          "User (%s) is a community user on Server (%s).",
                          username, fbcfg.SERVER)
-            try:
-                fb.logoff()
-            except Exception as e:
-                logger.warning("Failed to logoff community user (%s) from "
-                               "server (%s): %s", username, fbcfg.SERVER,
-                               str(e))
-            return None
+            metrics.set_outcome(metrics.COMMUNITY_REJECTED)
+            return False
+        return True
+
+    def _save_user(self, fbcfg, user, username, email_login, person, token,
+                   password=None):
+        """
+        Update the existing user and profile from the FogBugz person
+        details, or create them for a new user. Returns the user.
 
-        if not ixPerson:
-            ixPerson = int(fbPerson.ixperson.string,10)
-        fullname = fbPerson.sfullname.string
-        admin = fbPerson.fadministrator.string == 'true'
+        ``password`` is given when FogBugz verified it, to refresh the
+        offline verifier (see OFFLINE_LOGIN_TTL).
+
+        Only the fields which changed are written, most logins of an
+        existing user do not write at all.
+        """
+        UserModel = get_user_model()
+        admin = person.admin
+        community = person.community
         verb1 = 'Removing'
         verb2 = 'from'
         if admin:
             verb1 = 'Adding'
             verb2 = 'to'
 
-        if user:
-            changed_user = False
-            if fbcfg.MAP_ADMIN_AS_SUPER:
-                if user.is_superuser != admin:
-                    user.is_superuser = admin
-                    changed_user = True
-                    logger.debug("%s superuser access %s user (%s) from "
-                                 "server (%s).", verb1, verb2,
-                                 username, fbcfg.SERVER)
-            if admin and fbcfg.MAP_ADMIN_AS_STAFF:
-                if user.is_staff != admin:
-                    user.is_staff = admin
-                    logger.debug("%s staff access %s user (%s) from "
-                                 "server (%s).", verb1, verb2,
-                                 username, fbcfg.SERVER)
-                    changed_user = True
-            if changed_user:
-                user.save()
+        profile_values = dict(
+            ixPerson = person.ixPerson,
+            email = person.email.lower(),
+            is_normal = not community and not admin,
+            is_community = community,
+            is_administrator = admin,
+            permissions = role_permissions(fbcfg, admin, community))
+        if fbcfg.ENABLE_PROFILE_TOKEN and token is not None:
+            profile_values['token'] = token
 
+        if user:
+            user_values = {}
+            if fbcfg.MAP_ADMIN_AS_SUPER and user.is_superuser != admin:
+                user_values['is_superuser'] = admin
+                logger.debug("%s superuser access %s user (%s) from "
+                             "server (%s).", verb1, verb2,
+                             username, fbcfg.SERVER)
+            if admin and fbcfg.MAP_ADMIN_AS_STAFF and not user.is_staff:
+                user_values['is_staff'] = admin
+                logger.debug("%s staff access %s user (%s) from "
+                             "server (%s).", verb1, verb2,
+                             username, fbcfg.SERVER)
+
+            profile = None
+            created = False
+            profile_fields = []
             if fbcfg.ENABLE_PROFILE:
-                try:
-                    if fbcfg.ENABLE_PROFILE_TOKEN:
-                        user.fogbugzprofile.token = fb._token
-                    user.fogbugzprofile.is_normal = not community and not admin
-                    user.fogbugzprofile.is_community = community
-                    user.fogbugzprofile.is_administrator = admin
-                    user.fogbugzprofile.save()
-                    logger.debug("Updated user (%s) token for server (%s).",
-                                 username, fbcfg.SERVER)
-                except FogBugzProfile.DoesNotExist:
-                    token = ''
-                    if fbcfg.ENABLE_PROFILE_TOKEN:
-                        token = fb._token
-                    fbprofile = FogBugzProfile(
-                        user = user,
-                        is_normal = not community and not admin,
-                        is_community = community,
-                        is_administrator = admin,
-                        ixPerson = ixPerson,
-                        token = token)
+                profile = _cached_profile(user)
+                if profile is None:
+                    profile = FogBugzProfile(user=user)
+                    created = True
+                if password is not None and _use_offline_login(fbcfg):
+                    profile_values.update(
+                        _offline_values(fbcfg, profile, password))
+                old_token = profile.token
+                profile_fields = _set_changed(profile, profile_values)
+                if 'token' in profile_fields:
+                    forget_client(old_token)
+                    tokens.forget(old_token)
+                    profile.token_expires = _token_expires(fbcfg, token)
+                    profile_fields.append('token_expires')
+
+            if not user_values and not profile_fields:
+                return user
+
+            with transaction.atomic():
+                if user_values:
+                    user.save(update_fields=_set_changed(user, user_values))
+                if created:
+                    profile.save(force_insert=True)
                     logger.debug("Created user (%s) token profile for "
                                  "server (%s).", username, fbcfg.SERVER)
-                    fbprofile.save()
-
-
-            if not fbcfg.ENABLE_PROFILE_TOKEN or not fbcfg.ENABLE_PROFILE:
-                ## clear the token, as we are not saving it.
-                try:
-                    fb.logoff()
-                except Exception as e:
-                    logger.warning("Failed to logoff user (%s) from "
-                                   "server (%s): %s", username, fbcfg.SERVER,
-                                   str(e))
-
+                elif profile_fields:
+                    profile.save(update_fields=profile_fields)
+                    logger.debug("Updated user (%s) profile for server (%s).",
+                                 username, fbcfg.SERVER)
             return user
 
         ## Create a new user and profile and return it.
@@ -300,42 +606,270 @@ class FogBugzBackend(ModelBackend):
             email = username
             username = _username_from_email(email)
         else:
-            email = fbPerson.semail.string
+            email = person.email
 
         logger.debug("Creating new user with token profile for "
                      "user (%s) from server (%s).", username, fbcfg.SERVER)
 
-        user = UserModel.objects.create_user(username=username, email=email)
-        user.first_name = fullname
+        user_values = dict(first_name=person.fullname)
         if admin and fbcfg.MAP_ADMIN_AS_SUPER:
             logger.debug("%s superuser access %s user (%s) from "
                          "server (%s).", verb1, verb2, username, fbcfg.SERVER)
-            user.is_superuser = True
+            user_values['is_superuser'] = True
         if admin and fbcfg.MAP_ADMIN_AS_STAFF:
             logger.debug("%s staff access %s user (%s) from "
                          "server (%s).", verb1, verb2, username, fbcfg.SERVER)
-            user.is_staff = True
-        user.save()
-        if fbcfg.ENABLE_PROFILE:
-            token = ''
-            if fbcfg.ENABLE_PROFILE_TOKEN:
-                token = fb._token
-            fbprofile = FogBugzProfile(
-                user = user,
-                ixPerson = ixPerson,
-                is_normal = not community and not admin,
-                is_community = community,
-                is_administrator = admin,
-                token = token)
-            fbprofile.save()
-
-        if not fbcfg.ENABLE_PROFILE_TOKEN or not fbcfg.ENABLE_PROFILE:
-            ## clear the token as we are not saving it
+            user_values['is_staff'] = True
+
+        with transaction.atomic():
+            user = UserModel._default_manager.create_user(
+                username=username, email=email, **user_values)
+            if fbcfg.ENABLE_PROFILE:
+                profile_values.setdefault('token', '')
+                if password is not None and _use_offline_login(fbcfg):
+                    profile_values.update(
+                        _offline_values(fbcfg, None, password))
+                profile = FogBugzProfile(
+                    user = user,
+                    token_expires = _token_expires(fbcfg, token),
+                    **profile_values)
+                profile.save(force_insert=True)
+        return user
+
+    def _limited_logon(self, fbcfg, user, username, password):
+        """
+        :meth:`_fogbugz_logon`, waiting for a free slot when
+        LOGON_CONCURRENCY is set. A login which can not get one fails.
+        """
+        logons = limiter.get_limiter()
+        if logons is None:
+            return self._fogbugz_logon(fbcfg, user, username, password)
+        permit = logons.acquire()
+        if not permit:
+            self._log_logon_rejected(fbcfg, username)
+            return None, None
+        try:
+            return self._fogbugz_logon(fbcfg, user, username, password)
+        finally:
+            logons.release(permit)
+
+    def _log_logon_rejected(self, fbcfg, username):
+        metrics.set_outcome(metrics.OVERLOADED)
+        logger.warning("Login Failed: Too many logons in progress to "
+                       "FogBugz Server (%s), turning away user (%s).",
+                       fbcfg.SERVER, username)
+
+    def _fogbugz_logon(self, fbcfg, user, username, password):
+        """
+        Verify the password with the FogBugz server.
+
+        Returns the logged on client and the
+        :class:`.client.FogBugzPerson`, or ``(None, None)`` if the login
+        failed. Raises ``fogbugz.FogBugzConnectionError`` if the server
+        could not be reached.
+        """
+        with metrics.timed('connect'):
+            fb = FogBugzClient(fbcfg.SERVER)
+
+        profile, reuse_token, clear_token, queue_token = self._stored_token(
+            fbcfg, user, username)
+        if clear_token:
+            logger.debug("Clearing existing token for user (%s).", username)
+            fb.token(clear_token)
             try:
-                fb.logoff()
+                ## Loging off explicitly will clear the token
+                with metrics.timed('clear_token'):
+                    fb.logoff()
             except Exception as e:
-                logger.warning("Failed to logoff user (%s) from "
-                               "server (%s): %s", username, fbcfg.SERVER,
-                               str(e))
+                ## reset it if the logoff failed. Could fail for many
+                ## reasons. Later logon logic will handle meaningful
+                ## errors.
+                self._log_clear_failed(fbcfg, username, e)
+                fb._token = None
 
-        return user
+        try:
+            with metrics.timed('logon'):
+                fb.logon(username, password)
+        except fogbugz.FogBugzConnectionError:
+            raise
+        except fogbugz.FogBugzLogonError as e:
+            self._logon_failed(fbcfg, username, e)
+            return None, None
+        finally:
+            if queue_token and fb._token != queue_token:
+                if not self._queue_clear_token(fbcfg, queue_token, username):
+                    self._clear_token(fbcfg, queue_token, username)
+
+        if reuse_token:
+            stored = self._check_token(fbcfg, profile, username)
+            if stored:
+                ## keep the stored token, and discard the one we were
+                ## just given (FogBugz may hand back the same one).
+                if fb._token != profile.token:
+                    self._fogbugz_logoff(fbcfg, fb, username,
+                                         keep_token=False)
+                return stored
+            ## the stored token is no longer valid, so there is nothing
+            ## to clear, and the new one replaces it.
+
+        ## NOTE: FogBugz allows for logging in with the e-mail address
+        ##       as well as the username. Make sure you have the proper
+        ##       username.
+        try:
+            with metrics.timed('view_person'):
+                person = fb.view_person()
+            return fb, person
+        except fogbugz.FogBugzConnectionError:
+            self._fogbugz_logoff(fbcfg, fb, username, keep_token=False)
+            raise
+        except fogbugz.FogBugzAPIError as e:
+            self._view_person_failed(fbcfg, username, e)
+            return None, None
+
+    def _stored_token(self, fbcfg, user, username):
+        """
+        The user's profile, and what a logon does with its stored token.
+
+        Returns ``(profile, reuse, clear, queue)``. With ``reuse`` the
+        stored token is checked and kept (REUSE_PROFILE_TOKEN). Otherwise
+        ``clear`` is a token to log off before the logon, or with
+        DEFER_LOGOFF ``queue`` is one to queue for logoff once the logon
+        returns, if FogBugz did not hand the same one back.
+        """
+        profile = None
+        token = None
+        if user and fbcfg.ENABLE_PROFILE:
+            ## get the old token from the profile
+            profile = _cached_profile(user)
+            if profile is None:
+                logger.debug("No existing token for user (%s).", username)
+            else:
+                token = profile.token
+        if not token:
+            return profile, False, None, None
+        if self._can_reuse_token(fbcfg, profile, username):
+            return profile, True, None, None
+        if fbcfg.DEFER_LOGOFF:
+            return profile, False, None, token
+        return profile, False, token, None
+
+    def _logon_failed(self, fbcfg, username, error):
+        ## Log:
+        logger.debug("Login Failed: "
+            "Authentication Failure on Server (%s) for user (%s): %s",
+            fbcfg.SERVER, username, str(error))
+        #### RED_FLAG: check for inactive user and set in Django if there
+        ####           is a Django user.
+        metrics.set_outcome(metrics.BAD_PASSWORD)
+        if fbcfg.CREDENTIAL_CACHE_TTL:
+            credentials.forget(username)
+
+    def _view_person_failed(self, fbcfg, username, error):
+        logger.warning("Login Failed: viewPerson for user (%s) on "
+                       "FogBugz Server (%s) failed: %s",
+                       username, fbcfg.SERVER, str(error))
+
+    def _log_clear_failed(self, fbcfg, username, error):
+        logger.warning("Failed to clear old token for user (%s) on "
+                       "FogBugz Server (%s). Message: %s",
+                       username, fbcfg.SERVER, str(error))
+
+    def _queue_clear_token(self, fbcfg, token, username):
+        """
+        Queue a logoff of the replaced profile ``token``. Returns ``False``
+        if the logoff queue is full, and it should be cleared inline.
+        """
+        if not logoff.defer_logoff(fbcfg.SERVER, token, username):
+            return False
+        logger.debug("Queued clearing existing token for user (%s).",
+                     username)
+        return True
+
+    def _clear_token(self, fbcfg, token, username):
+        logger.debug("Clearing existing token for user (%s).", username)
+        try:
+            with metrics.timed('clear_token'):
+                FogBugzClient(fbcfg.SERVER, token).logoff()
+        except Exception as e:
+            self._log_clear_failed(fbcfg, username, e)
+
+    def _can_reuse_token(self, fbcfg, profile, username):
+        """
+        With REUSE_PROFILE_TOKEN, a stored token which has not reached its
+        expiry time is checked and kept, instead of replaced.
+        """
+        if not (fbcfg.REUSE_PROFILE_TOKEN and fbcfg.ENABLE_PROFILE_TOKEN):
+            return False
+        if profile.token_expires and profile.token_expires <= timezone.now():
+            logger.debug("Stored token for user (%s) has expired.", username)
+            return False
+        return True
+
+    def _check_token(self, fbcfg, profile, username):
+        """
+        Check the stored profile token is still valid with a ``viewPerson``
+        call. Returns a client using it and the person details, or ``None``.
+        """
+        stored = FogBugzClient(fbcfg.SERVER, profile.token)
+        try:
+            person = stored.view_person()
+        except fogbugz.FogBugzAPIError as e:
+            self._log_stored_token_invalid(username, e)
+            return None
+        return self._stored_person(stored, profile, person, username)
+
+    def _log_stored_token_invalid(self, username, error):
+        logger.debug("Stored token for user (%s) is no longer valid: %s",
+                     username, str(error))
+
+    def _stored_person(self, stored, profile, person, username):
+        if person.ixPerson != profile.ixPerson:
+            return None
+        logger.debug("Keeping the stored token for user (%s).", username)
+        return stored, person
+
+    def _fogbugz_logoff(self, fbcfg, fb, username, keep_token=None):
+        """
+        Clear the token from a successful logon, unless it is being kept
+        in the profile. With DEFER_LOGOFF this is queued to run in the
+        background.
+        """
+        if not self._logoff_inline(fbcfg, fb, username, keep_token):
+            return
+        try:
+            fb.logoff()
+        except Exception as e:
+            self._log_logoff_failed(fbcfg, username, e)
+
+    def _logoff_inline(self, fbcfg, fb, username, keep_token=None):
+        """
+        Decide on the token of a successful logon, returns ``True`` if it
+        should be logged off inline. It is not if it is kept in the
+        profile, or was queued (DEFER_LOGOFF).
+        """
+        if keep_token is None:
+            keep_token = fbcfg.ENABLE_PROFILE_TOKEN and fbcfg.ENABLE_PROFILE
+        if not fb or keep_token:
+            return False
+        if fbcfg.DEFER_LOGOFF and logoff.defer_logoff(
+                fbcfg.SERVER, fb._token, username):
+            fb._token = None
+            return False
+        return True
+
+    def _log_logoff_failed(self, fbcfg, username, error):
+        logger.warning("Failed to logoff user (%s) from "
+                       "server (%s): %s", username, fbcfg.SERVER,
+                       str(error))
+
+
+class FogBugzTokenBackend(ModelBackend):
+    """
+    Authenticates a FogBugz API token (as sent by API clients, see
+    :class:`.middleware.FogBugzTokenMiddleware`) as the user it belongs to,
+    see :mod:`.tokens`.
+    """
+    def authenticate(self, request=None, fogbugz_token=None):
+        if not fogbugz_token:
+            return None
+        return tokens.get_user(fogbugz_token, _client_address(request))
@@ -0,0 +1,191 @@
+# Copyright (c) 2012, Douglas Napoleone.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+#     3. Neither the name of Django nor the names of its contributors may be
+#        used to endorse or promote products derived from this software without
+#        specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Login throughput benchmark for :class:`.backend.FogBugzBackend`, normally
+run against a :class:`.mockserver.MockFogBugzServer` by the
+``fogbugz_benchmark`` management command.
+"""
+
+from django.db import connection, connections
+
+import multiprocessing
+import threading
+import time
+
+from .transport import close_pools
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+def percentile(values, pct):
+    """
+    The ``pct`` percentile of the sorted list ``values``.
+    """
+    if not values:
+        return 0.0
+    index = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+class BenchmarkResult(object):
+    """
+    Login latencies and database query counts of a benchmark run.
+    """
+    def __init__(self, latencies, failed, queries, elapsed):
+        self.latencies = sorted(latencies)
+        self.failed = failed
+        self.queries = queries
+        self.elapsed = elapsed
+
+    @property
+    def logins(self):
+        return len(self.latencies)
+
+    @property
+    def rate(self):
+        return self.logins / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def p50(self):
+        return percentile(self.latencies, 50)
+
+    @property
+    def p99(self):
+        return percentile(self.latencies, 99)
+
+    @property
+    def queries_per_login(self):
+        return float(self.queries) / self.logins if self.logins else 0.0
+
+
+def _login_worker(backend, people, next_login, results, own_thread=True):
+    """
+    Log people in until ``next_login()`` returns ``None``, appending
+    ``(latency, ok, queries)`` to ``results``.
+    """
+    queries = [0]
+
+    def count(execute, sql, params, many, context):
+        queries[0] += 1
+        return execute(sql, params, many, context)
+
+    try:
+        with connection.execute_wrapper(count):
+            while True:
+                index = next_login()
+                if index is None:
+                    break
+                person = people[index % len(people)]
+                queries[0] = 0
+                start = _clock()
+                user = backend.authenticate(None, username=person.email,
+                                            password=person.password)
+                results.append((_clock() - start, user is not None,
+                                queries[0]))
+    finally:
+        if own_thread:
+            connection.close()
+
+def _run_threads(people, logins, threads):
+    from .backend import FogBugzBackend
+
+    backend = FogBugzBackend()
+    lock = threading.Lock()
+    counter = [0]
+    results = []
+
+    def next_login():
+        with lock:
+            if counter[0] >= logins:
+                return None
+            counter[0] += 1
+            return counter[0] - 1
+
+    if threads <= 1:
+        ## in this thread, so the current transaction (e.g. a TestCase)
+        ## is used.
+        _login_worker(backend, people, next_login, results, own_thread=False)
+        return results
+
+    workers = [threading.Thread(target=_login_worker,
+                                args=(backend, people, next_login, results))
+               for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return results
+
+def _process_main(people, logins, threads, queue):
+    ## connections inherited from the parent must not be shared.
+    close_pools()
+    try:
+        queue.put(_run_threads(people, logins, threads))
+    except Exception as e:
+        queue.put(e)
+
+def run_logins(people, logins, threads=1, processes=1):
+    """
+    Log in ``logins`` times, cycling through the ``people`` fixtures, from
+    ``threads`` threads in each of ``processes`` (forked) processes.
+    Returns a :class:`BenchmarkResult`.
+    """
+    start = _clock()
+    if processes <= 1:
+        results = _run_threads(people, logins, threads)
+    else:
+        context = multiprocessing.get_context('fork') if hasattr(
+            multiprocessing, 'get_context') else multiprocessing
+        queue = context.Queue()
+        connections.close_all()
+        close_pools()
+        share, extra = divmod(logins, processes)
+        children = [context.Process(
+                        target=_process_main,
+                        args=(people, share + (1 if i < extra else 0),
+                              threads, queue))
+                    for i in range(processes)]
+        for child in children:
+            child.start()
+        results = []
+        for child in children:
+            result = queue.get()
+            if isinstance(result, Exception):
+                raise result
+            results.extend(result)
+        for child in children:
+            child.join()
+    elapsed = _clock() - start
+
+    return BenchmarkResult([latency for latency, ok, queries in results],
+                           len([ok for latency, ok, queries in results
+                                if not ok]),
+                           sum(queries for latency, ok, queries in results),
+                           elapsed)
@@ -0,0 +1,198 @@
+# Copyright (c) 2012, Douglas Napoleone.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+#     3. Neither the name of Django nor the names of its contributors may be
+#        used to endorse or promote products derived from this software without
+#        specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Circuit breaker for the FogBugz server.
+
+Every request to a FogBugz server is reported to the server's
+:class:`CircuitBreaker`. When the share of failed requests in the recent
+window reaches ``AUTH_FOGBUGZ_BREAKER_THRESHOLD`` the breaker opens, and
+requests fail immediately with :class:`CircuitOpenError` instead of waiting
+on a sick server. After ``AUTH_FOGBUGZ_BREAKER_OPEN_TIME`` seconds a single
+probe request is let through, closing the breaker again if it succeeds.
+"""
+
+from urllib.error import URLError
+from urllib.parse import urlsplit
+
+from collections import deque
+from django.dispatch import receiver
+
+import threading
+import time
+
+from .conf import SETTINGS_PREFIX, get_settings, setting_changed
+
+
+class CircuitOpenError(URLError):
+    """
+    Raised instead of sending a request while the breaker is open. A
+    ``URLError``, so FogBugzPy reports it as a connection error.
+    """
+    def __init__(self, url):
+        URLError.__init__(self, "Circuit breaker open for FogBugz server "
+                                "(%s)." % url)
+
+
+class CircuitBreaker(object):
+    """
+    Thread safe closed / open / half-open circuit breaker.
+
+    Call :meth:`allow` before each request, and :meth:`record` with the
+    outcome of every request it allowed.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=0.5, min_calls=10, window=60, open_time=30):
+        self.threshold = threshold
+        self.min_calls = min_calls
+        self.window = window
+        self.open_time = open_time
+        self.state = self.CLOSED
+        self._calls = deque()
+        self._failures = 0
+        self._opened_at = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Return ``True`` if a request may be sent. Once the open period is
+        over only one probe request at a time is allowed.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.time() - self._opened_at < self.open_time:
+                    return False
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def is_open(self):
+        """
+        Return ``True`` if a request would be refused right now, without
+        using up the half-open probe.
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                return time.time() - self._opened_at < self.open_time
+            return self.state == self.HALF_OPEN and self._probing
+
+    def record(self, success):
+        """
+        Report the outcome of an allowed request.
+        """
+        now = time.time()
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+                if success:
+                    self._close()
+                else:
+                    self._open(now)
+                return
+            if self.state == self.OPEN:
+                ## a slow request which started before the breaker opened.
+                return
+
+            self._calls.append((now, success))
+            if not success:
+                self._failures += 1
+            cutoff = now - self.window
+            while self._calls and self._calls[0][0] < cutoff:
+                if not self._calls.popleft()[1]:
+                    self._failures -= 1
+            if (len(self._calls) >= self.min_calls and
+                    self._failures >= self.threshold * len(self._calls)):
+                self._open(now)
+
+    def _open(self, now):
+        self.state = self.OPEN
+        self._opened_at = now
+        self._calls.clear()
+        self._failures = 0
+
+    def _close(self):
+        self.state = self.CLOSED
+        self._calls.clear()
+        self._failures = 0
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(url):
+    """
+    Return the shared :class:`CircuitBreaker` for the server of ``url``, or
+    ``None`` when ``AUTH_FOGBUGZ_BREAKER_THRESHOLD`` is not set.
+    """
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    breaker = _breakers.get(key)
+    if breaker is None:
+        fbcfg = get_settings()
+        if not fbcfg.BREAKER_THRESHOLD:
+            return None
+        with _breakers_lock:
+            breaker = _breakers.get(key)
+            if breaker is None:
+                breaker = CircuitBreaker(
+                    threshold=fbcfg.BREAKER_THRESHOLD,
+                    min_calls=fbcfg.BREAKER_MIN_CALLS,
+                    window=fbcfg.BREAKER_WINDOW,
+                    open_time=fbcfg.BREAKER_OPEN_TIME)
+                _breakers[key] = breaker
+    return breaker
+
+def is_open(url):
+    """
+    Return ``True`` if requests to the server of ``url`` are currently
+    being refused.
+    """
+    breaker = get_breaker(url)
+    return breaker is not None and breaker.is_open()
+
+def reset_breakers():
+    """
+    Forget every breaker and its history.
+    """
+    with _breakers_lock:
+        _breakers.clear()
+
+@receiver(setting_changed)
+def _setting_changed(sender, setting=None, **kwargs):
+    if setting and setting.startswith(SETTINGS_PREFIX):
+        reset_breakers()
@@ -0,0 +1,104 @@
+# Copyright (c) 2012, Douglas Napoleone.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+#     3. Neither the name of Django nor the names of its contributors may be
+#        used to endorse or promote products derived from this software without
+#        specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Helpers for the caches used by the backend.
+"""
+
+from django.utils.encoding import force_bytes
+
+from collections import OrderedDict
+
+import hashlib
+import threading
+import time
+
+from .conf import get_settings
+
+KEY_PREFIX = 'django_auth_fogbugz'
+
+def get_cache():
+    """
+    Return the Django cache named by the AUTH_FOGBUGZ_CACHE_ALIAS setting.
+    """
+    from django.core.cache import caches
+    return caches[get_settings().CACHE_ALIAS]
+
+def make_key(kind, *parts):
+    """
+    Build a cache key safe for any cache backend (no spaces, bounded
+    length) from arbitrary, possibly user supplied, parts.
+    """
+    digest = hashlib.sha1(force_bytes(u'\x00'.join(parts))).hexdigest()
+    return '%s:%s:%s' % (KEY_PREFIX, kind, digest)
+
+
+class LRUCache(object):
+    """
+    Small thread safe in process cache with least recently used eviction
+    and per entry expiry. Implements the ``get``/``set``/``delete`` subset
+    of the Django cache API so the two can be used interchangeably.
+    """
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires is not None and expires <= time.time():
+                return default
+            ## re-insert to mark it as most recently used.
+            self._data[key] = entry
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires = None
+        if timeout is not None:
+            expires = time.time() + timeout
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
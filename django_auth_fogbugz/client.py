@@ -0,0 +1,368 @@
+# Copyright (c) 2012, Douglas Napoleone.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+#     3. Neither the name of Django nor the names of its contributors may be
+#        used to endorse or promote products derived from this software without
+#        specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+FogBugzPy client wired up to the shared pooled transport.
+"""
+
+from django.dispatch import receiver
+from xml.etree import ElementTree
+
+from urllib.error import URLError
+from urllib.parse import urlencode
+from urllib.request import Request
+
+import threading
+import time
+
+import fogbugz
+
+from .cache import LRUCache, get_cache, make_key
+from .conf import SETTINGS_PREFIX, get_settings, setting_changed
+from .transport import get_opener
+
+_discovered = {}
+_discover_lock = threading.Lock()
+
+_clients = None
+_clients_lock = threading.Lock()
+
+def discover(url):
+    """
+    Return the API url for the FogBugz server at ``url`` (which must end in
+    a ``/``), as published by the server's ``api.xml``.
+
+    Results are cached for ``AUTH_FOGBUGZ_DISCOVERY_CACHE_TTL`` seconds,
+    both in process and in the Django cache so they are shared between
+    worker processes. Raises ``fogbugz.FogBugzConnectionError`` if the
+    server can not be reached.
+    """
+    ttl = get_settings().DISCOVERY_CACHE_TTL
+    if not ttl:
+        return _fetch_api_url(url)
+
+    now = time.time()
+    entry = _discovered.get(url)
+    if entry and entry[1] > now:
+        return entry[0]
+
+    with _discover_lock:
+        ## another thread may have refreshed it while we waited.
+        entry = _discovered.get(url)
+        if entry and entry[1] > now:
+            return entry[0]
+
+        key = make_key('api', url)
+        api_url = get_cache().get(key)
+        if api_url is None:
+            api_url = _fetch_api_url(url)
+            get_cache().set(key, api_url, ttl)
+        _discovered[url] = (api_url, now + ttl)
+    return api_url
+
+def cached_discovery(url):
+    """
+    Return the in process :func:`discover` result for ``url``, or ``None``
+    if there is no unexpired one. Never does any I/O.
+    """
+    entry = _discovered.get(url)
+    if entry and entry[1] > time.time():
+        return entry[0]
+    return None
+
+def clear_discovery_cache():
+    """
+    Forget all in process discovery results.
+    """
+    with _discover_lock:
+        _discovered.clear()
+
+class FogBugzPerson(object):
+    """
+    The FogBugz person details the backend and sync use. ``fingerprint``
+    is filled in by :class:`.sync.PeopleSync`.
+    """
+    __slots__ = ('ixPerson', 'fullname', 'email', 'admin', 'community',
+                 'deleted', 'fingerprint')
+
+    def __init__(self, ixPerson, fullname='', email='', admin=False,
+                 community=False, deleted=False, fingerprint=''):
+        self.ixPerson = ixPerson
+        self.fullname = fullname
+        self.email = email
+        self.admin = admin
+        self.community = community
+        self.deleted = deleted
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def from_fields(cls, fields):
+        """
+        Build the person from the text of the ``<person>`` child elements,
+        keyed by lower case tag name.
+        """
+        return cls(ixPerson = int(fields['ixperson'], 10),
+                   fullname = fields.get('sfullname', ''),
+                   email = fields.get('semail', ''),
+                   admin = fields.get('fadministrator') == 'true',
+                   community = fields.get('fcommunity') == 'true',
+                   deleted = fields.get('fdeleted') == 'true')
+
+    def __eq__(self, other):
+        if not isinstance(other, FogBugzPerson):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name)
+                   for name in self.__slots__)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<FogBugzPerson %s (%s)>' % (self.ixPerson, self.email)
+
+## the <person> children FogBugzPerson is built from.
+PERSON_FIELDS = ('ixperson', 'sfullname', 'semail', 'fadministrator',
+                 'fcommunity', 'fdeleted')
+
+def person_from_element(person):
+    """
+    Pull the details the backend needs out of an ElementTree ``<person>``
+    element from a ``viewPerson`` or ``listPeople`` response.
+    """
+    ## tag case differs between FogBugz versions, match it insensitively.
+    return FogBugzPerson.from_fields(dict(
+        (child.tag.lower(), child.text or '') for child in person))
+
+def parse_fields(response, names, stop):
+    """
+    Pull the text of the elements in ``names`` (lower case tag names) out
+    of a FogBugz API response, without keeping a tree of the rest of it.
+    Parsing ends at the close of the ``stop`` element. Raises
+    ``fogbugz.FogBugzAPIError`` for an ``<error>`` response.
+    """
+    fields = {}
+    for event, elem in ElementTree.iterparse(response):
+        tag = elem.tag.lower()
+        if tag == 'error':
+            raise fogbugz.FogBugzAPIError('Error Code %s: %s' % (
+                elem.get('code'), elem.text))
+        if tag in names:
+            fields[tag] = elem.text or ''
+        if tag == stop:
+            break
+        elem.clear()
+    return fields
+
+def parse_person(response):
+    """
+    Parse a ``viewPerson`` response into a :class:`FogBugzPerson`.
+    """
+    fields = parse_fields(response, PERSON_FIELDS, 'person')
+    if 'ixperson' not in fields:
+        raise fogbugz.FogBugzAPIError('No person in the response.')
+    return FogBugzPerson.from_fields(fields)
+
+def iter_people(stream):
+    """
+    Incrementally parse a ``listPeople`` response stream, yielding the
+    :func:`person_from_element` details for each person. The stream is
+    closed when done.
+    """
+    try:
+        for event, elem in ElementTree.iterparse(stream):
+            tag = elem.tag.lower()
+            if tag == 'person':
+                yield person_from_element(elem)
+                elem.clear()
+            elif tag == 'error':
+                raise fogbugz.FogBugzAPIError('Error Code %s: %s' % (
+                    elem.get('code'), elem.text))
+    finally:
+        stream.close()
+
+def get_client(token):
+    """
+    Return a :class:`FogBugzClient` for AUTH_FOGBUGZ_SERVER using the
+    stored ``token``. Up to ``AUTH_FOGBUGZ_CLIENT_CACHE_SIZE`` clients are
+    kept, least recently used first out, and shared between threads. A
+    client is dropped when its token is logged off (see
+    :func:`forget_client`).
+    """
+    global _clients
+    fbcfg = get_settings()
+    if not fbcfg.CLIENT_CACHE_SIZE:
+        return FogBugzClient(fbcfg.SERVER, token)
+    clients = _clients
+    if clients is None:
+        with _clients_lock:
+            clients = _clients
+            if clients is None:
+                clients = _clients = LRUCache(fbcfg.CLIENT_CACHE_SIZE)
+    client = clients.get(token)
+    if client is None:
+        ## two threads may both build one, the last one stored wins.
+        client = FogBugzClient(fbcfg.SERVER, token)
+        clients.set(token, client)
+    return client
+
+def forget_client(token):
+    """
+    Drop the cached :func:`get_client` client for ``token``, if any.
+    """
+    clients = _clients
+    if clients is not None and token:
+        clients.delete(token)
+
+@receiver(setting_changed)
+def _setting_changed(sender, setting=None, **kwargs):
+    global _clients
+    if setting and setting.startswith(SETTINGS_PREFIX):
+        clear_discovery_cache()
+        with _clients_lock:
+            _clients = None
+
+def _fetch_api_url(url):
+    try:
+        api = ElementTree.parse(get_opener(url).open(url + 'api.xml'))
+        api_url = api.findtext('url')
+    except Exception as e:
+        raise fogbugz.FogBugzConnectionError(
+            "Library could not connect to the FogBugz API.  Either this "
+            "installation of FogBugz does not support the API, or the "
+            "url, %s, is incorrect.\n\nError: %s" % (url, e))
+    if not api_url:
+        raise fogbugz.FogBugzConnectionError(
+            "FogBugz server (%s) api.xml has no API url." % url)
+    return url + api_url
+
+
+class FogBugzClient(fogbugz.FogBugz):
+    """
+    Drop in replacement for ``fogbugz.FogBugz`` which sends every request
+    over the pooled keep-alive connections shared by all clients for the
+    same server, and reuses the cached ``api.xml`` discovery result
+    (see :func:`discover`).
+    """
+    def __init__(self, url, token=None):
+        ## fogbugz.FogBugz.__init__ hard codes a fresh urllib opener and
+        ## api.xml request, so we do the same setup here with the pooled
+        ## opener and the discovery cache.
+        self._FogBugz__handlerCache = {}
+        if not url.endswith('/'):
+            url += '/'
+
+        self._token = None
+        if token:
+            self.token(token)
+
+        self._opener = get_opener(url)
+        self._url = discover(url)
+        self.currentFilter = None
+
+    def request(self, cmd, **kwargs):
+        """
+        Make an API call, returning the fully read, unparsed response.
+        """
+        return self._send(cmd, kwargs, False)
+
+    def stream(self, cmd, **kwargs):
+        """
+        Make an API call, returning the unparsed response stream (see
+        :class:`.transport.PooledStream`). The caller must close it.
+        """
+        return self._send(cmd, kwargs, True)
+
+    def _send(self, cmd, kwargs, stream):
+        kwargs['cmd'] = cmd
+        if self._token:
+            kwargs['token'] = self._token
+        body = urlencode(kwargs).encode('utf-8')
+        request = Request(self._url, body, {
+            'Content-Type': 'application/x-www-form-urlencoded'})
+        try:
+            return self._opener.open(request, stream=stream)
+        except URLError as e:
+            raise fogbugz.FogBugzConnectionError(e)
+
+    def logon(self, username, password):
+        """
+        Log the user on to FogBugz. Unlike FogBugzPy, connection failures
+        are raised as ``fogbugz.FogBugzConnectionError`` rather than
+        ``fogbugz.FogBugzLogonError``.
+        """
+        if self._token:
+            self.logoff()
+        try:
+            fields = parse_fields(self.request('logon', email=username,
+                                               password=password),
+                                  ('token',), 'token')
+        except fogbugz.FogBugzConnectionError:
+            raise
+        except fogbugz.FogBugzAPIError as e:
+            raise fogbugz.FogBugzLogonError(e)
+        except ElementTree.ParseError as e:
+            raise fogbugz.FogBugzLogonError(e)
+        if not fields.get('token'):
+            raise fogbugz.FogBugzLogonError('No token in the response.')
+        self._token = fields['token']
+
+    def logoff(self):
+        """
+        Log off the current user, dropping any :func:`get_client` client
+        and :mod:`.tokens` user cached for the token.
+        """
+        from .tokens import forget
+        forget_client(self._token)
+        forget(self._token)
+        parse_fields(self.request('logoff'), (), 'response')
+        self._token = None
+
+    def view_person(self, **kwargs):
+        """
+        Return the :class:`FogBugzPerson` for the logged on user, or the
+        one selected by ``kwargs`` (e.g. ``ixPerson=3``). Only the person
+        details are pulled out of the response.
+        """
+        try:
+            return parse_person(self.request('viewPerson', **kwargs))
+        except ElementTree.ParseError as e:
+            raise fogbugz.FogBugzAPIError(e)
+
+    def iter_people(self, **kwargs):
+        """
+        Stream ``listPeople``, yielding the details of each person without
+        building the whole response in memory. ``kwargs`` are passed on,
+        e.g. ``fIncludeCommunity=1``.
+        """
+        return iter_people(self.stream('listPeople', **kwargs))
@@ -0,0 +1,189 @@
+# Copyright (c) 2012, Douglas Napoleone.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+#     3. Neither the name of Django nor the names of its contributors may be
+#        used to endorse or promote products derived from this software without
+#        specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from django.core.exceptions import ValidationError
+from django.core.validators import URLValidator
+from django.dispatch import receiver
+
+from django.core.signals import setting_changed
+
+import threading
+
+SETTINGS_PREFIX = 'AUTH_FOGBUGZ_'
+
+def _choice_validator(name, choices):
+    def validate(value):
+        if value not in choices:
+            raise ValidationError("%s%s must be one of: %s." % (
+                SETTINGS_PREFIX, name, ', '.join(repr(c) for c in choices)))
+    return validate
+
+## FogBugz roles ROLE_PERMISSIONS can grant permissions to.
+ROLES = ('administrator', 'normal', 'community')
+
+def _role_permissions_validator(value):
+    if value is None:
+        return
+    if not isinstance(value, dict) or not set(value) <= set(ROLES):
+        raise ValidationError("%sROLE_PERMISSIONS must be a dict keyed by "
+                              "%s." % (SETTINGS_PREFIX, ', '.join(ROLES)))
+    for perms in value.values():
+        if isinstance(perms, str) or any(
+                len(perm.split('.')) != 2 for perm in perms):
+            raise ValidationError("%sROLE_PERMISSIONS values must be lists "
+                                  "of 'app_label.codename' permissions." %
+                                  SETTINGS_PREFIX)
+
+class FogBugzSettings(object):
+    """
+    Django setting wrapper, ensuring all values exist with defaults.
+
+    Instances are read-only snapshots. Use :func:`get_settings` to get the
+    shared, already validated, instance instead of building a new one.
+    """
+    _server_validator = URLValidator(message=
+        "AUTH_FOGBUGZ_SERVER must be set to a valid fogbugz api url.")
+
+    _credential_cache_validator = _choice_validator(
+        'CREDENTIAL_CACHE', ('locmem', 'django'))
+
+    _limit_scope_validator = _choice_validator(
+        'LOGON_LIMIT_SCOPE', ('process', 'global'))
+
+    defaults = dict(
+    #   SETTING_NAME                =     ('Default Value', Validator),
+        SERVER                      =     (None,            _server_validator),
+        ENABLE_PROFILE              =     (False,           None),
+        ENABLE_PROFILE_TOKEN        =     (False,           None),
+        ALLOW_COMMUNITY             =     (False,           None),
+        AUTO_CREATE_USERS           =     (False,           None),
+        SERVER_USES_LDAP            =     (False,           None),
+        MAP_ADMIN_AS_SUPER          =     (False,           None),
+        MAP_ADMIN_AS_STAFF          =     (False,           None),
+        POOL_SIZE                   =     (4,               None),
+        POOL_IDLE_TIMEOUT           =     (30,              None),
+        CACHE_ALIAS                 =     ('default',       None),
+        DISCOVERY_CACHE_TTL         =     (3600,            None),
+        CREDENTIAL_CACHE_TTL        =     (0,               None),
+        CREDENTIAL_CACHE            =     ('locmem',        _credential_cache_validator),
+        CREDENTIAL_CACHE_SIZE       =     (1000,            None),
+        COALESCE_LOGINS             =     (False,           None),
+        COALESCE_LEASE_TIMEOUT      =     (0,               None),
+        DEFER_LOGOFF                =     (False,           None),
+        LOGOFF_WORKERS              =     (2,               None),
+        LOGOFF_QUEUE_SIZE           =     (1000,            None),
+        LOGOFF_RETRIES              =     (2,               None),
+        LOGOFF_DRAIN_TIMEOUT        =     (5,               None),
+        REUSE_PROFILE_TOKEN         =     (False,           None),
+        TOKEN_LIFETIME              =     (14 * 24 * 3600,  None),
+        SYNC_TOKEN                  =     ('',              None),
+        TIMEOUT                     =     (None,            None),
+        BREAKER_THRESHOLD           =     (0,               None),
+        BREAKER_MIN_CALLS           =     (10,              None),
+        BREAKER_WINDOW              =     (60,              None),
+        BREAKER_OPEN_TIME           =     (30,              None),
+        OFFLINE_LOGIN_TTL           =     (0,               None),
+        LOGON_CONCURRENCY           =     (0,               None),
+        LOGON_QUEUE_SIZE            =     (100,             None),
+        LOGON_QUEUE_TIMEOUT         =     (10,              None),
+        LOGON_LIMIT_SCOPE           =     ('process',       _limit_scope_validator),
+        METRICS_SINK                =     (None,            None),
+        CLIENT_CACHE_SIZE           =     (100,             None),
+        ROLE_PERMISSIONS            =     (None,            _role_permissions_validator),
+        PERMISSION_CACHE_TTL        =     (3600,            None),
+        FAILED_LOGON_CACHE_TTL      =     (0,               None),
+        THROTTLE_LIMIT              =     (0,               None),
+        THROTTLE_WINDOW             =     (300,             None),
+        NOTIFY_SECRET               =     (None,            None),
+        NOTIFY_DELAY                =     (2,               None),
+        TOKEN_HEADER                =     ('HTTP_X_FOGBUGZ_TOKEN', None),
+        TOKEN_CACHE_SIZE            =     (1000,            None),
+        TOKEN_CACHE_TTL             =     (300,             None),
+        PERSON_CACHE_TTL            =     (300,             None),
+    )
+
+    def __init__(self, prefix=SETTINGS_PREFIX):
+        """
+        Loads our settings from django.conf.settings, applying defaults,
+        and raising an exception if a validator is supplied and fails.
+        """
+        from django.conf import settings
+
+        for name, (default, test) in self.defaults.items():
+            value = getattr(settings, prefix + name, default)
+
+            if callable(test):
+                test(value)
+
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("FogBugzSettings is read-only, change the "
+                             "%s%s setting instead." % (SETTINGS_PREFIX, name))
+
+    def __delattr__(self, name):
+        raise AttributeError("FogBugzSettings is read-only.")
+
+_settings = None
+_settings_lock = threading.Lock()
+
+def get_settings():
+    """
+    Return the process wide :class:`FogBugzSettings` snapshot, building
+    (and validating) it on first use.
+    """
+    fbcfg = _settings
+    if fbcfg is None:
+        fbcfg = load_settings()
+    return fbcfg
+
+def load_settings():
+    """
+    (Re)build the process wide :class:`FogBugzSettings` snapshot from
+    django.conf.settings. Validation errors are raised to the caller.
+    """
+    global _settings
+    with _settings_lock:
+        fbcfg = FogBugzSettings()
+        _settings = fbcfg
+    return fbcfg
+
+def clear_settings():
+    """
+    Drop the cached snapshot, it will be rebuilt on the next
+    :func:`get_settings` call.
+    """
+    global _settings
+    with _settings_lock:
+        _settings = None
+
+@receiver(setting_changed)
+def _setting_changed(sender, setting=None, **kwargs):
+    if setting and setting.startswith(SETTINGS_PREFIX):
+        clear_settings()
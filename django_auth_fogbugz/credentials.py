@@ -0,0 +1,98 @@
+# Copyright (c) 2012, Douglas Napoleone.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+#     3. Neither the name of Django nor the names of its contributors may be
+#        used to endorse or promote products derived from this software without
+#        specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Cache of recently verified FogBugz credentials.
+
+Only a salted, slow hashed verifier of the password is stored (using the
+project's ``PASSWORD_HASHERS``), together with the FogBugz person details
+resolved when the password was verified with the FogBugz server.
+"""
+
+from django.contrib.auth.hashers import check_password, make_password
+from django.dispatch import receiver
+
+import threading
+
+from .cache import LRUCache, get_cache, make_key
+from .conf import SETTINGS_PREFIX, get_settings, setting_changed
+
+_local_cache = None
+_local_cache_lock = threading.Lock()
+
+def get_store():
+    """
+    Return the cache holding the verifiers, either the in process LRU
+    or the Django cache, depending on AUTH_FOGBUGZ_CREDENTIAL_CACHE.
+    """
+    global _local_cache
+    fbcfg = get_settings()
+    if fbcfg.CREDENTIAL_CACHE == 'django':
+        return get_cache()
+    store = _local_cache
+    if store is None:
+        with _local_cache_lock:
+            store = _local_cache
+            if store is None:
+                store = _local_cache = LRUCache(fbcfg.CREDENTIAL_CACHE_SIZE)
+    return store
+
+def lookup(username, password):
+    """
+    Return the cached person details if ``password`` matches the
+    verifier cached for ``username``, otherwise ``None``. A verifier
+    that does not match is dropped, as the password may have changed.
+    """
+    store = get_store()
+    key = make_key('credential', username)
+    entry = store.get(key)
+    if entry is None:
+        return None
+    if check_password(password, entry['verifier']):
+        return entry['person']
+    store.delete(key)
+    return None
+
+def remember(username, password, person):
+    """
+    Cache a verifier for a password the FogBugz server just accepted.
+    """
+    entry = dict(verifier=make_password(password), person=person)
+    get_store().set(make_key('credential', username), entry,
+                    get_settings().CREDENTIAL_CACHE_TTL)
+
+def forget(username):
+    get_store().delete(make_key('credential', username))
+
+@receiver(setting_changed)
+def _setting_changed(sender, setting=None, **kwargs):
+    global _local_cache
+    if setting and setting.startswith(SETTINGS_PREFIX):
+        with _local_cache_lock:
+            _local_cache = None
@@ -36,6 +36,44 @@ AUTH_FOGBUGZ_SERVER = "https://my_account.fogbugz.com/"
 #AUTH_FOGBUGZ_MAP_ADMIN_AS_SUPER = True
 #AUTH_FOGBUGZ_MAP_ADMIN_AS_STAFF = True
 
+# Requests to the FogBugz server share persistent (keep-alive) connections.
+# These control the number of idle connections kept open per server, and
+# the number of seconds an idle connection is kept before it is closed.
+#
+#AUTH_FOGBUGZ_POOL_SIZE = 4
+#AUTH_FOGBUGZ_POOL_IDLE_TIMEOUT = 30
+
+# The FogBugz api.xml discovery result is cached for this many seconds in the
+# Django cache named by AUTH_FOGBUGZ_CACHE_ALIAS. Set to 0 to disable.
+#
+#AUTH_FOGBUGZ_CACHE_ALIAS = 'default'
+#AUTH_FOGBUGZ_DISCOVERY_CACHE_TTL = 3600
+
+# Remember (a salted, slow hashed verifier of) passwords accepted by the
+# FogBugz server for this many seconds, so repeat logins do not contact the
+# server. Verifiers are kept in a per process LRU cache ('locmem') or the
+# AUTH_FOGBUGZ_CACHE_ALIAS cache ('django'). Not used with profile tokens.
+#
+#AUTH_FOGBUGZ_CREDENTIAL_CACHE_TTL = 300
+#AUTH_FOGBUGZ_CREDENTIAL_CACHE = 'locmem'
+#AUTH_FOGBUGZ_CREDENTIAL_CACHE_SIZE = 1000
+
+# Coalesce concurrent logins for the same user, so only one of them talks to
+# the FogBugz server. Set a lease timeout (seconds) to also coalesce across
+# processes, using the AUTH_FOGBUGZ_CACHE_ALIAS cache.
+#
+#AUTH_FOGBUGZ_COALESCE_LOGINS = True
+#AUTH_FOGBUGZ_COALESCE_LEASE_TIMEOUT = 10
+
+# Run the FogBugz logoff calls which do not affect the login result in
+# background worker threads, instead of making the user wait on them.
+#
+#AUTH_FOGBUGZ_DEFER_LOGOFF = True
+#AUTH_FOGBUGZ_LOGOFF_WORKERS = 2
+#AUTH_FOGBUGZ_LOGOFF_QUEUE_SIZE = 1000
+#AUTH_FOGBUGZ_LOGOFF_RETRIES = 2
+#AUTH_FOGBUGZ_LOGOFF_DRAIN_TIMEOUT = 5
+
 # There is an extension profile model which is included with this auth backend
 # to help with integrating with the FogBugz API::
 #
@@ -90,7 +128,91 @@ AUTH_FOGBUGZ_SERVER = "https://my_account.fogbugz.com/"
 # when enabling this.
 #
 #AUTH_FOGBUGZ_ENABLE_PROFILE_TOKEN = True
+
+# Keep a stored profile token which is still valid, instead of logging it
+# off and storing a new one with every login. Tokens are assumed to expire
+# AUTH_FOGBUGZ_TOKEN_LIFETIME seconds after they are issued.
+#
+#AUTH_FOGBUGZ_REUSE_PROFILE_TOKEN = True
+#AUTH_FOGBUGZ_TOKEN_LIFETIME = 14 * 24 * 3600
     
+# FogBugz API token (for an administrator) used by the fogbugz_sync_users
+# management command to read the FogBugz people list.
+#
+#AUTH_FOGBUGZ_SYNC_TOKEN = ''
+
+# Per request timeout in seconds for FogBugz calls, and a circuit breaker
+# which stops calling a failing FogBugz server for a while, so logins fail
+# fast and later backends can still log in local accounts.
+#
+#AUTH_FOGBUGZ_TIMEOUT = 5
+#AUTH_FOGBUGZ_BREAKER_THRESHOLD = 0.5
+#AUTH_FOGBUGZ_BREAKER_MIN_CALLS = 10
+#AUTH_FOGBUGZ_BREAKER_WINDOW = 60
+#AUTH_FOGBUGZ_BREAKER_OPEN_TIME = 30
+
+# Let users log in while FogBugz is unreachable, by checking a password
+# hash stored with their profile at their last FogBugz login. The hash is
+# accepted for this many seconds. Requires AUTH_FOGBUGZ_ENABLE_PROFILE.
+#
+#AUTH_FOGBUGZ_OFFLINE_LOGIN_TTL = 7 * 24 * 3600
+
+# Limit the number of FogBugz logons in flight at once, queueing the rest.
+# Use the 'global' scope to share the limit between processes through the
+# AUTH_FOGBUGZ_CACHE_ALIAS cache.
+#
+#AUTH_FOGBUGZ_LOGON_CONCURRENCY = 10
+#AUTH_FOGBUGZ_LOGON_QUEUE_SIZE = 100
+#AUTH_FOGBUGZ_LOGON_QUEUE_TIMEOUT = 10
+#AUTH_FOGBUGZ_LOGON_LIMIT_SCOPE = 'process'
+
+# Callable (or dotted path to one) called as sink(name, duration, labels)
+# with the time taken by each phase of a login, and by the whole login with
+# its outcome, for statsd, Prometheus and the like.
+#
+#AUTH_FOGBUGZ_METRICS_SINK = 'myproject.metrics.fogbugz_sink'
+
+# Number of FogBugz API clients FogBugzProfile.get_client() keeps ready,
+# shared between threads and keyed by token.
+#
+#AUTH_FOGBUGZ_CLIENT_CACHE_SIZE = 100
+
+# Django permissions granted by FogBugz role ('administrator', 'normal' or
+# 'community'), stored in the profile at login and cached for permission
+# checks.
+#
+#AUTH_FOGBUGZ_ROLE_PERMISSIONS = {
+#    'administrator': ['reports.view_report', 'reports.change_report'],
+#    'normal': ['reports.view_report'],
+#}
+#AUTH_FOGBUGZ_PERMISSION_CACHE_TTL = 3600
+
+# Turn away repeats of logins FogBugz just rejected, and throttle the
+# rejected logins per username and per client address, without contacting
+# FogBugz.
+#
+#AUTH_FOGBUGZ_FAILED_LOGON_CACHE_TTL = 60
+#AUTH_FOGBUGZ_THROTTLE_LIMIT = 10
+#AUTH_FOGBUGZ_THROTTLE_WINDOW = 300
+
+# Secret signing person change notifications sent to the
+# django_auth_fogbugz.urls endpoint (requires AUTH_FOGBUGZ_SYNC_TOKEN). The
+# people are refreshed together after the delay.
+#
+#AUTH_FOGBUGZ_NOTIFY_SECRET = 'change me'
+#AUTH_FOGBUGZ_NOTIFY_DELAY = 2
+
+# Header FogBugzTokenMiddleware reads FogBugz API tokens from, and the cache
+# of the users they belong to.
+#
+#AUTH_FOGBUGZ_TOKEN_HEADER = 'HTTP_X_FOGBUGZ_TOKEN'
+#AUTH_FOGBUGZ_TOKEN_CACHE_SIZE = 1000
+#AUTH_FOGBUGZ_TOKEN_CACHE_TTL = 300
+
+# How long FogBugzPersonMiddleware caches a person not kept in the session.
+#
+#AUTH_FOGBUGZ_PERSON_CACHE_TTL = 300
+
 # Keep ModelBackend around for per-user permissions and maybe a local
 # superuser.
 #AUTHENTICATION_BACKENDS = (
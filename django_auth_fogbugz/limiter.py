@@ -0,0 +1,246 @@
+# Copyright (c) 2012, Douglas Napoleone.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+#     3. Neither the name of Django nor the names of its contributors may be
+#        used to endorse or promote products derived from this software without
+#        specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Limit on the number of FogBugz logon exchanges in flight at once.
+
+Logins beyond the limit wait in a bounded queue, for at most
+``AUTH_FOGBUGZ_LOGON_QUEUE_TIMEOUT`` seconds, and are turned away when the
+queue is full. :class:`ConcurrencyLimiter` limits a single process,
+:class:`GlobalConcurrencyLimiter` shares the limit between every process
+using the Django cache.
+"""
+
+from django.dispatch import receiver
+
+import random
+import threading
+import time
+import uuid
+
+from .cache import get_cache, make_key
+from .conf import SETTINGS_PREFIX, get_settings, setting_changed
+
+
+class ConcurrencyLimiter(object):
+    """
+    Thread safe limit of ``limit`` concurrent holders, with a queue of at
+    most ``queue_size`` waiters.
+
+    :meth:`acquire` returns a permit, or ``None`` if the queue was full or
+    the wait timed out. Pass the permit back to :meth:`release`.
+    """
+    ## seconds between tries, for waiters which have to poll.
+    poll_interval = 0.05
+
+    def __init__(self, limit, queue_size=100, timeout=10):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.in_flight = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.acquired = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.waited = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self._cond = threading.Condition()
+
+    def try_acquire(self):
+        """
+        Return a permit if one is free right now, otherwise ``None``.
+        """
+        with self._cond:
+            if self.in_flight < self.limit:
+                self.in_flight += 1
+                self.acquired += 1
+                return True
+        return None
+
+    def release(self, permit):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    def acquire(self):
+        permit = self.try_acquire()
+        if permit or not self.enqueue():
+            return permit
+        start = time.time()
+        try:
+            permit = self._wait(start + self.timeout)
+        finally:
+            self.dequeue(start, permit)
+        return permit
+
+    def _wait(self, deadline):
+        with self._cond:
+            while self.in_flight >= self.limit:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            self.in_flight += 1
+            self.acquired += 1
+            return True
+
+    def enqueue(self):
+        """
+        Join the wait queue, returns ``False`` if it is full.
+        """
+        with self._cond:
+            if self.queued >= self.queue_size:
+                self.rejected += 1
+                return False
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+            return True
+
+    def dequeue(self, start, permit):
+        """
+        Leave the wait queue joined at ``start``, with the permit the wait
+        ended with.
+        """
+        waited = time.time() - start
+        with self._cond:
+            self.queued -= 1
+            if permit:
+                self.waited += 1
+                self.wait_time += waited
+                self.max_wait_time = max(self.max_wait_time, waited)
+            else:
+                self.timed_out += 1
+
+    def stats(self):
+        """
+        Current queue depth and counters, for monitoring.
+        """
+        with self._cond:
+            return dict(
+                limit = self.limit,
+                in_flight = self.in_flight,
+                queued = self.queued,
+                max_queued = self.max_queued,
+                acquired = self.acquired,
+                rejected = self.rejected,
+                timed_out = self.timed_out,
+                waited = self.waited,
+                wait_time = self.wait_time,
+                max_wait_time = self.max_wait_time,
+                mean_wait_time = (self.wait_time / self.waited
+                                  if self.waited else 0.0),
+            )
+
+
+class GlobalConcurrencyLimiter(ConcurrencyLimiter):
+    """
+    :class:`ConcurrencyLimiter` shared by every process using the same
+    cache. Each permit is one of ``limit`` cache keys, claimed with an
+    atomic ``cache.add()``. Slots expire after ``slot_timeout`` seconds, so
+    a process which dies holding one does not shrink the limit for good.
+
+    The queue is per process, waiters poll for a free slot.
+    """
+    slot_timeout = 300
+
+    def __init__(self, limit, queue_size=100, timeout=10, name=''):
+        ConcurrencyLimiter.__init__(self, limit, queue_size, timeout)
+        self.slots = [make_key('logon-slot', name, str(i))
+                      for i in range(limit)]
+
+    def try_acquire(self):
+        cache = get_cache()
+        owner = uuid.uuid4().hex
+        ## start at a random slot, so processes do not all pile onto the
+        ## first ones.
+        first = random.randrange(self.limit)
+        for key in self.slots[first:] + self.slots[:first]:
+            if cache.add(key, owner, self.slot_timeout):
+                with self._cond:
+                    self.in_flight += 1
+                    self.acquired += 1
+                return (key, owner)
+        return None
+
+    def release(self, permit):
+        key, owner = permit
+        cache = get_cache()
+        if cache.get(key) == owner:
+            cache.delete(key)
+        with self._cond:
+            self.in_flight -= 1
+
+    def _wait(self, deadline):
+        while True:
+            time.sleep(min(self.poll_interval,
+                           max(deadline - time.time(), 0)))
+            permit = self.try_acquire()
+            if permit or time.time() >= deadline:
+                return permit
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+def get_limiter():
+    """
+    Return the shared limiter for FogBugz logons, or ``None`` when
+    ``AUTH_FOGBUGZ_LOGON_CONCURRENCY`` is not set.
+    """
+    global _limiter
+    limiter = _limiter
+    if limiter is None:
+        fbcfg = get_settings()
+        if not fbcfg.LOGON_CONCURRENCY:
+            return None
+        with _limiter_lock:
+            limiter = _limiter
+            if limiter is None:
+                if fbcfg.LOGON_LIMIT_SCOPE == 'global':
+                    limiter = GlobalConcurrencyLimiter(
+                        fbcfg.LOGON_CONCURRENCY, fbcfg.LOGON_QUEUE_SIZE,
+                        fbcfg.LOGON_QUEUE_TIMEOUT, name=fbcfg.SERVER)
+                else:
+                    limiter = ConcurrencyLimiter(
+                        fbcfg.LOGON_CONCURRENCY, fbcfg.LOGON_QUEUE_SIZE,
+                        fbcfg.LOGON_QUEUE_TIMEOUT)
+                _limiter = limiter
+    return limiter
+
+def reset_limiter():
+    global _limiter
+    with _limiter_lock:
+        _limiter = None
+
+@receiver(setting_changed)
+def _setting_changed(sender, setting=None, **kwargs):
+    if setting and setting.startswith(SETTINGS_PREFIX):
+        reset_limiter()
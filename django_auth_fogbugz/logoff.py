@@ -0,0 +1,165 @@
+# Copyright (c) 2012, Douglas Napoleone.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+#     3. Neither the name of Django nor the names of its contributors may be
+#        used to endorse or promote products derived from this software without
+#        specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Background FogBugz logoff, so clearing tokens does not hold up logins.
+
+Tokens are queued to a bounded queue served by a small pool of daemon
+worker threads. Failed logoffs are retried with a back off, and the queue is
+drained (for a bounded time) when the process exits.
+"""
+
+import atexit
+import logging
+import queue
+import threading
+import time
+
+import fogbugz
+
+from .conf import get_settings
+
+logger = logging.getLogger('django_auth_fogbugz')
+
+_STOP = object()
+
+
+class LogoffQueue(object):
+    """
+    Bounded queue of ``(server, token, username)`` to logoff, and the
+    worker threads doing it.
+    """
+    retry_delay = 0.5
+
+    def __init__(self, workers=2, maxsize=1000, retries=2):
+        self.retries = retries
+        self._queue = queue.Queue(maxsize)
+        self._threads = []
+        for n in range(workers):
+            thread = threading.Thread(target=self._run,
+                                      name='fogbugz-logoff-%d' % n)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, server, token, username):
+        """
+        Queue a logoff, returns ``False`` if the queue is full.
+        """
+        try:
+            self._queue.put_nowait((server, token, username))
+        except queue.Full:
+            return False
+        return True
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def drain(self, timeout):
+        """
+        Stop the workers once the queued logoffs are done, waiting at most
+        ``timeout`` seconds in total.
+        """
+        deadline = time.time() + timeout
+        for thread in self._threads:
+            try:
+                self._queue.put(_STOP, timeout=max(0, deadline - time.time()))
+            except queue.Full:
+                break
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.time()))
+        if self.pending():
+            logger.warning("Exiting with %d FogBugz token logoffs still "
+                           "queued.", self.pending())
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            self._logoff(*item)
+
+    def _logoff(self, server, token, username):
+        from .client import FogBugzClient
+        for attempt in range(self.retries + 1):
+            try:
+                FogBugzClient(server, token).logoff()
+                logger.debug("Cleared token for user (%s) on server (%s).",
+                             username, server)
+                return
+            except fogbugz.FogBugzConnectionError as e:
+                error = e
+            except Exception as e:
+                ## an API error means the token is not valid anymore,
+                ## there is nothing left to clear.
+                logger.debug("Token for user (%s) on server (%s) was not "
+                             "logged off: %s", username, server, str(e))
+                return
+            if attempt < self.retries:
+                time.sleep(self.retry_delay * 2 ** attempt)
+        logger.warning("Failed to logoff user (%s) from server (%s) after "
+                       "%d attempts: %s", username, server,
+                       self.retries + 1, str(error))
+
+_logoff_queue = None
+_logoff_queue_lock = threading.Lock()
+
+def defer_logoff(server, token, username):
+    """
+    Queue a logoff of ``token`` to run in the background. Returns
+    ``False`` if it could not be queued, and should be done inline.
+    """
+    global _logoff_queue
+    from .client import forget_client
+    from .tokens import forget
+    if not token:
+        return True
+    forget_client(token)
+    forget(token)
+    if _logoff_queue is None:
+        with _logoff_queue_lock:
+            if _logoff_queue is None:
+                fbcfg = get_settings()
+                _logoff_queue = LogoffQueue(fbcfg.LOGOFF_WORKERS,
+                                            fbcfg.LOGOFF_QUEUE_SIZE,
+                                            fbcfg.LOGOFF_RETRIES)
+                atexit.register(drain)
+    return _logoff_queue.submit(server, token, username)
+
+def drain(timeout=None):
+    """
+    Finish the queued logoffs and stop the workers. Called at exit.
+    """
+    global _logoff_queue
+    with _logoff_queue_lock:
+        logoff_queue, _logoff_queue = _logoff_queue, None
+    if logoff_queue is not None:
+        if timeout is None:
+            timeout = get_settings().LOGOFF_DRAIN_TIMEOUT
+        logoff_queue.drain(timeout)
@@ -0,0 +1,151 @@
+# Copyright (c) 2012, Douglas Napoleone.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+#     3. Neither the name of Django nor the names of its contributors may be
+#        used to endorse or promote products derived from this software without
+#        specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import (override_settings, setup_databases,
+                               teardown_databases)
+
+import ast
+
+from ...benchmark import run_logins
+from ...conf import SETTINGS_PREFIX
+from ...mockserver import MockFogBugzServer, Person
+
+## (name, settings) runs, without --combo.
+DEFAULT_COMBOS = (
+    ('baseline', {}),
+    ('profile', dict(ENABLE_PROFILE=True)),
+    ('profile-token-reuse', dict(ENABLE_PROFILE=True,
+                                 ENABLE_PROFILE_TOKEN=True,
+                                 REUSE_PROFILE_TOKEN=True)),
+    ('credential-cache', dict(CREDENTIAL_CACHE_TTL=300)),
+    ('coalesce', dict(COALESCE_LOGINS=True)),
+    ('defer-logoff', dict(DEFER_LOGOFF=True)),
+)
+
+def parse_combo(combo):
+    """
+    Parse ``'ENABLE_PROFILE=True,POOL_SIZE=8'`` into a settings dict. The
+    ``AUTH_FOGBUGZ_`` prefix is optional, values are Python literals or
+    plain strings.
+    """
+    settings = {}
+    for item in combo.split(','):
+        if not item.strip():
+            continue
+        name, sep, value = item.partition('=')
+        if not sep:
+            raise CommandError("Bad --combo setting %r, expected "
+                               "NAME=VALUE." % item)
+        name = name.strip().upper()
+        if name.startswith(SETTINGS_PREFIX):
+            name = name[len(SETTINGS_PREFIX):]
+        try:
+            settings[name] = ast.literal_eval(value.strip())
+        except (ValueError, SyntaxError):
+            settings[name] = value.strip()
+    return settings
+
+
+class Command(BaseCommand):
+    help = ("Benchmark FogBugzBackend logins against a local mock FogBugz "
+            "server, for several settings combinations. Runs in a "
+            "throw-away test database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--users', type=int, default=50,
+            help="Number of FogBugz people logging in.")
+        parser.add_argument(
+            '--logins', type=int, default=500,
+            help="Number of timed logins per combination.")
+        parser.add_argument(
+            '--threads', type=int, default=4,
+            help="Concurrent logins per process.")
+        parser.add_argument(
+            '--processes', type=int, default=1,
+            help="Number of forked processes logging in.")
+        parser.add_argument(
+            '--latency', type=float, default=0.0,
+            help="Seconds of latency the mock server adds to each request.")
+        parser.add_argument(
+            '--error-rate', type=float, default=0.0,
+            help="Share (0 to 1) of mock server requests failing with "
+                 "HTTP 500.")
+        parser.add_argument(
+            '--combo', action='append', default=[],
+            help="Settings to benchmark, as NAME=VALUE,NAME=VALUE. May be "
+                 "repeated. Defaults to a set of common combinations.")
+        parser.add_argument(
+            '--no-warmup', dest='warmup', action='store_false',
+            default=True,
+            help="Do not log every user in once before timing.")
+        parser.add_argument(
+            '--keepdb', action='store_true', default=False,
+            help="Keep the test database between runs.")
+
+    def handle(self, *args, **options):
+        if options['users'] < 1 or options['logins'] < 1:
+            raise CommandError("--users and --logins must be at least 1.")
+        combos = [(combo, parse_combo(combo)) for combo in options['combo']]
+        combos = combos or DEFAULT_COMBOS
+
+        people = [Person(i, 'user%d@example.com' % i, 'password%d' % i,
+                         fullname='User %d' % i, admin=(i % 10 == 1))
+                  for i in range(1, options['users'] + 1)]
+        server = MockFogBugzServer(people, latency=options['latency'],
+                                   error_rate=options['error_rate'])
+
+        old_config = setup_databases(0, False, keepdb=options['keepdb'])
+        try:
+            with server:
+                self.stdout.write("%-32s %10s %9s %9s %9s %7s" % (
+                    'settings', 'logins/s', 'p50 ms', 'p99 ms',
+                    'queries', 'failed'))
+                for name, combo in combos:
+                    result = self.run_combo(server, people, combo, options)
+                    self.stdout.write(
+                        "%-32s %10.1f %9.2f %9.2f %9.2f %7d" % (
+                        name[:32], result.rate, result.p50 * 1000,
+                        result.p99 * 1000, result.queries_per_login,
+                        result.failed))
+        finally:
+            teardown_databases(old_config, 0, keepdb=options['keepdb'])
+
+    def run_combo(self, server, people, combo, options):
+        overrides = dict((SETTINGS_PREFIX + name, value)
+                         for name, value in combo.items())
+        overrides.setdefault(SETTINGS_PREFIX + 'SERVER', server.url)
+        overrides.setdefault(SETTINGS_PREFIX + 'AUTO_CREATE_USERS', True)
+        with override_settings(**overrides):
+            if options['warmup']:
+                run_logins(people, len(people))
+            return run_logins(people, options['logins'],
+                              threads=options['threads'],
+                              processes=options['processes'])
@@ -0,0 +1,61 @@
+# Copyright (c) 2012, Douglas Napoleone.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+#     3. Neither the name of Django nor the names of its contributors may be
+#        used to endorse or promote products derived from this software without
+#        specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from django.core.management.base import BaseCommand
+
+from ...conf import get_settings
+from ...revalidate import TokenRevalidator
+
+
+class Command(BaseCommand):
+    help = ("Check the FogBugz tokens stored in profiles, clearing dead "
+            "ones and refreshing the admin and community flags.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help="Number of profiles read and written at a time.")
+        parser.add_argument(
+            '--workers', type=int, default=4,
+            help="Number of tokens checked with FogBugz at once.")
+        parser.add_argument(
+            '--dry-run', action='store_true', default=False,
+            help="Report what would change without writing anything.")
+
+    def handle(self, *args, **options):
+        revalidator = TokenRevalidator(get_settings(),
+                                       batch_size=options['batch_size'],
+                                       workers=options['workers'],
+                                       dry_run=options['dry_run'])
+        stats = revalidator.run()
+        self.stdout.write("%s%d checked, %d valid, %d cleared, %d updated, "
+                          "%d could not be checked." % (
+                          "Dry run: " if options['dry_run'] else "",
+                          stats['checked'], stats['valid'], stats['cleared'],
+                          stats['updated'], stats['errors']))
@@ -0,0 +1,132 @@
+# Copyright (c) 2012, Douglas Napoleone.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+#     3. Neither the name of Django nor the names of its contributors may be
+#        used to endorse or promote products derived from this software without
+#        specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from django.core.management.base import BaseCommand, CommandError
+
+import getpass
+
+import fogbugz
+
+from ...client import FogBugzClient
+from ...conf import get_settings
+from ...models import FogBugzSyncRun
+from ...sync import PeopleSync
+
+
+class Command(BaseCommand):
+    help = ("Create or update Django users (and FogBugz profiles) for all "
+            "the people on the FogBugz server.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--token', default=None,
+            help="FogBugz API token to list people with. Defaults to the "
+                 "AUTH_FOGBUGZ_SYNC_TOKEN setting.")
+        parser.add_argument(
+            '--email', default=None,
+            help="Log on to FogBugz as this user instead of using a token. "
+                 "The password is prompted for.")
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help="Number of people written to the database at a time.")
+        parser.add_argument(
+            '--create', dest='create', action='store_true', default=None,
+            help="Create missing users (default: AUTH_FOGBUGZ_AUTO_CREATE_USERS).")
+        parser.add_argument(
+            '--no-create', dest='create', action='store_false',
+            help="Only update existing users.")
+        parser.add_argument(
+            '--full', action='store_true', default=False,
+            help="Check every person, not only those changed since the "
+                 "last sync.")
+        parser.add_argument(
+            '--dry-run', action='store_true', default=False,
+            help="Report what would change without writing anything.")
+
+    def handle(self, *args, **options):
+        fbcfg = get_settings()
+        fb = self.connect(fbcfg, options)
+
+        create = options['create']
+        if create is None:
+            create = fbcfg.AUTO_CREATE_USERS
+        if create and fbcfg.SERVER_USES_LDAP:
+            ## FogBugz does not tell us the LDAP username, which is what a
+            ## login would create the user with.
+            self.stderr.write("AUTH_FOGBUGZ_SERVER_USES_LDAP is set, only "
+                              "updating existing users.")
+            create = False
+
+        if options['verbosity'] > 1:
+            try:
+                last = FogBugzSyncRun.objects.latest()
+                self.stdout.write("Last sync finished %s." % last.finished)
+            except FogBugzSyncRun.DoesNotExist:
+                self.stdout.write("No previous sync.")
+
+        ## deleted and community people are listed too, so the users of
+        ## those no longer allowed in lose their access.
+        people = fb.iter_people(
+            fIncludeNormal=1,
+            fIncludeCommunity=1,
+            fIncludeDeleted=1,
+            fIncludeVirtual=0)
+        sync = PeopleSync(fbcfg, batch_size=options['batch_size'],
+                          create=create, dry_run=options['dry_run'],
+                          full=options['full'])
+        try:
+            stats = sync.run(people)
+        except fogbugz.FogBugzAPIError as e:
+            raise CommandError("Listing people on FogBugz server (%s) "
+                               "failed: %s" % (fbcfg.SERVER, e))
+        finally:
+            if options['email']:
+                fb.logoff()
+
+        self.stdout.write("%s%d created, %d updated, %d unchanged, "
+                          "%d skipped." % (
+                          "Dry run: " if options['dry_run'] else "",
+                          stats['created'], stats['updated'],
+                          stats['unchanged'], stats['skipped']))
+
+    def connect(self, fbcfg, options):
+        token = options['token'] or fbcfg.SYNC_TOKEN
+        try:
+            fb = FogBugzClient(fbcfg.SERVER, token)
+            if options['email']:
+                fb.logon(options['email'], getpass.getpass(
+                    "FogBugz password for %s: " % options['email']))
+        except fogbugz.FogBugzAPIError as e:
+            raise CommandError("Could not log on to FogBugz server (%s): %s"
+                               % (fbcfg.SERVER, e))
+        if not fb._token:
+            raise CommandError("A FogBugz token (--token or "
+                               "AUTH_FOGBUGZ_SYNC_TOKEN) or --email "
+                               "is required.")
+        return fb
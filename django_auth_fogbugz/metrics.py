@@ -0,0 +1,200 @@
+# Copyright (c) 2012, Douglas Napoleone.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+#     3. Neither the name of Django nor the names of its contributors may be
+#        used to endorse or promote products derived from this software without
+#        specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Timing of the phases of a login, reported through the :mod:`.signals` and
+the callable named by ``AUTH_FOGBUGZ_METRICS_SINK``.
+
+The sink is called as ``sink(name, duration, labels)``, where ``name`` is
+one of :data:`PHASES` or ``'login'`` for the whole login, ``duration`` is in
+seconds, and ``labels`` is a dict, ``{'outcome': ...}`` for ``'login'``.
+"""
+
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import logging
+import threading
+import time
+
+from .conf import SETTINGS_PREFIX, get_settings, setting_changed
+from .signals import login_timed, phase_timed
+
+logger = logging.getLogger('django_auth_fogbugz')
+
+PHASES = (
+    'lookup',       # finding the Django user
+    'connect',      # creating the FogBugz client, and the api.xml fetch
+    'clear_token',  # logging off the old profile token
+    'logon',
+    'view_person',
+    'save',         # writing the user and profile
+    'logoff',
+)
+
+SUCCESS = 'success'
+OFFLINE = 'offline'
+BAD_PASSWORD = 'bad_password'
+COMMUNITY_REJECTED = 'community_rejected'
+CONNECTION_ERROR = 'connection_error'
+CIRCUIT_OPEN = 'circuit_open'
+OVERLOADED = 'overloaded'
+THROTTLED = 'throttled'
+NO_USER = 'no_user'
+NOT_ALLOWED = 'not_allowed'
+FAILED = 'failed'
+ERROR = 'error'
+
+OUTCOMES = (SUCCESS, OFFLINE, BAD_PASSWORD, COMMUNITY_REJECTED,
+            CONNECTION_ERROR, CIRCUIT_OPEN, OVERLOADED, THROTTLED, NO_USER,
+            NOT_ALLOWED, FAILED, ERROR)
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+class _Login(object):
+    __slots__ = ('username', 'start', 'outcome')
+
+    def __init__(self, username):
+        self.username = username
+        self.start = _clock()
+        self.outcome = None
+
+## The login in progress. A context variable follows asyncio tasks as well
+## as threads, and into ``sync_to_async`` calls.
+_current = ContextVar('django_auth_fogbugz_login', default=None)
+
+
+def _get_login():
+    return _current.get()
+
+
+def _set_login(login):
+    _current.set(login)
+
+
+_sink = None
+_sink_loaded = False
+_sink_lock = threading.Lock()
+
+def get_sink():
+    """
+    Return the ``AUTH_FOGBUGZ_METRICS_SINK`` callable, or ``None``.
+    """
+    global _sink, _sink_loaded
+    if not _sink_loaded:
+        with _sink_lock:
+            sink = get_settings().METRICS_SINK
+            if sink and not callable(sink):
+                sink = import_string(sink)
+            _sink = sink or None
+            _sink_loaded = True
+    return _sink
+
+def _report(name, duration, labels):
+    sink = get_sink()
+    if sink is None:
+        return
+    try:
+        sink(name, duration, labels)
+    except Exception as e:
+        logger.warning("FogBugz metrics sink failed: %s", str(e))
+
+def start_login(username):
+    """
+    Start timing a login, returns the previous login to pass to
+    :func:`finish_login` (normally ``None``).
+    """
+    previous = _get_login()
+    _set_login(_Login(username))
+    return previous
+
+def finish_login(previous, user, error=False):
+    """
+    Report the login started by :func:`start_login`. Without an outcome
+    from :func:`set_outcome` it is a success if there is a ``user``.
+    """
+    login = _get_login()
+    _set_login(previous)
+    if login is None:
+        return
+    duration = _clock() - login.start
+    outcome = login.outcome
+    if error:
+        outcome = ERROR
+    elif user is not None:
+        if outcome in (CONNECTION_ERROR, CIRCUIT_OPEN):
+            outcome = OFFLINE
+        else:
+            outcome = SUCCESS
+    elif outcome is None:
+        outcome = FAILED
+    login_timed.send(sender=None, username=login.username, outcome=outcome,
+                     duration=duration)
+    _report('login', duration, {'outcome': outcome})
+
+def set_outcome(outcome):
+    """
+    Record why the login in progress failed.
+    """
+    login = _get_login()
+    if login is not None:
+        login.outcome = outcome
+
+def get_outcome():
+    """
+    The outcome recorded for the login in progress, or ``None``.
+    """
+    login = _get_login()
+    if login is not None:
+        return login.outcome
+    return None
+
+@contextmanager
+def timed(phase):
+    """
+    Time the ``with`` block as one of the login :data:`PHASES`.
+    """
+    start = _clock()
+    try:
+        yield
+    finally:
+        duration = _clock() - start
+        phase_timed.send(sender=None, phase=phase, duration=duration)
+        _report(phase, duration, {})
+
+@receiver(setting_changed)
+def _setting_changed(sender, setting=None, **kwargs):
+    global _sink_loaded
+    if setting and setting.startswith(SETTINGS_PREFIX):
+        with _sink_lock:
+            _sink_loaded = False
@@ -0,0 +1,79 @@
+# Copyright (c) 2012, Douglas Napoleone.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+#     3. Neither the name of Django nor the names of its contributors may be
+#        used to endorse or promote products derived from this software without
+#        specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Middleware for requests authenticated with FogBugz.
+"""
+
+from django.contrib import auth
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.functional import SimpleLazyObject
+
+from django.utils.deprecation import MiddlewareMixin
+
+from .conf import get_settings
+from .session import get_person
+
+
+class FogBugzTokenMiddleware(MiddlewareMixin):
+    """
+    Authenticate requests carrying a FogBugz API token in the
+    AUTH_FOGBUGZ_TOKEN_HEADER header (``X-FogBugz-Token`` by default) with
+    :class:`.backend.FogBugzTokenBackend`.
+
+    Like an HTTP API key, the token is checked on every request and nothing
+    is stored in the session. Must come after Django's
+    ``AuthenticationMiddleware``.
+    """
+    def process_request(self, request):
+        if not hasattr(request, 'user'):
+            raise ImproperlyConfigured(
+                "FogBugzTokenMiddleware requires "
+                "django.contrib.auth.middleware.AuthenticationMiddleware "
+                "to come before it in MIDDLEWARE.")
+        token = request.META.get(get_settings().TOKEN_HEADER)
+        if not token:
+            return
+        user = auth.authenticate(request, fogbugz_token=token.strip())
+        if user is not None:
+            request.user = user
+            request._cached_user = user
+
+
+class FogBugzPersonMiddleware(MiddlewareMixin):
+    """
+    Set ``request.fogbugz_person`` to the logged in user's
+    :class:`.client.FogBugzPerson` (or ``None``), see :mod:`.session`.
+
+    It is lazy, nothing is looked up unless the view uses it. Must come
+    after Django's ``AuthenticationMiddleware``.
+    """
+    def process_request(self, request):
+        request.fogbugz_person = SimpleLazyObject(
+            lambda: get_person(request))
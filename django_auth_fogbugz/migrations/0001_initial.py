@@ -15,7 +15,7 @@ class Migration(migrations.Migration):
         migrations.CreateModel(
             name='FogBugzProfile',
             fields=[
-                ('user', models.OneToOneField(primary_key=True, to=settings.AUTH_USER_MODEL, serialize=False)),
+                ('user', models.OneToOneField(primary_key=True, to=settings.AUTH_USER_MODEL, serialize=False, on_delete=models.CASCADE)),
                 ('token', models.CharField(blank=True, max_length=32, default='')),
                 ('ixPerson', models.PositiveIntegerField()),
                 ('is_normal', models.BooleanField()),
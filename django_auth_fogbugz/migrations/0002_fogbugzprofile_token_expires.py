@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_auth_fogbugz', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fogbugzprofile',
+            name='token_expires',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+    ]
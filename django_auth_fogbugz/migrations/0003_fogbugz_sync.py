@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_auth_fogbugz', '0002_fogbugzprofile_token_expires'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fogbugzprofile',
+            name='fingerprint',
+            field=models.CharField(blank=True, max_length=40, default=''),
+        ),
+        migrations.CreateModel(
+            name='FogBugzSyncRun',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('started', models.DateTimeField()),
+                ('finished', models.DateTimeField()),
+                ('full', models.BooleanField(default=False)),
+                ('created', models.PositiveIntegerField(default=0)),
+                ('updated', models.PositiveIntegerField(default=0)),
+                ('unchanged', models.PositiveIntegerField(default=0)),
+                ('skipped', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'get_latest_by': 'finished',
+            },
+        ),
+    ]
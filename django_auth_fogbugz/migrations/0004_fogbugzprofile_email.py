@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import models, migrations
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Lower
+
+
+def backfill_email(apps, schema_editor):
+    FogBugzProfile = apps.get_model('django_auth_fogbugz', 'FogBugzProfile')
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    emails = User._default_manager.filter(pk=OuterRef('user')).values('email')
+    FogBugzProfile.objects.using(schema_editor.connection.alias).update(
+        email=Lower(Subquery(emails[:1])))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('django_auth_fogbugz', '0003_fogbugz_sync'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fogbugzprofile',
+            name='email',
+            field=models.CharField(blank=True, max_length=254, default='', db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='fogbugzprofile',
+            name='ixPerson',
+            field=models.PositiveIntegerField(db_index=True),
+        ),
+        migrations.RunPython(backfill_email, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_auth_fogbugz', '0004_fogbugzprofile_email'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fogbugzprofile',
+            name='offline_verifier',
+            field=models.CharField(blank=True, max_length=128, default=''),
+        ),
+        migrations.AddField(
+            model_name='fogbugzprofile',
+            name='offline_expires',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+    ]
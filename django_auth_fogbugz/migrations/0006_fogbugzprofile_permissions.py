@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_auth_fogbugz', '0005_fogbugzprofile_offline_verifier'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fogbugzprofile',
+            name='permissions',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_auth_fogbugz', '0006_fogbugzprofile_permissions'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='fogbugzprofile',
+            name='token',
+            field=models.CharField(blank=True, max_length=32, default='',
+                                   db_index=True),
+        ),
+    ]
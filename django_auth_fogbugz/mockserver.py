@@ -0,0 +1,289 @@
+# Copyright (c) 2012, Douglas Napoleone.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+#     3. Neither the name of Django nor the names of its contributors may be
+#        used to endorse or promote products derived from this software without
+#        specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Stand-in FogBugz XML API server, for tests and benchmarks of the backend
+without a real FogBugz.
+
+Serves ``api.xml`` and the ``logon``, ``logoff``, ``viewPerson`` and
+``listPeople`` commands for a fixed set of :class:`Person` fixtures, with
+optional added latency and a rate of failed (HTTP 500) requests::
+
+    server = MockFogBugzServer([
+        Person(1, 'admin@example.com', 'secret', admin=True),
+        Person(2, 'joe@example.com', 'secret', ldap_username='joe'),
+        Person(3, 'customer@example.com', 'secret', community=True),
+    ], latency=0.05)
+    with server:
+        settings.AUTH_FOGBUGZ_SERVER = server.url
+        ...
+"""
+
+from collections import Counter
+from email import message_from_bytes
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+from xml.sax.saxutils import escape
+
+import random
+import threading
+import time
+import uuid
+
+
+class Person(object):
+    """
+    A FogBugz person fixture. ``ldap_username`` is an extra name the person
+    can log on with, as on a FogBugz server using LDAP.
+    """
+    def __init__(self, ixPerson, email, password, fullname='', admin=False,
+                 community=False, ldap_username=None, deleted=False):
+        self.ixPerson = ixPerson
+        self.email = email
+        self.password = password
+        self.fullname = fullname or email.split('@')[0]
+        self.admin = admin
+        self.community = community
+        self.ldap_username = ldap_username
+        self.deleted = deleted
+
+    def to_xml(self):
+        return ('<person><ixPerson>%d</ixPerson>'
+                '<sFullName>%s</sFullName><sEmail>%s</sEmail>'
+                '<fAdministrator>%s</fAdministrator>'
+                '<fCommunity>%s</fCommunity><fDeleted>%s</fDeleted>'
+                '</person>' % (
+                    self.ixPerson, escape(self.fullname), escape(self.email),
+                    _bool(self.admin), _bool(self.community),
+                    _bool(self.deleted)))
+
+def _bool(value):
+    return 'true' if value else 'false'
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    ## the headers and body are written separately, do not let Nagle's
+    ## algorithm delay the body.
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        mock = self.server.mock
+        if not mock._begin('api.xml', self):
+            return
+        if not self.path.split('?')[0].endswith('/api.xml'):
+            return self._send(404, '')
+        self._send(200, '<?xml version="1.0" encoding="UTF-8"?><response>'
+                        '<version>8</version><minversion>1</minversion>'
+                        '<url>%s</url></response>' % escape(mock.api_path))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        fields = _parse_form(self.headers.get('Content-Type', ''), body)
+        cmd = fields.get('cmd', '')
+        mock = self.server.mock
+        if not mock._begin(cmd, self):
+            return
+        handler = getattr(mock, '_cmd_' + cmd, None)
+        if handler is None:
+            return self._send(200, _error(0, "Unknown command %s" % cmd))
+        self._send(200, handler(fields))
+
+    def _send(self, status, content):
+        data = content.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def _parse_form(content_type, body):
+    if content_type.startswith('multipart/'):
+        ## FogBugzPy posts multipart forms.
+        head = ('Content-Type: %s\r\n\r\n' % content_type).encode('latin-1')
+        message = message_from_bytes(head + body)
+        fields = {}
+        for part in message.get_payload():
+            name = part.get_param('name', header='content-disposition')
+            value = part.get_payload(decode=True)
+            fields[name] = value.decode('utf-8')
+        return fields
+    fields = parse_qs(body.decode('utf-8'), keep_blank_values=True)
+    return dict((name, values[0]) for name, values in fields.items())
+
+def _response(content):
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<response>%s</response>' % content)
+
+def _error(code, message):
+    return _response('<error code="%d"><![CDATA[%s]]></error>' % (
+        code, message))
+
+
+class MockFogBugzServer(object):
+    """
+    Threaded FogBugz XML API stand-in, listening on ``host`` and ``port``
+    (a free port by default). ``latency`` seconds are added to every
+    request, and ``error_rate`` (0 to 1) of requests fail with HTTP 500.
+
+    ``calls`` counts the requests made for each command. With
+    ``reuse_tokens`` a logon hands back the person's existing token, as
+    FogBugz may.
+    """
+    api_path = 'api.asp?'
+
+    def __init__(self, people=(), host='127.0.0.1', port=0, latency=0,
+                 error_rate=0, reuse_tokens=False):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.reuse_tokens = reuse_tokens
+        self.people = {}
+        self.tokens = {}
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+        for person in people:
+            self.add_person(person)
+
+    @property
+    def url(self):
+        return 'http://%s:%d/' % (self.host, self.port)
+
+    def add_person(self, person):
+        with self._lock:
+            self.people[person.ixPerson] = person
+
+    def start(self):
+        self._server = _Server((self.host, self.port), _Handler)
+        self._server.mock = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _begin(self, cmd, handler):
+        """
+        Count the call and apply the latency and error rate. Returns
+        ``False`` if the request was failed.
+        """
+        with self._lock:
+            self.calls[cmd] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            handler._send(500, 'Internal Server Error')
+            return False
+        return True
+
+    def _find_person(self, name):
+        name = name.lower()
+        with self._lock:
+            for person in self.people.values():
+                if name in (person.email.lower(),
+                            (person.ldap_username or '').lower()):
+                    return person
+        return None
+
+    def _logged_on(self, fields):
+        with self._lock:
+            ixPerson = self.tokens.get(fields.get('token'))
+            return self.people.get(ixPerson)
+
+    def _cmd_logon(self, fields):
+        person = self._find_person(fields.get('email', ''))
+        if (person is None or person.deleted or
+                person.password != fields.get('password')):
+            return _error(1, "Incorrect password or username")
+        with self._lock:
+            token = None
+            if self.reuse_tokens:
+                token = next((existing for existing, ixPerson
+                              in self.tokens.items()
+                              if ixPerson == person.ixPerson), None)
+            if token is None:
+                token = uuid.uuid4().hex[:30]
+            self.tokens[token] = person.ixPerson
+        return _response('<token><![CDATA[%s]]></token>' % token)
+
+    def _cmd_logoff(self, fields):
+        with self._lock:
+            self.tokens.pop(fields.get('token'), None)
+        return _response('')
+
+    def _cmd_viewPerson(self, fields):
+        person = self._logged_on(fields)
+        if person is None:
+            return _error(3, "Not logged on")
+        if fields.get('ixPerson'):
+            with self._lock:
+                person = self.people.get(int(fields['ixPerson']))
+            if person is None:
+                return _error(19, "Person not found")
+        return _response(person.to_xml())
+
+    def _cmd_listPeople(self, fields):
+        if self._logged_on(fields) is None:
+            return _error(3, "Not logged on")
+        community = fields.get('fIncludeCommunity') == '1'
+        deleted = fields.get('fIncludeDeleted') == '1'
+        normal = fields.get('fIncludeNormal', '1') == '1'
+        with self._lock:
+            people = sorted(self.people.values(), key=lambda p: p.ixPerson)
+        people = [p for p in people
+                  if (community if p.community else normal) and
+                  (deleted or not p.deleted)]
+        return _response('<people>%s</people>' % ''.join(
+            p.to_xml() for p in people))
@@ -27,17 +27,122 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.conf import settings
 
 
 class FogBugzProfile(models.Model):
-    user = models.OneToOneField(settings.AUTH_USER_MODEL, primary_key=True)
-    token = models.CharField(max_length=32, default='', blank=True)
-    ixPerson = models.PositiveIntegerField()
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, primary_key=True,
+                                on_delete=models.CASCADE)
+    token = models.CharField(max_length=32, default='', blank=True,
+                             db_index=True)
+    token_expires = models.DateTimeField(null=True, blank=True)
+    ixPerson = models.PositiveIntegerField(db_index=True)
+    ## lower-cased FogBugz e-mail address, for indexed e-mail logins.
+    email = models.CharField(max_length=254, default='', blank=True,
+                             db_index=True)
     is_normal = models.BooleanField()
     is_community = models.BooleanField()
     is_administrator = models.BooleanField()
+    fingerprint = models.CharField(max_length=40, default='', blank=True)
+    ## password verifier for logins while FogBugz is unavailable.
+    offline_verifier = models.CharField(max_length=128, default='',
+                                        blank=True)
+    offline_expires = models.DateTimeField(null=True, blank=True)
+    ## space separated permissions granted by the FogBugz role.
+    permissions = models.TextField(default='', blank=True)
 
-    def __unicode__(self):
-        return u"%d %d %s" % (self.ixPerson, self.user.id, self.user.first_name)
+    def __str__(self):
+        return "%d %d %s" % (self.ixPerson, self.user.id, self.user.first_name)
+
+    def get_client(self):
+        """
+        Return a FogBugz API client using the stored token, or ``None`` if
+        there is none. Clients are cached and shared, see
+        :func:`django_auth_fogbugz.client.get_client`.
+        """
+        from .client import get_client
+        if not self.token:
+            return None
+        return get_client(self.token)
+
+
+def forget_profiles(profiles, deleted=False):
+    """
+    Drop what is cached about the users of ``profiles``: their role
+    permissions, their FogBugz person (see :mod:`.session`) and their token
+    user (see :mod:`.tokens`). Sent by
+    the receivers below, and called after bulk writes, which send no
+    signals.
+    """
+    from .conf import get_settings
+    from .permissions import forget_permissions
+    from .session import forget_people, profile_version
+    from .tokens import forget_users as forget_token_users
+    pks = [profile.pk for profile in profiles]
+    versions = dict((profile.pk, '' if deleted else profile_version(profile))
+                    for profile in profiles)
+    role_permissions = get_settings().ROLE_PERMISSIONS
+
+    def forget():
+        if role_permissions:
+            forget_permissions(pks)
+        forget_people(versions)
+        forget_token_users(pks)
+    ## after the commit, so a concurrent request can not cache the old
+    ## values again.
+    transaction.on_commit(forget)
+
+def forget_users(users):
+    """
+    Drop the cached token user (see :mod:`.tokens`) of each of ``users``.
+    Sent by the receivers below, and called after bulk writes.
+    """
+    from .tokens import forget_users as forget_token_users
+    pks = [user.pk for user in users]
+    transaction.on_commit(lambda: forget_token_users(pks))
+
+
+@receiver(post_save, sender=FogBugzProfile)
+def _profile_saved(sender, instance, **kwargs):
+    forget_profiles([instance])
+
+
+@receiver(post_delete, sender=FogBugzProfile)
+def _profile_deleted(sender, instance, **kwargs):
+    forget_profiles([instance], deleted=True)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def _user_saved(sender, instance, update_fields=None, **kwargs):
+    ## update_last_login() saves every login, it changes nothing cached.
+    if update_fields and set(update_fields) == set(['last_login']):
+        return
+    forget_users([instance])
+
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def _user_deleted(sender, instance, **kwargs):
+    forget_users([instance])
+
+
+class FogBugzSyncRun(models.Model):
+    """
+    Record of a ``fogbugz_sync_users`` run.
+    """
+    started = models.DateTimeField()
+    finished = models.DateTimeField()
+    full = models.BooleanField(default=False)
+    created = models.PositiveIntegerField(default=0)
+    updated = models.PositiveIntegerField(default=0)
+    unchanged = models.PositiveIntegerField(default=0)
+    skipped = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        get_latest_by = 'finished'
+
+    def __str__(self):
+        return "%s: %d created, %d updated" % (self.finished, self.created,
+                                              self.updated)
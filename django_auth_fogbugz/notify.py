@@ -0,0 +1,216 @@
+# Copyright (c) 2012, Douglas Napoleone.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+#     3. Neither the name of Django nor the names of its contributors may be
+#        used to endorse or promote products derived from this software without
+#        specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Refreshes of users and profiles from FogBugz person change notifications
+(see :func:`.views.person_changed`).
+
+Notified ``ixPerson`` values are collected in a set, and refreshed by a
+background thread AUTH_FOGBUGZ_NOTIFY_DELAY seconds after the first of them
+arrived. A burst of notifications about the same people therefore costs one
+``viewPerson`` call per person and one bulk write, done with the same rules
+as :class:`.sync.PeopleSync`.
+"""
+
+from django.db import close_old_connections
+from django.utils.crypto import constant_time_compare
+from django.utils.encoding import force_bytes
+
+import atexit
+import hashlib
+import hmac
+import logging
+import threading
+import time
+
+import fogbugz
+
+from . import throttle
+from .cache import get_cache, make_key
+from .client import FogBugzClient
+from .conf import get_settings
+from .sync import PeopleSync, fingerprint
+
+logger = logging.getLogger('django_auth_fogbugz')
+
+## seconds a notification signature is accepted for.
+SIGNATURE_MAX_AGE = 300
+
+def sign(secret, value, timestamp):
+    """
+    The signature of a notification for the ``ixPerson`` parameter
+    ``value``, sent at ``timestamp`` (integer seconds since the epoch): the
+    hex HMAC-SHA256 of ``"<value>:<timestamp>"``, keyed with ``secret``.
+    """
+    return hmac.new(force_bytes(secret),
+                    force_bytes(u'%s:%s' % (value, timestamp)),
+                    hashlib.sha256).hexdigest()
+
+def check_signature(secret, value, timestamp, signature, now=None):
+    """
+    Check a notification signature, and that ``timestamp`` is within
+    SIGNATURE_MAX_AGE seconds of ``now``. Each signature is accepted once,
+    as long as the AUTH_FOGBUGZ_CACHE_ALIAS cache is shared.
+    """
+    try:
+        timestamp = int(timestamp, 10)
+    except (TypeError, ValueError):
+        return False
+    if now is None:
+        now = time.time()
+    if abs(now - timestamp) > SIGNATURE_MAX_AGE:
+        return False
+    if not constant_time_compare(sign(secret, value, timestamp),
+                                 signature or ''):
+        return False
+    ## kept until the timestamp is too old to be accepted anyway.
+    return get_cache().add(make_key('notification', signature), 1,
+                           SIGNATURE_MAX_AGE * 2)
+
+def refresh_people(fbcfg, ixPersons):
+    """
+    Update the existing users and profiles of the people ``ixPersons``
+    from FogBugz, using the AUTH_FOGBUGZ_SYNC_TOKEN token. No users are
+    created. People deleted in FogBugz, or turned into community users while
+    ALLOW_COMMUNITY is off, lose their access (see
+    :meth:`.sync.PeopleSync.update_user`). Returns the
+    :attr:`.sync.PeopleSync.stats`.
+    """
+    fb = FogBugzClient(fbcfg.SERVER, fbcfg.SYNC_TOKEN)
+    sync = PeopleSync(fbcfg, create=False, full=True)
+    people = []
+    for ixPerson in sorted(ixPersons):
+        ## the cached community rejection may be out of date.
+        throttle.forget_community(ixPerson)
+        try:
+            person = fb.view_person(ixPerson=ixPerson)
+        except fogbugz.FogBugzConnectionError:
+            raise
+        except fogbugz.FogBugzAPIError as e:
+            logger.debug("Not refreshing FogBugz person (%s): %s",
+                         ixPerson, str(e))
+            sync.stats['skipped'] += 1
+            continue
+        person.fingerprint = fingerprint(fbcfg, person)
+        people.append(person)
+
+    if people:
+        sync.sync_batch(people)
+    return sync.stats
+
+
+class RefreshQueue(object):
+    """
+    Set of ``ixPerson`` values waiting to be refreshed, and the thread
+    refreshing them.
+    """
+    def __init__(self, delay=2, maxsize=10000):
+        self.delay = delay
+        self.maxsize = maxsize
+        self._pending = set()
+        self._stopping = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run,
+                                        name='fogbugz-refresh')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, ixPersons):
+        """
+        Queue refreshes, returns ``False`` if too many are pending.
+        """
+        with self._cond:
+            if len(self._pending | set(ixPersons)) > self.maxsize:
+                return False
+            self._pending.update(ixPersons)
+            self._cond.notify()
+        return True
+
+    def pending(self):
+        return len(self._pending)
+
+    def drain(self, timeout):
+        """
+        Refresh what is pending without waiting for the delay, then stop,
+        waiting at most ``timeout`` seconds.
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        if self.pending():
+            logger.warning("Exiting with %d FogBugz person refreshes still "
+                           "queued.", self.pending())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopping:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                stopping = self._stopping
+            if not stopping:
+                ## let the rest of the burst arrive.
+                time.sleep(self.delay)
+            with self._cond:
+                batch, self._pending = self._pending, set()
+            try:
+                refresh_people(get_settings(), batch)
+            except Exception as e:
+                logger.error("Failed to refresh FogBugz people (%s): %s",
+                             ', '.join(str(i) for i in sorted(batch)), str(e))
+            finally:
+                close_old_connections()
+
+_refresh_queue = None
+_refresh_queue_lock = threading.Lock()
+
+def queue_refresh(ixPersons):
+    """
+    Queue a refresh of the people ``ixPersons``. Returns ``False`` if it
+    could not be queued.
+    """
+    global _refresh_queue
+    if _refresh_queue is None:
+        with _refresh_queue_lock:
+            if _refresh_queue is None:
+                _refresh_queue = RefreshQueue(get_settings().NOTIFY_DELAY)
+                atexit.register(drain)
+    return _refresh_queue.submit(ixPersons)
+
+def drain(timeout=10):
+    """
+    Do the queued refreshes and stop the thread. Called at exit.
+    """
+    global _refresh_queue
+    with _refresh_queue_lock:
+        refresh_queue, _refresh_queue = _refresh_queue, None
+    if refresh_queue is not None:
+        refresh_queue.drain(timeout)
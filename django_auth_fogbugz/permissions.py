@@ -0,0 +1,89 @@
+# Copyright (c) 2012, Douglas Napoleone.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+#     3. Neither the name of Django nor the names of its contributors may be
+#        used to endorse or promote products derived from this software without
+#        specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Django permissions granted by FogBugz role, see AUTH_FOGBUGZ_ROLE_PERMISSIONS.
+
+The permissions for a user's role are worked out when they log in (or are
+synced) and stored with their FogBugzProfile, then served from the
+AUTH_FOGBUGZ_CACHE_ALIAS cache for permission checks. Saving or deleting the
+profile drops the cached entry.
+"""
+
+from .cache import get_cache, make_key
+from .conf import get_settings
+
+
+def role(admin, community):
+    """
+    The FogBugz role name for the person flags.
+    """
+    if admin:
+        return 'administrator'
+    if community:
+        return 'community'
+    return 'normal'
+
+def role_permissions(fbcfg, admin, community):
+    """
+    The permissions ROLE_PERMISSIONS grants the role, in the space separated
+    form stored in :attr:`.models.FogBugzProfile.permissions`.
+    """
+    perms = (fbcfg.ROLE_PERMISSIONS or {}).get(role(admin, community)) or ()
+    return u' '.join(sorted(set(perms)))
+
+def get_role_permissions(user):
+    """
+    Return the set of ``'app_label.codename'`` permissions the user's
+    FogBugz role grants. Kept on the user instance, and in the cache for
+    PERMISSION_CACHE_TTL seconds, so only a cache miss queries the profile.
+    """
+    perms = getattr(user, '_fogbugz_role_perm_cache', None)
+    if perms is not None:
+        return perms
+
+    from .models import FogBugzProfile
+    cache = get_cache()
+    key = make_key('permissions', str(user.pk))
+    stored = cache.get(key)
+    if stored is None:
+        stored = FogBugzProfile.objects.filter(user=user).values_list(
+            'permissions', flat=True).first() or u''
+        cache.set(key, stored, get_settings().PERMISSION_CACHE_TTL)
+    perms = user._fogbugz_role_perm_cache = frozenset(stored.split())
+    return perms
+
+def forget_permissions(user_pks):
+    """
+    Drop the cached role permissions of the users with the given primary
+    keys.
+    """
+    if user_pks:
+        get_cache().delete_many([make_key('permissions', str(pk))
+                                 for pk in user_pks])
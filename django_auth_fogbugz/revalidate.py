@@ -0,0 +1,157 @@
+# Copyright (c) 2012, Douglas Napoleone.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+#     3. Neither the name of Django nor the names of its contributors may be
+#        used to endorse or promote products derived from this software without
+#        specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Revalidation of the FogBugz tokens stored in profiles (ENABLE_PROFILE_TOKEN),
+outside of the request path.
+
+Profiles with a token are walked in primary key order, a batch at a time
+(keyset pagination, so the cost of a page does not grow with the offset).
+The tokens of each batch are checked with a ``viewPerson`` call by a bounded
+pool of threads. Dead tokens are cleared, and the admin and community flags
+of the live ones refreshed the same way :class:`.sync.PeopleSync` does, with
+one bulk write per batch.
+"""
+
+from django.db import transaction
+
+from django.contrib.auth import get_user_model
+
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+
+import fogbugz
+
+from . import tokens
+from .client import FogBugzClient, forget_client
+from .models import FogBugzProfile, forget_profiles, forget_users
+from .sync import PeopleSync, fingerprint
+
+logger = logging.getLogger('django_auth_fogbugz')
+
+## profile fields PeopleSync.update_profile sets.
+PROFILE_FIELDS = ['ixPerson', 'is_normal', 'is_community', 'is_administrator',
+                  'email', 'fingerprint', 'permissions']
+
+class TokenRevalidator(object):
+    """
+    Check every stored profile token with the FogBugz server. Counts are
+    kept in :attr:`stats`: ``checked``, ``valid``, ``cleared`` (dead
+    tokens), ``updated`` (profiles or users with refreshed flags) and
+    ``errors`` (tokens which could not be checked, and were left alone).
+    """
+    def __init__(self, fbcfg, batch_size=500, workers=4, dry_run=False):
+        self.fbcfg = fbcfg
+        self.batch_size = batch_size
+        self.workers = workers
+        self.dry_run = dry_run
+        self.sync = PeopleSync(fbcfg, dry_run=dry_run)
+        self.stats = dict(checked=0, valid=0, cleared=0, updated=0,
+                          errors=0)
+
+    def run(self):
+        last = None
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while True:
+                profiles = FogBugzProfile.objects.select_related(
+                    'user').exclude(token='').order_by('pk')
+                if last is not None:
+                    profiles = profiles.filter(pk__gt=last)
+                batch = list(profiles[:self.batch_size])
+                if not batch:
+                    break
+                last = batch[-1].pk
+                results = pool.map(self.check, [p.token for p in batch])
+                self.revalidate_batch(list(zip(batch, results)))
+        return self.stats
+
+    def check(self, token):
+        """
+        Returns the :class:`.client.FogBugzPerson` for a live token,
+        ``False`` for a dead one and ``None`` if it could not be checked.
+        """
+        try:
+            return FogBugzClient(self.fbcfg.SERVER, token).view_person()
+        except fogbugz.FogBugzConnectionError as e:
+            logger.warning("Could not check a stored token with FogBugz "
+                           "server (%s): %s", self.fbcfg.SERVER, str(e))
+            return None
+        except fogbugz.FogBugzAPIError:
+            return False
+
+    def revalidate_batch(self, checked):
+        dead = []
+        changed_users = []
+        changed_profiles = []
+        for profile, person in checked:
+            self.stats['checked'] += 1
+            if person is None:
+                self.stats['errors'] += 1
+                continue
+            if (person is False or person.deleted or
+                    person.ixPerson != profile.ixPerson):
+                logger.debug("Clearing the dead stored token of user (%s).",
+                             profile.user.get_username())
+                dead.append(profile.token)
+                continue
+
+            self.stats['valid'] += 1
+            person.fingerprint = fingerprint(self.fbcfg, person)
+            user_changed = self.sync.update_user(profile.user, person)
+            if user_changed:
+                changed_users.append(profile.user)
+            profile_changed = self.sync.update_profile(profile, person)
+            if profile_changed:
+                changed_profiles.append(profile)
+            if user_changed or profile_changed:
+                self.stats['updated'] += 1
+        self.stats['cleared'] += len(dead)
+
+        if self.dry_run:
+            return
+
+        with transaction.atomic():
+            if dead:
+                ## matched by token, so a token replaced by a login since
+                ## the check is left alone.
+                FogBugzProfile.objects.filter(token__in=dead).update(
+                    token='', token_expires=None)
+            if changed_users:
+                get_user_model()._default_manager.bulk_update(
+                    changed_users, self.sync.user_fields)
+                forget_users(changed_users)
+            if changed_profiles:
+                FogBugzProfile.objects.bulk_update(changed_profiles,
+                                                   PROFILE_FIELDS)
+                ## bulk_update sends no post_save.
+                forget_profiles(changed_profiles)
+        for token in dead:
+            forget_client(token)
+            tokens.forget(token)
@@ -0,0 +1,158 @@
+# Copyright (c) 2012, Douglas Napoleone.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+#     3. Neither the name of Django nor the names of its contributors may be
+#        used to endorse or promote products derived from this software without
+#        specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+The logged in user's FogBugz person details, for
+:class:`.middleware.FogBugzPersonMiddleware`.
+
+The :class:`.client.FogBugzPerson` fetched by a FogBugz login is kept in the
+session (as a short list) when Django logs the user in. Without it, e.g.
+after an offline login or for token authenticated requests, the person is
+fetched once with the stored profile token (or built from the profile) and
+cached in the AUTH_FOGBUGZ_CACHE_ALIAS cache for PERSON_CACHE_TTL seconds.
+
+When a profile changes (a login, sync or refresh), :func:`forget_people`
+drops the cached person and records the new :func:`profile_version` in the
+cache. A session whose person has another version is out of date, and is
+not used.
+"""
+
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_in
+from django.dispatch import receiver
+from django.utils.encoding import force_bytes
+
+import hashlib
+import logging
+
+import fogbugz
+
+from .cache import get_cache, make_key
+from .client import FogBugzPerson, get_client
+from .conf import get_settings
+
+logger = logging.getLogger('django_auth_fogbugz')
+
+SESSION_KEY = '_fogbugz_person'
+
+def person_version(person):
+    """
+    Short hash of the person details a profile stores.
+    """
+    return _version(person.ixPerson, person.email, person.admin,
+                    person.community)
+
+def profile_version(profile):
+    return _version(profile.ixPerson, profile.email,
+                    profile.is_administrator, profile.is_community)
+
+def _version(ixPerson, email, admin, community):
+    return hashlib.sha1(force_bytes(u'%s\x00%s\x00%s\x00%s' % (
+        ixPerson, (email or '').lower(), admin, community))).hexdigest()[:12]
+
+def to_session(person):
+    return [person.ixPerson, person.fullname, person.email, person.admin,
+            person.community, person_version(person)]
+
+def from_session(data):
+    ixPerson, fullname, email, admin, community, version = data
+    return FogBugzPerson(ixPerson, fullname, email, admin, community)
+
+def forget_people(versions):
+    """
+    Drop the cached person of each user primary key in ``versions``, and
+    record its new profile version (``''`` for a deleted profile) for the
+    sessions to check against.
+    """
+    if not versions:
+        return
+    cache = get_cache()
+    cache.delete_many([make_key('person', str(pk)) for pk in versions])
+    ## kept as long as a session can be.
+    cache.set_many(dict((make_key('person_version', str(pk)), version)
+                        for pk, version in versions.items()),
+                   settings.SESSION_COOKIE_AGE)
+
+def get_person(request):
+    """
+    Return the :class:`.client.FogBugzPerson` of the user logged in to
+    ``request``, or ``None``.
+    """
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        return None
+    cache = get_cache()
+    session = getattr(request, 'session', None)
+    data = session.get(SESSION_KEY) if session is not None else None
+    if data:
+        try:
+            person = from_session(data)
+        except (TypeError, ValueError):
+            person = None
+        if person is not None:
+            version = cache.get(make_key('person_version', str(user.pk)))
+            if version is None or version == data[-1]:
+                return person
+        del session[SESSION_KEY]
+
+    key = make_key('person', str(user.pk))
+    data = cache.get(key)
+    if data is None:
+        person = _fetch_person(user)
+        if person is None:
+            return None
+        data = to_session(person)
+        cache.set(key, data, get_settings().PERSON_CACHE_TTL)
+    return from_session(data)
+
+def _fetch_person(user):
+    from .models import FogBugzProfile
+    try:
+        profile = user.fogbugzprofile
+    except FogBugzProfile.DoesNotExist:
+        return None
+    if profile.token:
+        try:
+            person = get_client(profile.token).view_person()
+            if person.ixPerson == profile.ixPerson:
+                return person
+        except fogbugz.FogBugzAPIError as e:
+            logger.debug("Could not fetch the FogBugz person of user (%s), "
+                         "using the profile: %s", user.get_username(), str(e))
+    return FogBugzPerson(profile.ixPerson, user.first_name,
+                         profile.email or user.email,
+                         profile.is_administrator, profile.is_community)
+
+@receiver(user_logged_in)
+def _user_logged_in(sender, request=None, user=None, **kwargs):
+    ## set on the user by FogBugzBackend.authenticate.
+    person = getattr(user, '_fogbugz_person', None)
+    session = getattr(request, 'session', None)
+    if person is not None and session is not None:
+        session[SESSION_KEY] = to_session(person)
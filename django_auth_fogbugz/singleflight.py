@@ -0,0 +1,163 @@
+# Copyright (c) 2012, Douglas Napoleone.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+#     3. Neither the name of Django nor the names of its contributors may be
+#        used to endorse or promote products derived from this software without
+#        specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Coalescing of concurrent identical work, so only one caller does it and the
+others share the result.
+
+:class:`Group` coalesces callers within a process, :class:`Lease` uses the
+Django cache to coalesce callers across processes.
+"""
+
+from django.utils.crypto import salted_hmac
+
+import threading
+import time
+
+from .cache import get_cache, make_key
+
+
+class _Call(object):
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Group(object):
+    """
+    Table of in flight calls, keyed by the caller supplied key.
+    """
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, timeout=None):
+        """
+        Run ``fn()`` unless a call for ``key`` is already in flight, in
+        which case wait for it and share its result (or exception).
+
+        Returns ``(result, shared)``. If the in flight call does not finish
+        within ``timeout`` seconds, ``fn()`` is run anyway.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if call.done.wait(timeout) or call.done.is_set():
+                if call.error is not None:
+                    raise call.error
+                return call.result, True
+            return fn(), False
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+
+class Lease(object):
+    """
+    Cache backed lease for ``key``, letting one process do the work while
+    the others wait for the result it publishes.
+
+    The result must be picklable, and may not be ``None``. It is kept for
+    ``result_timeout`` seconds after the lease is released.
+    """
+    poll_interval = 0.05
+    ## waiters are polling for the result, so it is only kept briefly.
+    result_timeout = 5
+
+    def __init__(self, key, timeout):
+        self.timeout = timeout
+        self.lease_key = make_key('lease', key)
+        self.result_key = make_key('lease-result', key)
+
+    def acquire(self):
+        """
+        Try to take the lease, returns ``True`` if we are to do the work.
+        """
+        cache = get_cache()
+        if not cache.add(self.lease_key, 1, self.timeout):
+            return False
+        ## a result published by an earlier holder is stale now.
+        cache.delete(self.result_key)
+        return True
+
+    def wait(self):
+        """
+        Wait for the holder of the lease to publish its result.
+
+        Returns ``(True, result)``, or ``(False, None)`` if the lease was
+        released, or expired, without a result.
+        """
+        cache = get_cache()
+        deadline = time.time() + self.timeout
+        while time.time() < deadline:
+            result = cache.get(self.result_key)
+            if result is not None:
+                return True, result
+            if cache.get(self.lease_key) is None:
+                ## check once more, the result is written before the lease
+                ## is released.
+                result = cache.get(self.result_key)
+                return result is not None, result
+            time.sleep(self.poll_interval)
+        return False, None
+
+    def release(self, result=None):
+        """
+        Publish ``result`` (unless it is ``None``) to any waiters, and
+        release the lease.
+        """
+        cache = get_cache()
+        if result is not None:
+            cache.set(self.result_key, result,
+                      min(self.timeout, self.result_timeout))
+        cache.delete(self.lease_key)
+
+
+def login_key(username, password):
+    """
+    Key identifying a login attempt. The password is only used as part of a
+    keyed HMAC (using ``SECRET_KEY``), so keys do not leak it.
+    """
+    return salted_hmac('django_auth_fogbugz.singleflight',
+                       u'%s\x00%s' % (username, password)).hexdigest()
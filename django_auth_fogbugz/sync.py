@@ -0,0 +1,325 @@
+# Copyright (c) 2012, Douglas Napoleone.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+#     3. Neither the name of Django nor the names of its contributors may be
+#        used to endorse or promote products derived from this software without
+#        specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Bulk provisioning of Django users (and FogBugz profiles) from the FogBugz
+people list, applying the same rules as the authentication backend.
+"""
+
+from django.db import transaction
+from django.db.models.functions import Lower
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+
+from django.contrib.auth import get_user_model
+
+import hashlib
+import logging
+
+from . import credentials, tokens
+from .client import forget_client
+from .models import (FogBugzProfile, FogBugzSyncRun, forget_profiles,
+                     forget_users)
+from .permissions import role_permissions
+
+logger = logging.getLogger('django_auth_fogbugz')
+
+
+def fingerprint(fbcfg, person):
+    """
+    Hash of the FogBugz person details a sync writes, and the settings
+    deciding how they are written, so a settings change forces a rewrite.
+    """
+    values = (person.ixPerson, person.fullname, person.email,
+              person.admin, person.community, person.deleted,
+              fbcfg.ALLOW_COMMUNITY, fbcfg.MAP_ADMIN_AS_SUPER,
+              fbcfg.MAP_ADMIN_AS_STAFF,
+              role_permissions(fbcfg, person.admin, person.community))
+    return hashlib.sha1(force_bytes(
+        u'\x00'.join(u'%s' % v for v in values))).hexdigest()
+
+class PeopleSync(object):
+    """
+    Create or update Django users from FogBugz person details (as yielded
+    by :meth:`.client.FogBugzClient.iter_people`) in batches, using
+    ``bulk_create`` and ``bulk_update``.
+
+    Existing users are matched by :class:`.models.FogBugzProfile`
+    ``ixPerson``, then by (case insensitive) e-mail address. New users get
+    the lower-cased e-mail address as their username, and an unusable
+    password. People deleted in FogBugz, and community users unless
+    ``ALLOW_COMMUNITY`` is set, are never created, and existing users of
+    theirs lose their access (see :meth:`update_user`). Counts are kept in
+    :attr:`stats`.
+
+    With ``ENABLE_PROFILE`` set, the :func:`fingerprint` of each person is
+    stored in their profile. Unless ``full`` is set, people whose
+    fingerprint has not changed since the last sync are skipped without
+    any further database work. Each (non dry run) sync is recorded as a
+    :class:`.models.FogBugzSyncRun`.
+    """
+    def __init__(self, fbcfg, batch_size=500, create=True, dry_run=False,
+                 full=False):
+        self.fbcfg = fbcfg
+        ## the user fields update_user may change.
+        self.user_fields = ['is_superuser', 'is_staff']
+        if 'is_active' in [f.name for f in get_user_model()._meta.fields]:
+            self.user_fields.append('is_active')
+        self.batch_size = batch_size
+        self.create = create
+        self.dry_run = dry_run
+        self.full = full or not fbcfg.ENABLE_PROFILE
+        self.stats = dict(created=0, updated=0, unchanged=0, skipped=0)
+
+    def run(self, people):
+        started = timezone.now()
+        known = {}
+        if not self.full:
+            known = dict(FogBugzProfile.objects.values_list(
+                'ixPerson', 'fingerprint'))
+
+        batch = []
+        for person in people:
+            if (self.revoked(person) and not self.full and
+                    person.ixPerson not in known):
+                ## never synced or logged in, there is nothing to revoke.
+                self.stats['skipped'] += 1
+                continue
+            person.fingerprint = fingerprint(self.fbcfg, person)
+            if known.get(person.ixPerson) == person.fingerprint:
+                self.stats['unchanged'] += 1
+                continue
+            batch.append(person)
+            if len(batch) >= self.batch_size:
+                self.sync_batch(batch)
+                batch = []
+        if batch:
+            self.sync_batch(batch)
+
+        if not self.dry_run:
+            FogBugzSyncRun.objects.create(started=started,
+                                          finished=timezone.now(),
+                                          full=self.full, **self.stats)
+        return self.stats
+
+    def sync_batch(self, people):
+        UserModel = get_user_model()
+        manager = UserModel._default_manager
+        username_field = getattr(UserModel, 'USERNAME_FIELD', 'username')
+        fbcfg = self.fbcfg
+
+        ## match existing users, by ixPerson then e-mail address.
+        users = {}
+        if fbcfg.ENABLE_PROFILE:
+            for profile in FogBugzProfile.objects.select_related('user').filter(
+                    ixPerson__in=[p.ixPerson for p in people]):
+                users[profile.ixPerson] = profile.user
+        by_email = dict((p.email.lower(), p) for p in people
+                        if p.email and p.ixPerson not in users)
+        if by_email:
+            for user in manager.annotate(
+                    fogbugz_email=Lower('email')).filter(
+                    fogbugz_email__in=list(by_email)):
+                users.setdefault(by_email[user.fogbugz_email].ixPerson,
+                                 user)
+
+        profiles = {}
+        if fbcfg.ENABLE_PROFILE:
+            profiles = FogBugzProfile.objects.in_bulk(
+                [user.pk for user in users.values()])
+
+        new_users = {}
+        changed_users = []
+        new_profiles = []
+        changed_profiles = []
+        revoked = []
+        for person in people:
+            user = users.get(person.ixPerson)
+            if user is None:
+                if (self.create and person.email and
+                        not self.revoked(person)):
+                    new_users[person.email.lower()] = self.new_user(person)
+                else:
+                    self.stats['skipped'] += 1
+                continue
+
+            changed = self.update_user(user, person)
+            if changed:
+                changed_users.append(user)
+            profile = None
+            if fbcfg.ENABLE_PROFILE:
+                profile = profiles.get(user.pk)
+                if profile is None:
+                    profile = FogBugzProfile(user=user)
+                    self.update_profile(profile, person)
+                    new_profiles.append(profile)
+                    changed = True
+                elif self.update_profile(profile, person):
+                    changed_profiles.append(profile)
+                    changed = True
+            if self.revoked(person):
+                revoked.append((user, profile))
+            self.stats['updated' if changed else 'unchanged'] += 1
+
+        if new_users:
+            ## never collide with hand created accounts.
+            taken = set(manager.filter(**{
+                username_field + '__in': list(new_users)}).values_list(
+                username_field, flat=True))
+            for username in taken:
+                logger.warning("Not creating user (%s), the username is "
+                               "already taken.", username)
+                del new_users[username]
+                self.stats['skipped'] += 1
+        self.stats['created'] += len(new_users)
+
+        if self.dry_run:
+            return
+
+        with transaction.atomic():
+            if changed_users:
+                manager.bulk_update(changed_users, self.user_fields,
+                                    batch_size=self.batch_size)
+                forget_users(changed_users)
+            if new_users:
+                manager.bulk_create(list(new_users.values()),
+                                    batch_size=self.batch_size)
+            if new_users and fbcfg.ENABLE_PROFILE:
+                ## not every database returns the new primary keys.
+                by_ixPerson = dict((p.ixPerson, p) for p in people)
+                for user in manager.filter(**{
+                        username_field + '__in': list(new_users)}):
+                    person = by_ixPerson[
+                        new_users[user.get_username()].fogbugz_ixPerson]
+                    profile = FogBugzProfile(user=user)
+                    self.update_profile(profile, person)
+                    new_profiles.append(profile)
+            if new_profiles:
+                FogBugzProfile.objects.bulk_create(new_profiles,
+                                                   batch_size=self.batch_size)
+            if changed_profiles:
+                FogBugzProfile.objects.bulk_update(
+                    changed_profiles, ['ixPerson', 'is_normal',
+                                       'is_community', 'is_administrator',
+                                       'email', 'fingerprint',
+                                       'permissions'],
+                    batch_size=self.batch_size)
+                ## bulk_update sends no post_save.
+                forget_profiles(changed_profiles)
+            if revoked:
+                transaction.on_commit(lambda: self.forget_revoked(revoked))
+
+    def new_user(self, person):
+        UserModel = get_user_model()
+        email = person.email.lower()
+        user = UserModel(**{
+            getattr(UserModel, 'USERNAME_FIELD', 'username'): email})
+        user.email = person.email
+        user.first_name = person.fullname
+        user.set_unusable_password()
+        if person.admin and self.fbcfg.MAP_ADMIN_AS_SUPER:
+            user.is_superuser = True
+        if person.admin and self.fbcfg.MAP_ADMIN_AS_STAFF:
+            user.is_staff = True
+        user.fogbugz_ixPerson = person.ixPerson
+        return user
+
+    def revoked(self, person):
+        """
+        Whether ``person`` may no longer log in: deleted in FogBugz, or a
+        community user while ``ALLOW_COMMUNITY`` is off.
+        """
+        return person.deleted or (person.community and
+                                  not self.fbcfg.ALLOW_COMMUNITY)
+
+    def update_user(self, user, person):
+        """
+        Apply the admin mapping settings to an existing user, the same way
+        a login does. A :meth:`revoked` person loses the superuser and staff
+        access the mappings grant, and a deleted one is made inactive.
+        Returns ``True`` if the user changed.
+        """
+        admin = person.admin
+        changed = False
+        if self.revoked(person):
+            values = {}
+            if self.fbcfg.MAP_ADMIN_AS_SUPER:
+                values['is_superuser'] = False
+            if self.fbcfg.MAP_ADMIN_AS_STAFF:
+                values['is_staff'] = False
+            if person.deleted and 'is_active' in self.user_fields:
+                values['is_active'] = False
+            for name, value in values.items():
+                if getattr(user, name) != value:
+                    setattr(user, name, value)
+                    changed = True
+            return changed
+        if self.fbcfg.MAP_ADMIN_AS_SUPER and user.is_superuser != admin:
+            user.is_superuser = admin
+            changed = True
+        if admin and self.fbcfg.MAP_ADMIN_AS_STAFF and not user.is_staff:
+            user.is_staff = True
+            changed = True
+        return changed
+
+    def forget_revoked(self, revoked):
+        """
+        Drop what this process has cached for the ``(user, profile)`` pairs
+        of revoked people: verified passwords, the profile token's client
+        and token user.
+        """
+        for user, profile in revoked:
+            if self.fbcfg.CREDENTIAL_CACHE_TTL:
+                credentials.forget(user.get_username().lower())
+                if profile is not None and profile.email:
+                    credentials.forget(profile.email)
+            if profile is not None and profile.token:
+                forget_client(profile.token)
+                tokens.forget(profile.token)
+
+    def update_profile(self, profile, person):
+        """
+        Returns ``True`` if the profile changed.
+        """
+        admin = person.admin
+        community = person.community
+        values = dict(ixPerson = person.ixPerson,
+                      is_normal = not community and not admin,
+                      is_community = community,
+                      is_administrator = admin,
+                      email = person.email.lower(),
+                      fingerprint = person.fingerprint,
+                      permissions = role_permissions(self.fbcfg, admin,
+                                                     community))
+        changed = False
+        for name, value in values.items():
+            if getattr(profile, name, None) != value:
+                setattr(profile, name, value)
+                changed = True
+        return changed
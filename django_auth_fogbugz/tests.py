@@ -0,0 +1,1250 @@
+# Copyright (c) 2012, Douglas Napoleone.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+#     3. Neither the name of Django nor the names of its contributors may be
+#        used to endorse or promote products derived from this software without
+#        specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from django.apps import apps
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.signals import user_logged_in
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from django.contrib.auth import get_user_model
+
+import asyncio
+import datetime
+import time
+from io import BytesIO, StringIO
+from unittest import mock
+
+import fogbugz
+
+from django.utils import timezone
+
+from .aio import AsyncFogBugzClient, AsyncGroup, aacquire
+from .backend import FogBugzBackend, FogBugzTokenBackend
+from .benchmark import run_logins
+from .breaker import CircuitBreaker
+from .cache import get_cache
+from .client import (FogBugzClient, FogBugzPerson, clear_discovery_cache,
+                     iter_people, parse_fields, parse_person)
+from .conf import get_settings
+from .middleware import FogBugzPersonMiddleware, FogBugzTokenMiddleware
+from .limiter import ConcurrencyLimiter, GlobalConcurrencyLimiter
+from .logoff import LogoffQueue, drain
+from .mockserver import MockFogBugzServer, Person
+from .models import FogBugzProfile, FogBugzSyncRun, forget_users
+from .notify import RefreshQueue, refresh_people, sign
+from .revalidate import TokenRevalidator
+from .singleflight import Lease
+from .transport import ConnectionPool
+from .signals import login_timed
+
+_reported = []
+
+def _sink(name, duration, labels):
+    _reported.append((name, labels))
+
+def _person(**kwargs):
+    values = dict(ixPerson=7, fullname='Joe User', email='joe@example.com')
+    values.update(kwargs)
+    return FogBugzPerson(**values)
+
+@override_settings(AUTH_FOGBUGZ_SERVER='http://fogbugz.example.com/',
+                   AUTH_FOGBUGZ_AUTO_CREATE_USERS=True,
+                   AUTH_FOGBUGZ_ENABLE_PROFILE=True,
+                   AUTH_FOGBUGZ_MAP_ADMIN_AS_STAFF=True,
+                   AUTH_FOGBUGZ_MAP_ADMIN_AS_SUPER=True)
+class LoginQueryTests(TestCase):
+    """
+    The number of queries a login costs. The FogBugz exchange is replaced
+    with a fixed person, so only the database work is counted.
+    """
+
+    def setUp(self):
+        self.backend = FogBugzBackend()
+        self.person = _person()
+
+    def login(self):
+        with mock.patch.object(FogBugzBackend, '_fogbugz_logon',
+                               return_value=(None, self.person)):
+            return self.backend.authenticate(username='Joe@example.com',
+                                             password='secret')
+
+    def test_new_user(self):
+        ## profile and user e-mail lookups, then the user and profile
+        ## inserts in a savepoint.
+        with self.assertNumQueries(6):
+            user = self.login()
+        self.assertEqual(user.username, 'joe@example.com')
+        self.assertEqual(user.first_name, 'Joe User')
+        self.assertEqual(user.fogbugzprofile.ixPerson, 7)
+
+    def test_unchanged_user(self):
+        self.login()
+        with self.assertNumQueries(1):
+            user = self.login()
+        self.assertFalse(user.is_staff)
+
+    def test_changed_user(self):
+        self.login()
+        self.person = _person(admin=True)
+        ## lookup, then one update each for the user and profile.
+        with self.assertNumQueries(5):
+            user = self.login()
+        user = get_user_model()._default_manager.get(pk=user.pk)
+        self.assertTrue(user.is_superuser and user.is_staff)
+        self.assertTrue(user.fogbugzprofile.is_administrator)
+        self.assertFalse(user.fogbugzprofile.is_normal)
+
+    def test_missing_profile(self):
+        self.login()
+        FogBugzProfile.objects.all().delete()
+        with self.assertNumQueries(5):
+            user = self.login()
+        self.assertTrue(FogBugzProfile.objects.filter(user=user).exists())
+
+    @override_settings(AUTH_FOGBUGZ_ENABLE_PROFILE=False)
+    def test_unchanged_user_without_profile(self):
+        self.login()
+        with self.assertNumQueries(1):
+            self.login()
+
+    def test_profile_email_lookup(self):
+        user = self.login()
+        self.assertEqual(user.fogbugzprofile.email, 'joe@example.com')
+        ## the indexed profile e-mail is used, whatever the user's case.
+        get_user_model()._default_manager.filter(pk=user.pk).update(
+            email='JOE@EXAMPLE.COM')
+        with self.assertNumQueries(1):
+            self.assertEqual(self.login().pk, user.pk)
+
+    @override_settings(AUTH_FOGBUGZ_AUTO_CREATE_USERS=False)
+    def test_hand_created_user(self):
+        user = get_user_model()._default_manager.create(
+            username='joe', email='Joe@Example.com')
+        self.assertEqual(self.login().pk, user.pk)
+        self.assertEqual(FogBugzProfile.objects.get(user=user).email,
+                         'joe@example.com')
+        ## the profile is found from then on, without the e-mail scan.
+        with self.assertNumQueries(1):
+            self.assertEqual(self.login().pk, user.pk)
+
+    def test_get_user_by_ixPerson(self):
+        user = self.login()
+        self.assertEqual(self.backend.get_user_by_ixPerson(7).pk, user.pk)
+        self.assertEqual(self.backend.get_user_by_ixPerson(8), None)
+
+
+class AppConfigTests(TestCase):
+
+    @override_settings(AUTH_FOGBUGZ_SERVER='not a url')
+    def test_bad_server(self):
+        config = apps.get_app_config('django_auth_fogbugz')
+        self.assertRaises(ImproperlyConfigured, config.ready)
+
+    def test_ready(self):
+        apps.get_app_config('django_auth_fogbugz').ready()
+        self.assertTrue(get_settings().SERVER)
+
+
+@override_settings(AUTH_FOGBUGZ_SERVER='http://fogbugz.example.com/',
+                   AUTH_FOGBUGZ_AUTO_CREATE_USERS=True,
+                   AUTH_FOGBUGZ_ENABLE_PROFILE=True,
+                   AUTH_FOGBUGZ_MAP_ADMIN_AS_STAFF=False,
+                   AUTH_FOGBUGZ_MAP_ADMIN_AS_SUPER=False,
+                   AUTH_FOGBUGZ_ROLE_PERMISSIONS={
+                       'administrator': ['auth.change_user', 'auth.view_user'],
+                       'normal': ['auth.view_user']})
+class RolePermissionsTests(TestCase):
+
+    def setUp(self):
+        get_cache().clear()
+        self.backend = FogBugzBackend()
+
+    def login(self, **kwargs):
+        with mock.patch.object(FogBugzBackend, '_fogbugz_logon',
+                               return_value=(None, _person(**kwargs))):
+            with self.captureOnCommitCallbacks(execute=True):
+                user = self.backend.authenticate(username='joe@example.com',
+                                                 password='secret')
+        ## a fresh instance, as the next request would load it.
+        return get_user_model()._default_manager.get(pk=user.pk)
+
+    def test_role_permissions(self):
+        user = self.login()
+        ## the ModelBackend user and group permissions, then the role
+        ## permissions from the profile, once for all checks.
+        with self.assertNumQueries(3):
+            self.assertTrue(self.backend.has_perm(user, 'auth.view_user'))
+            self.assertFalse(self.backend.has_perm(user, 'auth.change_user'))
+        user = get_user_model()._default_manager.get(pk=user.pk)
+        with self.assertNumQueries(2):
+            self.assertTrue(self.backend.has_perm(user, 'auth.view_user'))
+
+    def test_role_change(self):
+        user = self.login()
+        self.assertFalse(self.backend.has_perm(user, 'auth.change_user'))
+        user = self.login(admin=True)
+        self.assertEqual(user.fogbugzprofile.permissions,
+                         'auth.change_user auth.view_user')
+        self.assertTrue(self.backend.has_perm(user, 'auth.change_user'))
+
+    def test_community(self):
+        with override_settings(AUTH_FOGBUGZ_ALLOW_COMMUNITY=True):
+            user = self.login(community=True)
+        self.assertEqual(self.backend.get_all_permissions(user), set())
+
+    @override_settings(AUTH_FOGBUGZ_ROLE_PERMISSIONS=None)
+    def test_disabled(self):
+        user = self.login()
+        self.assertEqual(user.fogbugzprofile.permissions, '')
+        self.assertFalse(self.backend.has_perm(user, 'auth.view_user'))
+
+
+@override_settings(AUTH_FOGBUGZ_SERVER='http://fogbugz.example.com/',
+                   AUTH_FOGBUGZ_AUTO_CREATE_USERS=True,
+                   AUTH_FOGBUGZ_ENABLE_PROFILE=True,
+                   AUTH_FOGBUGZ_OFFLINE_LOGIN_TTL=3600)
+class OfflineLoginTests(TestCase):
+
+    def login(self, password='secret', offline=False):
+        if offline:
+            patch = dict(side_effect=fogbugz.FogBugzConnectionError('down'))
+        else:
+            patch = dict(return_value=(mock.Mock(_token='t'), _person()))
+        with mock.patch.object(FogBugzBackend, '_fogbugz_logon', **patch):
+            return FogBugzBackend().authenticate(username='joe@example.com',
+                                                 password=password)
+
+    def test_offline_login(self):
+        user = self.login()
+        profile = FogBugzProfile.objects.get(user=user)
+        self.assertTrue(profile.offline_verifier)
+        self.assertNotEqual(profile.offline_verifier, 'secret')
+        self.assertEqual(self.login(offline=True).pk, user.pk)
+        self.assertEqual(self.login('wrong', offline=True), None)
+
+    def test_verifier_kept(self):
+        self.login()
+        ## a verifier which is not about to expire is neither checked nor
+        ## written.
+        with mock.patch('django_auth_fogbugz.backend.make_password') as make, \
+             mock.patch('django_auth_fogbugz.backend.check_password') as check:
+            with self.assertNumQueries(1):
+                self.login()
+        self.assertFalse(make.called or check.called)
+
+    def test_verifier_refreshed(self):
+        user = self.login()
+        expires = timezone.now() + datetime.timedelta(seconds=600)
+        FogBugzProfile.objects.filter(user=user).update(
+            offline_expires=expires)
+        verifier = FogBugzProfile.objects.get(user=user).offline_verifier
+        self.login('changed')
+        profile = FogBugzProfile.objects.get(user=user)
+        self.assertNotEqual(profile.offline_verifier, verifier)
+        self.assertTrue(profile.offline_expires > expires)
+        self.assertEqual(self.login('secret', offline=True), None)
+        self.assertEqual(self.login('changed', offline=True).pk, user.pk)
+
+    def test_expired_verifier(self):
+        user = self.login()
+        FogBugzProfile.objects.filter(user=user).update(
+            offline_expires=timezone.now() - datetime.timedelta(seconds=1))
+        self.assertEqual(self.login(offline=True), None)
+
+    def test_community_flag(self):
+        user = self.login()
+        FogBugzProfile.objects.filter(user=user).update(is_community=True)
+        self.assertEqual(self.login(offline=True), None)
+
+    @override_settings(AUTH_FOGBUGZ_OFFLINE_LOGIN_TTL=0)
+    def test_disabled(self):
+        self.login()
+        self.assertEqual(self.login(offline=True), None)
+
+
+class CircuitBreakerTests(TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('django_auth_fogbugz.breaker.time.time',
+                             lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker(threshold=0.5, min_calls=4, window=60,
+                                      open_time=30)
+
+    def test_opens_on_error_rate(self):
+        for success in (True, False, True):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record(success)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertTrue(self.breaker.is_open())
+        self.assertFalse(self.breaker.allow())
+
+    def test_old_failures_expire(self):
+        for i in range(3):
+            self.breaker.record(False)
+        self.now += 61
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_probe(self):
+        for i in range(4):
+            self.breaker.record(False)
+        self.now += 31
+        self.assertFalse(self.breaker.is_open())
+        ## one probe at a time.
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record(False)
+        self.assertTrue(self.breaker.is_open())
+        self.now += 31
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record(True)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    @override_settings(AUTH_FOGBUGZ_SERVER='http://fogbugz.example.com/',
+                       AUTH_FOGBUGZ_BREAKER_THRESHOLD=0.5)
+    def test_backend_fails_fast(self):
+        with mock.patch('django_auth_fogbugz.breaker.is_open',
+                        return_value=True):
+            with mock.patch.object(FogBugzBackend,
+                                   '_fogbugz_logon') as logon:
+                with self.assertNumQueries(0):
+                    self.assertEqual(FogBugzBackend().authenticate(
+                        username='joe@example.com', password='secret'), None)
+        self.assertFalse(logon.called)
+
+
+class ConcurrencyLimiterTests(TestCase):
+
+    def test_limit_and_queue(self):
+        limiter = ConcurrencyLimiter(2, queue_size=1, timeout=0.05)
+        permits = [limiter.acquire(), limiter.acquire()]
+        self.assertTrue(all(permits))
+        ## waits in the queue, then times out.
+        self.assertEqual(limiter.acquire(), None)
+        limiter.release(permits.pop())
+        self.assertTrue(limiter.acquire())
+        stats = limiter.stats()
+        self.assertEqual(stats['in_flight'], 2)
+        self.assertEqual(stats['acquired'], 3)
+        self.assertEqual(stats['timed_out'], 1)
+
+    def test_full_queue(self):
+        limiter = ConcurrencyLimiter(1, queue_size=0, timeout=5)
+        self.assertTrue(limiter.acquire())
+        self.assertEqual(limiter.acquire(), None)
+        self.assertEqual(limiter.stats()['rejected'], 1)
+
+    def test_queued_waiter_gets_released_permit(self):
+        import threading
+        limiter = ConcurrencyLimiter(1, queue_size=1, timeout=5)
+        permit = limiter.acquire()
+        result = []
+        waiter = threading.Thread(
+            target=lambda: result.append(limiter.acquire()))
+        waiter.start()
+        while not limiter.queued:
+            pass
+        limiter.release(permit)
+        waiter.join()
+        self.assertTrue(result[0])
+        self.assertEqual(limiter.stats()['waited'], 1)
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'django_auth_fogbugz_tests'}})
+    def test_global_slots(self):
+        first = GlobalConcurrencyLimiter(1, timeout=0.05, name='a')
+        second = GlobalConcurrencyLimiter(1, timeout=0.05, name='a')
+        permit = first.acquire()
+        self.assertTrue(permit)
+        ## another process sharing the cache has to wait for the slot.
+        self.assertEqual(second.acquire(), None)
+        first.release(permit)
+        self.assertTrue(second.acquire())
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'django_auth_fogbugz_tests'}})
+class LeaseTests(TestCase):
+
+    def setUp(self):
+        get_cache().clear()
+
+    def test_waiter_gets_result(self):
+        holder, waiter = Lease('k', 5), Lease('k', 5)
+        self.assertTrue(holder.acquire())
+        self.assertFalse(waiter.acquire())
+        holder.release(42)
+        self.assertEqual(waiter.wait(), (True, 42))
+
+    def test_stale_result_dropped(self):
+        Lease('k', 5).release(42)
+        lease = Lease('k', 5)
+        self.assertTrue(lease.acquire())
+        self.assertEqual(get_cache().get(lease.result_key), None)
+
+    def test_result_timeout(self):
+        lease = Lease('k', 60)
+        lease.acquire()
+        with mock.patch('django_auth_fogbugz.singleflight.get_cache') as cache:
+            lease.release(42)
+        cache.return_value.set.assert_called_once_with(
+            lease.result_key, 42, Lease.result_timeout)
+
+
+@override_settings(AUTH_FOGBUGZ_SERVER='http://fogbugz.example.com/',
+                   AUTH_FOGBUGZ_AUTO_CREATE_USERS=True,
+                   AUTH_FOGBUGZ_METRICS_SINK=
+                       'django_auth_fogbugz.tests._sink')
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        del _reported[:]
+
+    def login(self, **patch):
+        patch.setdefault('return_value', (None, _person()))
+        with mock.patch.object(FogBugzBackend, '_fogbugz_logon', **patch):
+            return FogBugzBackend().authenticate(username='joe@example.com',
+                                                 password='secret')
+
+    def test_success(self):
+        self.login()
+        self.assertEqual(_reported, [('lookup', {}), ('save', {}),
+                                     ('logoff', {}),
+                                     ('login', {'outcome': 'success'})])
+
+    def test_outcomes(self):
+        self.login(side_effect=fogbugz.FogBugzConnectionError('down'))
+        self.assertEqual(_reported[-1],
+                         ('login', {'outcome': 'connection_error'}))
+        self.login(return_value=(None, _person(community=True)))
+        self.assertEqual(_reported[-1],
+                         ('login', {'outcome': 'community_rejected'}))
+        with override_settings(AUTH_FOGBUGZ_AUTO_CREATE_USERS=False):
+            self.login()
+        self.assertEqual(_reported[-1], ('login', {'outcome': 'no_user'}))
+
+    def test_signal(self):
+        received = []
+        def receiver(sender, **kwargs):
+            received.append((kwargs['username'], kwargs['outcome']))
+        login_timed.connect(receiver)
+        self.addCleanup(login_timed.disconnect, receiver)
+        self.login()
+        self.assertEqual(received, [('joe@example.com', 'success')])
+
+
+class LogoffQueueTests(TestCase):
+
+    def logoff(self, *errors):
+        client = mock.Mock()
+        client.return_value.logoff.side_effect = list(errors) + [None]
+        logoff_queue = LogoffQueue(workers=0, retries=2)
+        with mock.patch('django_auth_fogbugz.client.FogBugzClient', client), \
+             mock.patch('django_auth_fogbugz.logoff.time.sleep') as sleep:
+            logoff_queue._logoff('http://fogbugz.example.com/', 'abc', 'joe')
+        return client.return_value.logoff.call_count, sleep.call_count
+
+    def test_retry(self):
+        error = fogbugz.FogBugzConnectionError('down')
+        self.assertEqual(self.logoff(error), (2, 1))
+
+    def test_no_sleep_after_last_attempt(self):
+        error = fogbugz.FogBugzConnectionError('down')
+        self.assertEqual(self.logoff(error, error, error), (3, 2))
+
+    def test_api_error_not_retried(self):
+        self.assertEqual(self.logoff(fogbugz.FogBugzAPIError('gone')), (1, 0))
+
+
+def _http_response(body, chunked=False):
+    if not chunked:
+        return (b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' %
+                len(body)) + body
+    chunks = b''.join(b'%x\r\n%s\r\n' % (len(body[i:i + 7]), body[i:i + 7])
+                      for i in range(0, len(body), 7))
+    return (b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n' +
+            chunks + b'0\r\n\r\n')
+
+async def _raw_server(responses, per_connection=0):
+    """
+    Serve the raw HTTP ``responses`` in turn, closing each connection after
+    ``per_connection`` requests (``0`` keeps it open).
+    """
+    connections = []
+
+    async def handle(reader, writer):
+        connections.append(writer)
+        served = 0
+        try:
+            while not per_connection or served < per_connection:
+                head = await reader.readuntil(b'\r\n\r\n')
+                length = int(head.lower().split(b'content-length:')[1]
+                             .split(b'\r\n')[0])
+                await reader.readexactly(length)
+                writer.write(responses.pop(0))
+                await writer.drain()
+                served += 1
+        except asyncio.IncompleteReadError:
+            pass
+        writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    url = 'http://127.0.0.1:%d/' % server.sockets[0].getsockname()[1]
+    return server, url, connections
+
+
+class AsyncClientTests(TestCase):
+    """
+    The asyncio FogBugz client and helpers, see :mod:`.aio`.
+    """
+    async def request(self, responses, per_connection=0, calls=1):
+        server, url, connections = await _raw_server(responses,
+                                                     per_connection)
+        client = AsyncFogBugzClient(url)
+        client._api_url = url + 'api.asp?'
+        try:
+            results = [await client.request('viewPerson')
+                       for n in range(calls)]
+        finally:
+            await client.close()
+            server.close()
+            await server.wait_closed()
+        return results, len(connections)
+
+    async def test_keep_alive(self):
+        body = b'<response><token>abc</token></response>'
+        results, connections = await self.request(
+            [_http_response(body), _http_response(body)], calls=2)
+        self.assertEqual([r.findtext('token') for r in results],
+                         ['abc', 'abc'])
+        self.assertEqual(connections, 1)
+
+    async def test_chunked(self):
+        results, connections = await self.request([_http_response(
+            b'<response><person><ixPerson>7</ixPerson></person></response>',
+            chunked=True)])
+        self.assertEqual(results[0].findtext('person/ixPerson'), '7')
+
+    async def test_stale_connection_retried(self):
+        body = b'<response><token>abc</token></response>'
+        ## the server drops each connection after one request.
+        results, connections = await self.request(
+            [_http_response(body), _http_response(body, chunked=True)],
+            per_connection=1, calls=2)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(connections, 2)
+
+    async def test_api_error(self):
+        with self.assertRaises(fogbugz.FogBugzAPIError):
+            await self.request([_http_response(
+                b'<response><error code="3">Not logged on</error>'
+                b'</response>')])
+
+    async def test_group(self):
+        calls = []
+
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 42
+
+        group = AsyncGroup()
+        results = await asyncio.gather(group.do('k', work),
+                                       group.do('k', work))
+        self.assertEqual(sorted(results), [(42, False), (42, True)])
+        self.assertEqual(len(calls), 1)
+
+    async def test_aacquire(self):
+        limiter = ConcurrencyLimiter(1, queue_size=1, timeout=5)
+        permit = limiter.acquire()
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.1, limiter.release, permit)
+        self.assertTrue(await aacquire(limiter))
+        self.assertEqual(limiter.stats()['waited'], 1)
+        ## no room in the queue.
+        full = ConcurrencyLimiter(1, queue_size=0, timeout=5)
+        full.acquire()
+        self.assertEqual(await aacquire(full), None)
+
+
+class ResponseParsingTests(TestCase):
+
+    def test_person(self):
+        person = parse_person(BytesIO(
+            b'<?xml version="1.0" encoding="UTF-8"?><response><person>'
+            b'<ixPerson>7</ixPerson><sFullName><![CDATA[Jo\xc3\xab User]]>'
+            b'</sFullName><sEmail>joe@example.com</sEmail>'
+            b'<fAdministrator>true</fAdministrator>'
+            b'<fCommunity>false</fCommunity><sPhone>555</sPhone>'
+            b'</person></response>'))
+        self.assertEqual(person, _person(fullname=u'Jo\xeb User',
+                                         admin=True))
+        self.assertFalse(person.deleted)
+
+    def test_lower_case_tags(self):
+        person = parse_person(BytesIO(
+            b'<response><person><ixperson>3</ixperson>'
+            b'<fcommunity>true</fcommunity></person></response>'))
+        self.assertEqual((person.ixPerson, person.community), (3, True))
+
+    def test_people_tag_case(self):
+        people = list(iter_people(BytesIO(
+            b'<response><people><Person><ixPerson>3</ixPerson></Person>'
+            b'<person><ixPerson>4</ixPerson></person></people></response>')))
+        self.assertEqual([p.ixPerson for p in people], [3, 4])
+
+    def test_error(self):
+        self.assertRaises(fogbugz.FogBugzAPIError, parse_person, BytesIO(
+            b'<response><error code="3">Not logged on</error></response>'))
+
+    def test_token(self):
+        fields = parse_fields(BytesIO(
+            b'<response><token><![CDATA[abc]]></token></response>'),
+            ('token',), 'token')
+        self.assertEqual(fields, dict(token='abc'))
+
+
+class MockServerLoginTests(TestCase):
+    """
+    Logins through the real FogBugz client, against the mock server.
+    """
+    @classmethod
+    def setUpClass(cls):
+        super(MockServerLoginTests, cls).setUpClass()
+        cls.server = MockFogBugzServer([
+            Person(1, 'admin@example.com', 'secret', admin=True),
+            Person(2, 'joe@example.com', 'secret', fullname='Joe User',
+                   ldap_username='joe'),
+            Person(3, 'customer@example.com', 'secret', community=True),
+        ]).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        super(MockServerLoginTests, cls).tearDownClass()
+
+    def setUp(self):
+        self.server.error_rate = 0
+        self.server.calls.clear()
+        self.server.tokens.clear()
+        get_cache().clear()
+        overrides = override_settings(
+            AUTH_FOGBUGZ_SERVER=self.server.url,
+            AUTH_FOGBUGZ_AUTO_CREATE_USERS=True,
+            AUTH_FOGBUGZ_ENABLE_PROFILE=True,
+            AUTH_FOGBUGZ_MAP_ADMIN_AS_STAFF=True)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def login(self, username, password='secret'):
+        return FogBugzBackend().authenticate(username=username,
+                                             password=password)
+
+    def test_login(self):
+        user = self.login('Joe@Example.com')
+        self.assertEqual(user.username, 'joe@example.com')
+        self.assertEqual(user.first_name, 'Joe User')
+        self.assertEqual(user.fogbugzprofile.ixPerson, 2)
+        self.assertTrue(user.fogbugzprofile.is_normal)
+        ## the token was logged off.
+        self.assertEqual(self.server.tokens, {})
+        with self.assertNumQueries(1):
+            self.assertEqual(self.login('joe@example.com').pk, user.pk)
+
+    def test_admin(self):
+        user = self.login('admin@example.com')
+        self.assertTrue(user.is_staff)
+        self.assertTrue(user.fogbugzprofile.is_administrator)
+
+    def test_bad_password(self):
+        self.assertEqual(self.login('joe@example.com', 'wrong'), None)
+
+    def test_community(self):
+        self.assertEqual(self.login('customer@example.com'), None)
+        with override_settings(AUTH_FOGBUGZ_ALLOW_COMMUNITY=True):
+            self.assertTrue(self.login('customer@example.com')
+                            .fogbugzprofile.is_community)
+
+    @override_settings(AUTH_FOGBUGZ_CREDENTIAL_CACHE_TTL=60,
+                       AUTH_FOGBUGZ_MAP_ADMIN_AS_SUPER=True)
+    def test_credential_cache_keeps_stored_flags(self):
+        user = self.login('admin@example.com')
+        self.assertTrue(user.is_superuser)
+        ## demoted by a sync since the password was cached.
+        get_user_model()._default_manager.filter(pk=user.pk).update(
+            is_superuser=False)
+        FogBugzProfile.objects.filter(pk=user.pk).update(
+            is_administrator=False, is_normal=True)
+        user = self.login('admin@example.com')
+        self.assertFalse(user.is_superuser)
+        self.assertFalse(user._fogbugz_person.admin)
+        self.assertFalse(FogBugzProfile.objects.get(pk=user.pk)
+                         .is_administrator)
+        FogBugzProfile.objects.filter(pk=user.pk).update(is_community=True)
+        self.assertEqual(self.login('admin@example.com'), None)
+        self.assertEqual(self.server.calls['logon'], 1)
+
+    @override_settings(AUTH_FOGBUGZ_FAILED_LOGON_CACHE_TTL=60)
+    def test_failed_logon_cache(self):
+        self.assertEqual(self.login('joe@example.com', 'wrong'), None)
+        self.assertEqual(self.login('joe@example.com', 'wrong'), None)
+        self.assertEqual(self.server.calls['logon'], 1)
+        self.assertTrue(self.login('joe@example.com'))
+        ## community users are turned away whatever the password.
+        self.assertEqual(self.login('customer@example.com'), None)
+        self.assertEqual(self.login('customer@example.com', 'other'), None)
+        self.assertEqual(self.server.calls['logon'], 3)
+        self.assertEqual(self.server.calls['viewPerson'], 2)
+
+    @override_settings(AUTH_FOGBUGZ_THROTTLE_LIMIT=2)
+    def test_throttle(self):
+        request = mock.Mock(META={'REMOTE_ADDR': '10.0.0.1'})
+        for password in ('wrong1', 'wrong2', 'secret'):
+            self.assertEqual(FogBugzBackend().authenticate(
+                request, username='joe@example.com', password=password), None)
+        self.assertEqual(self.server.calls['logon'], 2)
+        ## the client is throttled for other users too.
+        self.assertEqual(FogBugzBackend().authenticate(
+            request, username='admin@example.com', password='secret'), None)
+        self.assertTrue(self.login('admin@example.com'))
+
+    @override_settings(AUTH_FOGBUGZ_SERVER_USES_LDAP=True)
+    def test_ldap(self):
+        user = self.login('DOMAIN\\joe')
+        self.assertEqual(user.username, 'joe')
+        self.assertEqual(user.email, 'joe@example.com')
+
+    @override_settings(AUTH_FOGBUGZ_ENABLE_PROFILE_TOKEN=True,
+                       AUTH_FOGBUGZ_DEFER_LOGOFF=True)
+    def test_deferred_logoff_same_token(self):
+        self.server.reuse_tokens = True
+        self.addCleanup(setattr, self.server, 'reuse_tokens', False)
+        token = self.login('joe@example.com').fogbugzprofile.token
+        ## FogBugz hands back the stored token, it must not be queued for
+        ## logoff.
+        user = self.login('joe@example.com')
+        drain(5)
+        self.assertEqual(user.fogbugzprofile.token, token)
+        self.assertEqual(self.server.calls['logoff'], 0)
+        self.assertEqual(self.server.tokens.get(token), 2)
+
+    @override_settings(AUTH_FOGBUGZ_ENABLE_PROFILE_TOKEN=True,
+                       AUTH_FOGBUGZ_DEFER_LOGOFF=True)
+    def test_deferred_logoff_old_token(self):
+        token = self.login('joe@example.com').fogbugzprofile.token
+        user = self.login('joe@example.com')
+        drain(5)
+        self.assertNotEqual(user.fogbugzprofile.token, token)
+        self.assertEqual(self.server.calls['logoff'], 1)
+        self.assertFalse(token in self.server.tokens)
+
+    def test_view_person_error(self):
+        with mock.patch.object(FogBugzClient, 'view_person',
+                               side_effect=fogbugz.FogBugzAPIError('3')):
+            self.assertEqual(self.login('joe@example.com'), None)
+
+    def test_connection_reused(self):
+        reused = []
+        acquire = ConnectionPool.acquire
+
+        def record(pool):
+            conn, was_reused = acquire(pool)
+            reused.append(was_reused)
+            return conn, was_reused
+
+        with mock.patch.object(ConnectionPool, 'acquire', record):
+            self.login('joe@example.com')
+            first = len(reused)
+            self.login('joe@example.com')
+        ## the second logon does not open a new socket.
+        self.assertTrue(first)
+        self.assertTrue(all(reused[first:]))
+
+    def test_discovery_cached(self):
+        self.login('joe@example.com')
+        self.login('joe@example.com')
+        self.assertEqual(self.server.calls['api.xml'], 1)
+        ## another process finds it in the Django cache.
+        clear_discovery_cache()
+        self.login('joe@example.com')
+        self.assertEqual(self.server.calls['api.xml'], 1)
+
+    @override_settings(AUTH_FOGBUGZ_DISCOVERY_CACHE_TTL=0)
+    def test_discovery_uncached(self):
+        self.login('joe@example.com')
+        self.login('joe@example.com')
+        self.assertEqual(self.server.calls['api.xml'], 2)
+
+    @override_settings(AUTH_FOGBUGZ_ENABLE_PROFILE_TOKEN=True)
+    def test_get_client(self):
+        profile = self.login('joe@example.com').fogbugzprofile
+        fb = profile.get_client()
+        self.assertTrue(fb is profile.get_client())
+        self.assertEqual(fb.view_person().ixPerson, 2)
+        fb.logoff()
+        self.assertFalse(fb is profile.get_client())
+
+    @override_settings(AUTH_FOGBUGZ_ENABLE_PROFILE_TOKEN=True,
+                       AUTH_FOGBUGZ_REUSE_PROFILE_TOKEN=True)
+    def test_reuse_profile_token(self):
+        token = self.login('joe@example.com').fogbugzprofile.token
+        profile = self.login('joe@example.com').fogbugzprofile
+        ## the stored token is kept, the new logon's token is cleared.
+        self.assertEqual(profile.token, token)
+        self.assertEqual(self.server.calls['logoff'], 1)
+        self.assertEqual(list(self.server.tokens), [token])
+        ## a token FogBugz no longer accepts is replaced.
+        self.server.tokens.clear()
+        profile = self.login('joe@example.com').fogbugzprofile
+        self.assertNotEqual(profile.token, token)
+        self.assertEqual(list(self.server.tokens), [profile.token])
+
+    @override_settings(AUTH_FOGBUGZ_ENABLE_PROFILE_TOKEN=True)
+    def test_revalidate_tokens(self):
+        joe = self.login('joe@example.com')
+        admin = self.login('admin@example.com')
+        ## joe is logged off by FogBugz, and admin demoted.
+        del self.server.tokens[joe.fogbugzprofile.token]
+        self.server.people[1].admin = False
+        self.addCleanup(setattr, self.server.people[1], 'admin', True)
+        revalidator = TokenRevalidator(get_settings(), batch_size=1,
+                                       workers=2)
+        stats = revalidator.run()
+        self.assertEqual(stats, dict(checked=2, valid=1, cleared=1,
+                                     updated=1, errors=0))
+        joe = FogBugzProfile.objects.get(pk=joe.pk)
+        admin = FogBugzProfile.objects.get(pk=admin.pk)
+        self.assertEqual(joe.token, '')
+        self.assertTrue(admin.token)
+        self.assertFalse(admin.is_administrator)
+        self.assertTrue(admin.is_normal)
+
+    def test_refresh_people(self):
+        admin = self.login('admin@example.com')
+        self.server.people[1].admin = False
+        self.addCleanup(setattr, self.server.people[1], 'admin', True)
+        fb = FogBugzClient(self.server.url)
+        fb.logon('joe@example.com', 'secret')
+        with override_settings(AUTH_FOGBUGZ_SYNC_TOKEN=fb._token):
+            stats = refresh_people(get_settings(), set([1, 3, 99]))
+        self.assertEqual((stats['updated'], stats['skipped']), (1, 2))
+        self.assertFalse(FogBugzProfile.objects.get(
+            pk=admin.pk).is_administrator)
+
+    @override_settings(AUTH_FOGBUGZ_ENABLE_PROFILE_TOKEN=True)
+    def test_refresh_revokes(self):
+        admin = self.login('admin@example.com')
+        joe = self.login('joe@example.com')
+        self.assertTrue(admin.is_staff)
+        self.server.people[1].community = True
+        self.addCleanup(setattr, self.server.people[1], 'community', False)
+        self.server.people[2].deleted = True
+        self.addCleanup(setattr, self.server.people[2], 'deleted', False)
+        fb = FogBugzClient(self.server.url)
+        fb.logon('customer@example.com', 'secret')
+        token = joe.fogbugzprofile.token
+        backend = FogBugzTokenBackend()
+        self.assertEqual(backend.authenticate(fogbugz_token=token), joe)
+        with override_settings(AUTH_FOGBUGZ_SYNC_TOKEN=fb._token):
+            with self.captureOnCommitCallbacks(execute=True):
+                stats = refresh_people(get_settings(), set([1, 2]))
+        self.assertEqual(stats['updated'], 2)
+        admin = get_user_model()._default_manager.get(pk=admin.pk)
+        self.assertFalse(admin.is_staff)
+        self.assertTrue(admin.is_active)
+        self.assertTrue(admin.fogbugzprofile.is_community)
+        self.assertFalse(get_user_model()._default_manager.get(
+            pk=joe.pk).is_active)
+        self.assertEqual(backend.authenticate(fogbugz_token=token), None)
+
+    @override_settings(AUTH_FOGBUGZ_NOTIFY_SECRET='s3cret',
+                       AUTH_FOGBUGZ_SYNC_TOKEN='token',
+                       ROOT_URLCONF='django_auth_fogbugz.urls')
+    def test_notification_view(self):
+        url = '/person-changed/'
+        now = int(time.time())
+        params = {'ixPerson': '1,2', 'ts': str(now),
+                  'sig': sign('s3cret', '1,2', now)}
+        with mock.patch('django_auth_fogbugz.notify.queue_refresh',
+                        return_value=True) as queue_refresh:
+            response = self.client.post(url, params)
+            self.assertEqual(response.status_code, 202)
+            queue_refresh.assert_called_once_with(set([1, 2]))
+            ## replayed.
+            self.assertEqual(self.client.post(url, params).status_code, 403)
+            response = self.client.get(url, {
+                'ixPerson': '1', 'ts': str(now),
+                'sig': sign('wrong', '1', now)})
+            self.assertEqual(response.status_code, 403)
+            ## stale.
+            response = self.client.get(url, {
+                'ixPerson': '1', 'ts': str(now - 600),
+                'sig': sign('s3cret', '1', now - 600)})
+            self.assertEqual(response.status_code, 403)
+            with override_settings(AUTH_FOGBUGZ_NOTIFY_SECRET=None):
+                self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(queue_refresh.call_count, 1)
+
+    def test_refresh_queue_coalesces(self):
+        with mock.patch('django_auth_fogbugz.notify.refresh_people') as refresh:
+            refresh_queue = RefreshQueue(delay=1)
+            refresh_queue.submit([1])
+            refresh_queue.submit([2, 1])
+            refresh_queue.drain(5)
+        self.assertEqual(refresh.call_count, 1)
+        self.assertEqual(refresh.call_args[0][1], set([1, 2]))
+
+    @override_settings(AUTH_FOGBUGZ_ENABLE_PROFILE_TOKEN=True,
+                       AUTHENTICATION_BACKENDS=[
+                           'django_auth_fogbugz.backend.FogBugzBackend',
+                           'django_auth_fogbugz.backend.FogBugzTokenBackend'])
+    def test_token_middleware(self):
+        joe = self.login('joe@example.com')
+        self.login('admin@example.com')
+        fb = FogBugzClient(self.server.url)
+        fb.logon('admin@example.com', 'secret')
+        middleware = FogBugzTokenMiddleware(lambda request: None)
+
+        def request_user(token, address='127.0.0.1'):
+            request = RequestFactory().get('/', HTTP_X_FOGBUGZ_TOKEN=token,
+                                           REMOTE_ADDR=address)
+            request.user = AnonymousUser()
+            middleware.process_request(request)
+            return request.user
+
+        ## the indexed token lookup, then the cached user.
+        with self.assertNumQueries(1):
+            self.assertEqual(request_user(joe.fogbugzprofile.token), joe)
+        with self.assertNumQueries(0):
+            self.assertEqual(request_user(joe.fogbugzprofile.token), joe)
+        ## a token not stored in a profile is checked with FogBugz once.
+        self.assertEqual(request_user(fb._token).username,
+                         'admin@example.com')
+        self.assertEqual(request_user(fb._token).username,
+                         'admin@example.com')
+        self.assertFalse(request_user('bad').is_authenticated)
+        self.assertFalse(request_user('bad').is_authenticated)
+        self.assertEqual(self.server.calls['viewPerson'], 4)
+        ## logged off tokens are dropped from the cache.
+        FogBugzClient(self.server.url, joe.fogbugzprofile.token).logoff()
+        FogBugzProfile.objects.filter(pk=joe.pk).update(token='')
+        self.assertFalse(request_user(
+            joe.fogbugzprofile.token).is_authenticated)
+
+    @override_settings(AUTH_FOGBUGZ_ENABLE_PROFILE_TOKEN=True,
+                       AUTHENTICATION_BACKENDS=[
+                           'django_auth_fogbugz.backend.FogBugzBackend',
+                           'django_auth_fogbugz.backend.FogBugzTokenBackend'])
+    def test_token_user_changes(self):
+        user = self.login('joe@example.com')
+        token = user.fogbugzprofile.token
+        middleware = FogBugzTokenMiddleware(lambda request: None)
+
+        def request_user():
+            request = RequestFactory().get('/', HTTP_X_FOGBUGZ_TOKEN=token)
+            request.user = AnonymousUser()
+            middleware.process_request(request)
+            return request.user
+
+        self.assertFalse(request_user().is_staff)
+        with self.assertNumQueries(0):
+            request_user()
+        user.is_staff = True
+        with self.captureOnCommitCallbacks(execute=True):
+            user.save()
+        self.assertTrue(request_user().is_staff)
+        ## bulk writes send no signals.
+        user.is_staff = False
+        with self.captureOnCommitCallbacks(execute=True):
+            get_user_model()._default_manager.bulk_update([user],
+                                                          ['is_staff'])
+            forget_users([user])
+        self.assertFalse(request_user().is_staff)
+        profile = FogBugzProfile.objects.get(pk=user.pk)
+        profile.is_community = True
+        with self.captureOnCommitCallbacks(execute=True):
+            profile.save()
+        self.assertFalse(request_user().is_authenticated)
+
+    @override_settings(AUTH_FOGBUGZ_ENABLE_PROFILE_TOKEN=True,
+                       AUTH_FOGBUGZ_THROTTLE_LIMIT=2,
+                       AUTH_FOGBUGZ_TOKEN_CACHE_SIZE=1)
+    def test_unknown_tokens(self):
+        backend = FogBugzTokenBackend()
+        user = self.login('joe@example.com')
+        token = user.fogbugzprofile.token
+        self.server.calls.clear()
+
+        def authenticate(token, address='10.0.0.1'):
+            request = RequestFactory().get('/', REMOTE_ADDR=address)
+            return backend.authenticate(request, fogbugz_token=token)
+
+        self.assertEqual(authenticate(token).pk, user.pk)
+        self.assertEqual(authenticate('bad1'), None)
+        self.assertEqual(authenticate('bad1'), None)
+        self.assertEqual(self.server.calls['viewPerson'], 1)
+        ## unknown tokens do not push out the tokens in use.
+        with self.assertNumQueries(0):
+            self.assertEqual(authenticate(token).pk, user.pk)
+        ## the client is throttled after two unknown tokens.
+        self.assertEqual(authenticate('bad2'), None)
+        self.assertEqual(authenticate('bad3'), None)
+        self.assertEqual(self.server.calls['viewPerson'], 2)
+        self.assertEqual(authenticate('bad3', '10.0.0.2'), None)
+        self.assertEqual(self.server.calls['viewPerson'], 3)
+
+    def test_person_middleware(self):
+        user = self.login('joe@example.com')
+        middleware = FogBugzPersonMiddleware(lambda request: None)
+
+        def request_person(user, session):
+            request = RequestFactory().get('/')
+            request.user = user
+            request.session = session
+            middleware.process_request(request)
+            return request.fogbugz_person
+
+        session = {}
+        request = RequestFactory().get('/')
+        request.session = session
+        user_logged_in.send(sender=user.__class__, request=request,
+                            user=user)
+        user = get_user_model()._default_manager.get(pk=user.pk)
+        ## kept in the session at login.
+        with self.assertNumQueries(0):
+            person = request_person(user, session)
+            self.assertEqual((person.ixPerson, person.fullname),
+                             (2, 'Joe User'))
+        ## otherwise built from the profile once, then cached.
+        with self.assertNumQueries(1):
+            self.assertEqual(request_person(user, {}).email,
+                             'joe@example.com')
+        user = get_user_model()._default_manager.get(pk=user.pk)
+        with self.assertNumQueries(0):
+            self.assertFalse(request_person(user, {}).admin)
+        self.assertFalse(request_person(AnonymousUser(), {}))
+
+    def test_person_changes(self):
+        user = self.login('joe@example.com')
+        middleware = FogBugzPersonMiddleware(lambda request: None)
+
+        def request_person(session):
+            request = RequestFactory().get('/')
+            request.user = user
+            request.session = session
+            middleware.process_request(request)
+            return request.fogbugz_person
+
+        session = {}
+        request = RequestFactory().get('/')
+        request.session = session
+        user_logged_in.send(sender=user.__class__, request=request,
+                            user=user)
+        self.assertFalse(request_person(session).admin)
+        self.assertFalse(request_person({}).admin)
+        ## made an administrator, e.g. by a sync.
+        profile = FogBugzProfile.objects.get(pk=user.pk)
+        profile.is_administrator = True
+        profile.is_normal = False
+        with self.captureOnCommitCallbacks(execute=True):
+            profile.save()
+        user = get_user_model()._default_manager.get(pk=user.pk)
+        self.assertTrue(request_person(session).admin)
+        self.assertTrue(request_person({}).admin)
+
+    def sync_users(self, *args):
+        fb = FogBugzClient(self.server.url)
+        fb.logon('admin@example.com', 'secret')
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('fogbugz_sync_users', '--token', fb._token, *args,
+                         stdout=StringIO())
+        return FogBugzSyncRun.objects.order_by('-pk')[0]
+
+    def test_sync_users(self):
+        UserModel = get_user_model()
+        out = StringIO()
+        fb = FogBugzClient(self.server.url)
+        fb.logon('admin@example.com', 'secret')
+        call_command('fogbugz_sync_users', '--token', fb._token, '--dry-run',
+                     stdout=out)
+        self.assertIn('Dry run: 2 created', out.getvalue())
+        self.assertFalse(UserModel._default_manager.exists())
+        self.assertFalse(FogBugzSyncRun.objects.exists())
+        ## only existing users are updated.
+        self.login('joe@example.com')
+        run = self.sync_users('--no-create')
+        self.assertEqual((run.created, run.skipped), (0, 2))
+        self.assertEqual(UserModel._default_manager.count(), 1)
+        run = self.sync_users('--full')
+        self.assertEqual((run.created, run.unchanged), (1, 1))
+        admin = UserModel._default_manager.get(username='admin@example.com')
+        self.assertTrue(admin.is_staff)
+        self.assertEqual(admin.fogbugzprofile.ixPerson, 1)
+
+    def test_sync_users_incremental(self):
+        run = self.sync_users()
+        self.assertEqual((run.created, run.updated, run.skipped), (2, 0, 1))
+        ## nothing changed, only the run itself is recorded.
+        with CaptureQueriesContext(connection) as queries:
+            run = self.sync_users()
+        self.assertEqual((run.created, run.updated, run.unchanged), (0, 0, 2))
+        writes = [q['sql'] for q in queries.captured_queries
+                  if not q['sql'].startswith('SELECT')]
+        self.assertEqual(len(writes), 1)
+        self.assertIn('INSERT INTO "django_auth_fogbugz_fogbugzsyncrun"',
+                      writes[0])
+        ## deleted in FogBugz.
+        self.server.people[2].deleted = True
+        self.addCleanup(setattr, self.server.people[2], 'deleted', False)
+        run = self.sync_users()
+        self.assertEqual((run.updated, run.unchanged), (1, 1))
+        self.assertFalse(get_user_model()._default_manager.get(
+            username='joe@example.com').is_active)
+        run = self.sync_users()
+        self.assertEqual((run.updated, run.unchanged), (0, 2))
+
+    def alogin(self, username, password='secret'):
+        return FogBugzBackend().aauthenticate(username=username,
+                                              password=password)
+
+    async def test_async_login(self):
+        user = await self.alogin('Joe@Example.com')
+        self.assertEqual(user.username, 'joe@example.com')
+        self.assertEqual(user._fogbugz_person.ixPerson, 2)
+        profile = await FogBugzProfile.objects.aget(user=user)
+        self.assertEqual(profile.email, 'joe@example.com')
+        ## the token was logged off.
+        self.assertEqual(self.server.tokens, {})
+        self.assertEqual((await self.alogin('joe@example.com')).pk, user.pk)
+
+    async def test_async_bad_password(self):
+        self.assertEqual(await self.alogin('joe@example.com', 'wrong'), None)
+        self.assertFalse(await get_user_model()._default_manager.aexists())
+
+    async def test_async_community(self):
+        self.assertEqual(await self.alogin('customer@example.com'), None)
+        self.assertEqual(self.server.calls['logoff'], 1)
+        self.assertFalse(await get_user_model()._default_manager.aexists())
+
+    @override_settings(AUTH_FOGBUGZ_COALESCE_LOGINS=True)
+    async def test_async_coalesced(self):
+        self.server.latency = 0.05
+        self.addCleanup(setattr, self.server, 'latency', 0)
+        first, second = await asyncio.gather(
+            self.alogin('joe@example.com'), self.alogin('joe@example.com'))
+        self.assertEqual(first.pk, second.pk)
+        self.assertFalse(first is second)
+        self.assertEqual(self.server.calls['logon'], 1)
+
+    @override_settings(AUTH_FOGBUGZ_ENABLE_PROFILE_TOKEN=True,
+                       AUTH_FOGBUGZ_REUSE_PROFILE_TOKEN=True)
+    async def test_async_reuse_profile_token(self):
+        user = await self.alogin('joe@example.com')
+        token = (await FogBugzProfile.objects.aget(user=user)).token
+        user = await self.alogin('joe@example.com')
+        self.assertEqual((await FogBugzProfile.objects.aget(user=user)).token,
+                         token)
+        self.assertEqual(self.server.calls['logoff'], 1)
+        self.assertEqual(list(self.server.tokens), [token])
+
+    @override_settings(AUTH_FOGBUGZ_ENABLE_PROFILE_TOKEN=True,
+                       AUTH_FOGBUGZ_DEFER_LOGOFF=True)
+    async def test_async_deferred_logoff_same_token(self):
+        self.server.reuse_tokens = True
+        self.addCleanup(setattr, self.server, 'reuse_tokens', False)
+        await self.alogin('joe@example.com')
+        self.assertNotEqual(await self.alogin('joe@example.com'), None)
+        drain(5)
+        self.assertEqual(self.server.calls['logoff'], 0)
+
+    def test_server_errors(self):
+        self.server.error_rate = 1
+        self.assertEqual(self.login('joe@example.com'), None)
+
+    def test_benchmark(self):
+        people = list(self.server.people.values())
+        result = run_logins(people, 6)
+        self.assertEqual(result.logins, 6)
+        self.assertEqual(result.failed, 2)
+        self.assertTrue(result.p50 <= result.p99)
+
+
+class ConcurrentLoginTests(TransactionTestCase):
+    """
+    Logins from several threads, each with its own database connection.
+    """
+    def setUp(self):
+        self.server = MockFogBugzServer([
+            Person(2, 'joe@example.com', 'secret')], latency=0.2).start()
+        self.addCleanup(self.server.stop)
+        get_cache().clear()
+        overrides = override_settings(
+            AUTH_FOGBUGZ_SERVER=self.server.url,
+            AUTH_FOGBUGZ_AUTO_CREATE_USERS=True,
+            AUTH_FOGBUGZ_ENABLE_PROFILE=True,
+            AUTH_FOGBUGZ_COALESCE_LOGINS=True)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def login(self, users):
+        from django.db import connection
+        try:
+            users.append(FogBugzBackend().authenticate(
+                username='joe@example.com', password='secret'))
+        finally:
+            connection.close()
+
+    def test_coalesced_logins(self):
+        import threading
+        pk = FogBugzBackend().authenticate(username='joe@example.com',
+                                           password='secret').pk
+        self.server.calls.clear()
+        users = []
+        threads = [threading.Thread(target=self.login, args=(users,))
+                   for n in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([user.pk for user in users], [pk] * 5)
+        self.assertEqual(self.server.calls['logon'], 1)
+        ## every caller got its own instance.
+        self.assertEqual(len(set(id(user) for user in users)), 5)
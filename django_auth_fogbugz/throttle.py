@@ -0,0 +1,161 @@
+# Copyright (c) 2012, Douglas Napoleone.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+#     3. Neither the name of Django nor the names of its contributors may be
+#        used to endorse or promote products derived from this software without
+#        specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Negative cache and throttling of failed FogBugz logons.
+
+Rejections by FogBugz (a bad password or unknown user, or a community user
+while ALLOW_COMMUNITY is off) are remembered in the AUTH_FOGBUGZ_CACHE_ALIAS
+cache, so repeats are turned away without contacting FogBugz:
+
+* the username and password pair, for FAILED_LOGON_CACHE_TTL seconds,
+* community users by ``ixPerson``, also for FAILED_LOGON_CACHE_TTL seconds,
+* the number of failures per username and per client address, limited to
+  THROTTLE_LIMIT in a sliding window of THROTTLE_WINDOW seconds. Unknown API
+  tokens (see :mod:`.tokens`) count as failures of the client address.
+
+The sliding window is approximated from two fixed windows, the previous
+one weighted by how much of it still overlaps the sliding window.
+"""
+
+import time
+
+from .cache import get_cache, make_key
+from .metrics import BAD_PASSWORD, COMMUNITY_REJECTED, THROTTLED
+from .singleflight import login_key
+
+## outcomes which count as a FogBugz rejection.
+REJECTIONS = (BAD_PASSWORD, COMMUNITY_REJECTED)
+
+def enabled(fbcfg):
+    return bool(fbcfg.FAILED_LOGON_CACHE_TTL or fbcfg.THROTTLE_LIMIT)
+
+def check(fbcfg, username, password, client=None):
+    """
+    Return the outcome to turn the login away with, or ``None`` if it may
+    go ahead.
+    """
+    cache = get_cache()
+    if fbcfg.FAILED_LOGON_CACHE_TTL:
+        keys = [_rejected_key(username, password),
+                make_key('community_user', username)]
+        found = cache.get_many(keys)
+        outcome = found.get(keys[0])
+        if outcome:
+            return outcome
+        ixPerson = found.get(keys[1])
+        if ixPerson is not None and cache.get(_community_key(ixPerson)):
+            return COMMUNITY_REJECTED
+
+    if fbcfg.THROTTLE_LIMIT:
+        now = time.time()
+        for kind, value in (('username', username), ('client', client)):
+            if value and _failures(cache, fbcfg.THROTTLE_WINDOW, kind, value,
+                                   now) >= fbcfg.THROTTLE_LIMIT:
+                return THROTTLED
+    return None
+
+def record(fbcfg, username, password, client, outcome):
+    """
+    Remember a login FogBugz rejected with ``outcome``.
+    """
+    cache = get_cache()
+    if fbcfg.FAILED_LOGON_CACHE_TTL:
+        cache.set(_rejected_key(username, password), outcome,
+                  fbcfg.FAILED_LOGON_CACHE_TTL)
+    if fbcfg.THROTTLE_LIMIT:
+        now = time.time()
+        for kind, value in (('username', username), ('client', client)):
+            if value:
+                _fail(cache, fbcfg.THROTTLE_WINDOW, kind, value, now)
+
+def check_client(fbcfg, client):
+    """
+    Return ``THROTTLED`` if ``client`` is over THROTTLE_LIMIT failures,
+    for requests without a username, such as :mod:`.tokens`.
+    """
+    if fbcfg.THROTTLE_LIMIT and client and _failures(
+            get_cache(), fbcfg.THROTTLE_WINDOW, 'client', client,
+            time.time()) >= fbcfg.THROTTLE_LIMIT:
+        return THROTTLED
+    return None
+
+def record_client(fbcfg, client):
+    """
+    Count a failure against ``client``.
+    """
+    if fbcfg.THROTTLE_LIMIT and client:
+        _fail(get_cache(), fbcfg.THROTTLE_WINDOW, 'client', client,
+              time.time())
+
+def remember_community(fbcfg, username, ixPerson):
+    """
+    Remember that ``username`` logs on as a community user, so later logins
+    are rejected before the ``logon`` and ``viewPerson`` calls.
+    """
+    if fbcfg.FAILED_LOGON_CACHE_TTL:
+        get_cache().set_many({
+            make_key('community_user', username): ixPerson,
+            _community_key(ixPerson): True,
+        }, fbcfg.FAILED_LOGON_CACHE_TTL)
+
+def forget_community(ixPerson):
+    """
+    Forget a cached community rejection, e.g. when the person is promoted.
+    """
+    get_cache().delete(_community_key(ixPerson))
+
+def _rejected_key(username, password):
+    ## keyed HMAC, so cache keys do not leak the password.
+    return make_key('rejected', login_key(username, password))
+
+def _community_key(ixPerson):
+    return make_key('community', str(ixPerson))
+
+def _window_keys(window, kind, value, now):
+    current = int(now // window)
+    return (make_key('failures', kind, value, str(current)),
+            make_key('failures', kind, value, str(current - 1)))
+
+def _failures(cache, window, kind, value, now):
+    current, previous = _window_keys(window, kind, value, now)
+    counts = cache.get_many([current, previous])
+    overlap = 1 - (now % window) / float(window)
+    return counts.get(current, 0) + counts.get(previous, 0) * overlap
+
+def _fail(cache, window, kind, value, now):
+    key = _window_keys(window, kind, value, now)[0]
+    ## kept for two windows, the next one still weighs it.
+    if cache.add(key, 1, window * 2):
+        return
+    try:
+        cache.incr(key)
+    except ValueError:
+        ## expired since the add().
+        cache.set(key, 1, window * 2)
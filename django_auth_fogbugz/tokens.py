@@ -0,0 +1,206 @@
+# Copyright (c) 2012, Douglas Napoleone.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+#     3. Neither the name of Django nor the names of its contributors may be
+#        used to endorse or promote products derived from this software without
+#        specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Resolution of FogBugz API tokens to Django users, for
+:class:`.backend.FogBugzTokenBackend`.
+
+A token is looked up in the indexed :attr:`.models.FogBugzProfile.token`
+column, and otherwise verified once with the FogBugz server (``viewPerson``)
+and matched to a profile by ``ixPerson``. The primary key of the user the
+token belongs to is kept in a per process least recently used cache for
+AUTH_FOGBUGZ_TOKEN_CACHE_TTL seconds, and the user itself (with its profile)
+in the AUTH_FOGBUGZ_CACHE_ALIAS cache, so a known token costs one cache hit
+and no query. The cached user is dropped by :func:`forget_users` whenever
+the user or profile is saved or deleted (see :mod:`.models`), so a user who
+was deactivated or demoted is not served from the cache.
+
+Unknown tokens are kept in a separate cache for UNKNOWN_TOKEN_TTL seconds, so
+they can not push out the tokens in use, and count as failures of the client
+in the failed logon throttle (see AUTH_FOGBUGZ_THROTTLE_LIMIT).
+"""
+
+from django.dispatch import receiver
+
+import logging
+import threading
+
+import fogbugz
+
+from . import throttle
+from .cache import LRUCache, get_cache, make_key
+from .client import FogBugzClient
+from .conf import SETTINGS_PREFIX, get_settings, setting_changed
+from .models import FogBugzProfile
+
+logger = logging.getLogger('django_auth_fogbugz')
+
+## FogBugz tokens are 30 or so characters, do not look up anything much
+## longer.
+MAX_TOKEN_LENGTH = 64
+
+## seconds an unknown token is remembered for, at most TOKEN_CACHE_TTL.
+UNKNOWN_TOKEN_TTL = 30
+
+_stores = None
+_stores_lock = threading.Lock()
+
+def get_stores():
+    """
+    Return the ``(users, unknown)`` caches, of the user primary key of each
+    token, and of the tokens which belong to no user.
+    """
+    global _stores
+    stores = _stores
+    if stores is None:
+        with _stores_lock:
+            stores = _stores
+            if stores is None:
+                size = get_settings().TOKEN_CACHE_SIZE
+                stores = _stores = (LRUCache(size), LRUCache(size))
+    return stores
+
+def get_user(token, client=None):
+    """
+    Return the active Django user ``token`` belongs to, or ``None``.
+    ``client`` is the address the request came from, for the throttle.
+    """
+    if not token or len(token) > MAX_TOKEN_LENGTH:
+        return None
+    fbcfg = get_settings()
+    store, unknown = get_stores()
+    if unknown.get(token):
+        return None
+    pk = store.get(token)
+    if pk is not None:
+        user = _cached_user(fbcfg, pk)
+    else:
+        if throttle.check_client(fbcfg, client):
+            logger.info("Turning away a token from (%s) after recent "
+                        "failures.", client)
+            return None
+        user = _find_user(fbcfg, token)
+        if user is None:
+            ## could not be checked, try again next time.
+            return None
+        if user is False:
+            throttle.record_client(fbcfg, client)
+    if user is False:
+        store.delete(token)
+        unknown.set(token, True, min(fbcfg.TOKEN_CACHE_TTL,
+                                     UNKNOWN_TOKEN_TTL))
+        return None
+    if pk is None:
+        store.set(token, user.pk, fbcfg.TOKEN_CACHE_TTL)
+        get_cache().set(_user_key(user.pk), user, fbcfg.TOKEN_CACHE_TTL)
+    return user
+
+def forget(token):
+    """
+    Drop the cached user of ``token``, when it is logged off or replaced.
+    """
+    stores = _stores
+    if stores is not None and token:
+        for store in stores:
+            store.delete(token)
+
+def forget_users(pks):
+    """
+    Drop the cached users with the primary keys ``pks``, when they or their
+    profiles change.
+    """
+    if pks:
+        get_cache().delete_many([_user_key(pk) for pk in pks])
+
+def _user_key(pk):
+    return make_key('token_user', str(pk))
+
+def _cached_user(fbcfg, pk):
+    """
+    The user (or ``False``) with the primary key ``pk``, from the cache when
+    it has not changed since.
+    """
+    cache = get_cache()
+    key = _user_key(pk)
+    user = cache.get(key)
+    if user is None:
+        user = _load_user(fbcfg, pk)
+        cache.set(key, user, fbcfg.TOKEN_CACHE_TTL)
+    return user
+
+def _profile_user(fbcfg, profile):
+    """
+    The user of ``profile``, or ``False`` if they may not use a token.
+    """
+    if profile.is_community and not fbcfg.ALLOW_COMMUNITY:
+        return False
+    user = profile.user
+    if not getattr(user, 'is_active', True):
+        return False
+    return user
+
+def _load_user(fbcfg, pk):
+    profile = FogBugzProfile.objects.select_related('user').filter(
+        pk=pk).first()
+    if profile is None:
+        return False
+    return _profile_user(fbcfg, profile)
+
+def _find_user(fbcfg, token):
+    """
+    Returns the user, ``False`` if there is none, or ``None`` if FogBugz
+    could not be reached.
+    """
+    profiles = FogBugzProfile.objects.select_related('user')
+    profile = profiles.filter(token=token).first()
+    if profile is None:
+        try:
+            person = FogBugzClient(fbcfg.SERVER, token).view_person()
+        except fogbugz.FogBugzConnectionError as e:
+            logger.warning("Could not verify a token with FogBugz server "
+                           "(%s): %s", fbcfg.SERVER, str(e))
+            return None
+        except fogbugz.FogBugzAPIError as e:
+            logger.debug("Unknown token: %s", str(e))
+            return False
+        if person.community and not fbcfg.ALLOW_COMMUNITY:
+            return False
+        profile = profiles.filter(ixPerson=person.ixPerson).first()
+        if profile is None:
+            logger.debug("No user for FogBugz person (%s) of a token.",
+                         person.ixPerson)
+            return False
+    return _profile_user(fbcfg, profile)
+
+@receiver(setting_changed)
+def _setting_changed(sender, setting=None, **kwargs):
+    global _stores
+    if setting and setting.startswith(SETTINGS_PREFIX):
+        with _stores_lock:
+            _stores = None
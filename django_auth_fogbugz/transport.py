@@ -0,0 +1,299 @@
+# Copyright (c) 2012, Douglas Napoleone.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+#     3. Neither the name of Django nor the names of its contributors may be
+#        used to endorse or promote products derived from this software without
+#        specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Pooled keep-alive HTTP transport shared by every FogBugz client the backend
+creates.
+
+FogBugzPy talks to the server through a urllib opener, which opens a new
+connection (and TLS handshake) for every request. :class:`PooledOpener` is a
+drop in replacement for that opener which keeps persistent HTTP/1.1
+connections per server in a :class:`ConnectionPool`.
+"""
+
+from http import client as httplib
+from io import BytesIO
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
+
+from django.dispatch import receiver
+
+import socket
+import threading
+import time
+
+from .breaker import CircuitOpenError, get_breaker
+from .conf import SETTINGS_PREFIX, get_settings, setting_changed
+
+
+class ConnectionPool(object):
+    """
+    Thread safe pool of idle persistent connections to one host.
+
+    At most ``maxsize`` idle connections are kept, connections idle for
+    more than ``idle_timeout`` seconds are closed instead of reused.
+    """
+    def __init__(self, scheme, host, port=None, maxsize=4, idle_timeout=30,
+                 timeout=None):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _new_connection(self):
+        if self.scheme == 'https':
+            conn_class = httplib.HTTPSConnection
+        else:
+            conn_class = httplib.HTTPConnection
+        if self.timeout is None:
+            return conn_class(self.host, self.port)
+        return conn_class(self.host, self.port, timeout=self.timeout)
+
+    def acquire(self):
+        """
+        Return ``(connection, reused)``, reusing the most recently released
+        idle connection if there is one.
+        """
+        now = time.time()
+        stale = []
+        conn = None
+        with self._lock:
+            while self._idle:
+                candidate, last_used = self._idle.pop()
+                if now - last_used > self.idle_timeout:
+                    stale.append(candidate)
+                else:
+                    conn = candidate
+                    break
+        for candidate in stale:
+            candidate.close()
+        if conn is not None:
+            return conn, True
+        return self._new_connection(), False
+
+    def release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.maxsize:
+                self._idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, last_used in idle:
+            conn.close()
+
+
+class PooledResponse(BytesIO):
+    """
+    Fully read response body, with the bits of the urllib response API
+    FogBugzPy and BeautifulSoup use.
+    """
+    def __init__(self, url, code, msg, headers, body):
+        BytesIO.__init__(self, body)
+        self.url = url
+        self.code = code
+        self.msg = msg
+        self.headers = headers
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.code
+
+    def info(self):
+        return self.headers
+
+
+class PooledStream(object):
+    """
+    Unread response body, for incremental parsing of large responses. The
+    connection goes back to the pool on :meth:`close` if the body was read
+    in full, and is closed otherwise.
+    """
+    def __init__(self, pool, conn, resp, url):
+        self.pool = pool
+        self.conn = conn
+        self.resp = resp
+        self.url = url
+        self.code = resp.status
+        self.headers = resp.msg
+
+    def read(self, amt=None):
+        try:
+            return self.resp.read(amt)
+        except (httplib.HTTPException, socket.error) as e:
+            raise URLError(e)
+
+    def close(self):
+        conn, self.conn = self.conn, None
+        if conn is None:
+            return
+        if self.resp.isclosed() and not self.resp.will_close:
+            self.pool.release(conn)
+        else:
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PooledOpener(object):
+    """
+    Minimal urllib opener replacement sending requests over a
+    :class:`ConnectionPool`. Network failures are raised as ``URLError``
+    and HTTP errors as ``HTTPError``, the same as a urllib opener would,
+    so FogBugzPy error handling is unchanged.
+    """
+    def __init__(self, pool, breaker=None):
+        self.pool = pool
+        self.breaker = breaker
+
+    def open(self, fullurl, data=None, timeout=None, stream=False):
+        """
+        Send the request and return the response. The body is read in full
+        and the connection returned to the pool, unless ``stream`` is set,
+        in which case a :class:`PooledStream` is returned.
+
+        With a :class:`.breaker.CircuitBreaker` every outcome is recorded,
+        and ``CircuitOpenError`` is raised without sending anything while
+        it is open.
+        """
+        breaker = self.breaker
+        if breaker is None:
+            return self._open(fullurl, data, stream)
+        if not breaker.allow():
+            raise CircuitOpenError(self.pool.host)
+        success = False
+        try:
+            response = self._open(fullurl, data, stream)
+            success = True
+        finally:
+            breaker.record(success)
+        return response
+
+    def _open(self, fullurl, data, stream):
+        if isinstance(fullurl, str):
+            url = fullurl
+            headers = {}
+        else:
+            url = fullurl.get_full_url()
+            if data is None:
+                data = getattr(fullurl, 'data', None)
+                if data is None and hasattr(fullurl, 'get_data'):
+                    data = fullurl.get_data()
+            headers = dict(fullurl.header_items())
+
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        method = 'POST' if data is not None else 'GET'
+
+        while True:
+            conn, reused = self.pool.acquire()
+            try:
+                conn.request(method, path, data, headers)
+                resp = conn.getresponse()
+                if not stream or resp.status >= 400:
+                    body = resp.read()
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                if reused and not isinstance(e, socket.timeout):
+                    ## The server closed an idle keep-alive connection,
+                    ## retry once on a fresh one.
+                    continue
+                raise URLError(e)
+            break
+
+        if stream and resp.status < 400:
+            return PooledStream(self.pool, conn, resp, url)
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self.pool.release(conn)
+
+        if resp.status >= 400:
+            raise HTTPError(url, resp.status, resp.reason, resp.msg,
+                            BytesIO(body))
+        return PooledResponse(url, resp.status, resp.reason, resp.msg, body)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(url):
+    """
+    Return the shared :class:`ConnectionPool` for the server of ``url``.
+    """
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    pool = _pools.get(key)
+    if pool is None:
+        fbcfg = get_settings()
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = ConnectionPool(parts.scheme, parts.hostname, parts.port,
+                                      maxsize=fbcfg.POOL_SIZE,
+                                      idle_timeout=fbcfg.POOL_IDLE_TIMEOUT,
+                                      timeout=fbcfg.TIMEOUT)
+                _pools[key] = pool
+    return pool
+
+def get_opener(url):
+    """
+    Return an opener for ``url`` sharing the server's connection pool.
+    """
+    return PooledOpener(get_pool(url), get_breaker(url))
+
+def close_pools():
+    """
+    Close every pooled connection, new pools are created on demand.
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+@receiver(setting_changed)
+def _setting_changed(sender, setting=None, **kwargs):
+    if setting and setting.startswith(SETTINGS_PREFIX):
+        close_pools()
@@ -0,0 +1,72 @@
+# Copyright (c) 2012, Douglas Napoleone.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+#     3. Neither the name of Django nor the names of its contributors may be
+#        used to endorse or promote products derived from this software without
+#        specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Endpoint for FogBugz person change notifications, see
+:mod:`.notify` and the AUTH_FOGBUGZ_NOTIFY_SECRET setting.
+"""
+
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest,
+                         HttpResponseForbidden)
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+
+from . import notify
+from .conf import get_settings
+
+
+@csrf_exempt
+@require_http_methods(['GET', 'POST'])
+def person_changed(request):
+    """
+    Queue a refresh of the users of the FogBugz people in the comma
+    separated ``ixPerson`` parameter. ``ts`` must be the current time (in
+    seconds since the epoch), and ``sig`` the :func:`.notify.sign`
+    signature of the ``ixPerson`` and ``ts`` values.
+
+    Responds ``202 Accepted`` once queued, the refresh happens in the
+    background.
+    """
+    fbcfg = get_settings()
+    if not fbcfg.NOTIFY_SECRET or not fbcfg.SYNC_TOKEN:
+        raise Http404
+    params = request.POST if request.method == 'POST' else request.GET
+    value = params.get('ixPerson', '')
+    if not notify.check_signature(fbcfg.NOTIFY_SECRET, value,
+                                  params.get('ts'), params.get('sig')):
+        return HttpResponseForbidden()
+    try:
+        ixPersons = set(int(v, 10) for v in value.split(',') if v.strip())
+    except ValueError:
+        return HttpResponseBadRequest()
+    if not ixPersons:
+        return HttpResponseBadRequest()
+    if not notify.queue_refresh(ixPersons):
+        return HttpResponse(status=503)
+    return HttpResponse(status=202)
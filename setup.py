@@ -11,15 +11,16 @@ setup(
     author="Doug Napoleone",
     author_email="doug.napoleone+django-auth-fogbugz@gmail.com",
     license="BSD",
-    packages=["django_auth_fogbugz"],
+    packages=find_packages(),
     classifiers=[
         "Development Status :: 5 - Production/Stable",
         "Environment :: Web Environment",
         "Programming Language :: Python",
-        "Programming Language :: Python :: 2.5",
-        "Programming Language :: Python :: 2.6",
-        "Programming Language :: Python :: 2.7",
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3 :: Only",
         "Framework :: Django",
+        "Framework :: Django :: 4.2",
+        "Framework :: Django :: 5.2",
         "Intended Audience :: Developers",
         "Intended Audience :: System Administrators",
         "License :: OSI Approved :: BSD License",
@@ -28,6 +29,7 @@ setup(
         #"Topic :: System :: Systems Administration :: Authentication/Directory :: FogBugz",
         "Topic :: Software Development :: Libraries :: Python Modules",
     ],
-    install_requires=['fogbugz',],
+    python_requires='>=3.8',
+    install_requires=['fogbugz', 'Django>=4.2', 'asgiref',],
     keywords=["django", "fogbugz", "authentication", "auth"],
 )
\ No newline at end of file